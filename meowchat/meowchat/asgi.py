@@ -8,11 +8,13 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "meowchat.settings")
 django_application = get_asgi_application()
 
 from . import urls  # noqa isort:skip
+from .lifespan import lifespan_application  # noqa isort:skip
 from webchat.middleware import JWTAuthMiddleWare  # noqa isort:skip
 
 application = ProtocolTypeRouter(
     {
         "http": get_asgi_application(),
         "websocket": JWTAuthMiddleWare(URLRouter(urls.websocket_urlpatterns)),
+        "lifespan": lifespan_application,
     }
 )
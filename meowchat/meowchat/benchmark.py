@@ -0,0 +1,315 @@
+"""Helpers shared by the `bench_*` management commands."""
+
+import asyncio
+import json
+import math
+import os
+import resource
+import tempfile
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+from django.test import override_settings
+
+# Rate limits that never reject, for benchmarks that send as fast as they can
+UNLIMITED_RATES = {scope: {"RATE": 1e9, "BURST": 1e9} for scope in ("CONNECTION", "USER", "CHANNEL")}
+
+# Channel layer inbox size for benchmarks, the default of 100 drops bursts to one channel
+BENCH_LAYER_CAPACITY = 100_000
+
+
+@contextmanager
+def private_channel_layer():
+    """Points the default channel layer at a temporary socket directory.
+
+    Benchmarks then never exchange group messages with servers running on the same host.
+    Inboxes hold `BENCH_LAYER_CAPACITY` messages, so senders going flat out are measured
+    rather than dropped.
+    """
+    with tempfile.TemporaryDirectory(prefix="meowchat-bench-") as socket_dir:
+        layer = dict(settings.CHANNEL_LAYERS["default"])
+        layer["CONFIG"] = {**layer.get("CONFIG", {}), "socket_dir": socket_dir, "capacity": BENCH_LAYER_CAPACITY}
+        with override_settings(CHANNEL_LAYERS={**settings.CHANNEL_LAYERS, "default": layer}):
+            yield
+
+
+@contextmanager
+def private_sequence_file():
+    """Gives write-behind a fresh sequence counter file, matching a freshly created database."""
+    with tempfile.TemporaryDirectory(prefix="meowchat-bench-") as directory:
+        write_behind = {**settings.WEBCHAT_WRITE_BEHIND, "SEQUENCE_FILE": os.path.join(directory, "sequences")}
+        with override_settings(WEBCHAT_WRITE_BEHIND=write_behind):
+            yield
+
+
+@contextmanager
+def benchmark_database():
+    """Runs the enclosed block against a throwaway test database, like the test runner does.
+
+    The channel layer and the sequence counters are private to the block as well, see
+    `private_channel_layer` and `private_sequence_file`. Buffered read markers and
+    queued messages are saved before the database goes, and their background threads
+    stopped, so nothing writes to it afterwards.
+    """
+    from webchat.persistence import close_message_writer
+    from webchat.read_markers import close_read_markers
+
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        with private_channel_layer(), private_sequence_file():
+            try:
+                yield
+            finally:
+                close_read_markers()
+                close_message_writer()
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+async def receive_chat_messages(communicator, expected, idle_timeout=5.0):
+    """Returns the `chat.message` frames a communicator receives, up to `expected` of them.
+
+    Gives up once nothing has arrived for `idle_timeout` seconds, so a run that lost
+    deliveries still ends and can report how many arrived. Other frames, e.g. resync
+    markers, are skipped. Each frame is returned with the `perf_counter` time it was read.
+    """
+    frames = []
+    while len(frames) < expected:
+        try:
+            # Straight from the queue, a timeout in receive_json_from would cancel the application
+            message = await asyncio.wait_for(communicator.output_queue.get(), idle_timeout)
+        except asyncio.TimeoutError:
+            break
+        if message["type"] != "websocket.send" or not message.get("text"):
+            continue
+        frame = json.loads(message["text"])
+        if frame.get("type") == "chat.message":
+            frames.append((time.perf_counter(), frame))
+    return frames
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+
+def rss_bytes():
+    """Returns the resident set size of this process, or its peak where /proc is missing."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # ru_maxrss is in kilobytes on Linux, bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class ScopeUser:
+    """ASGI wrapper that authenticates every connection as `user`, bypassing the JWT cookie."""
+
+    def __init__(self, app, user):
+        self.app = app
+        self.user = user
+
+    async def __call__(self, scope, receive, send):
+        return await self.app(dict(scope, user=self.user), receive, send)
+
+
+def create_chat_server(num_members, name="bench"):
+    """Creates a server with `num_members` members and returns `(server, members)`."""
+    from django.contrib.auth import get_user_model
+    from server.models import Category, Server
+
+    User = get_user_model()
+    User.objects.bulk_create(User(username=f"{name}-user-{i}") for i in range(num_members))
+    members = list(User.objects.filter(username__startswith=f"{name}-user-").order_by("id"))
+    category = Category.objects.create(name=f"{name}-category")
+    server = Server.objects.create(name=name, owner=members[0], category=category)
+    server.member.add(*members)
+    return server, members
+
+
+WORDS = (
+    "meow purr hiss nap tuna yarn box laser sunbeam whisker paw tail kibble catnip scratch "
+    "the a to and is it of for on with that this was but just so what lol ok yes no maybe"
+).split()
+
+
+def seed_dataset(
+    accounts,
+    servers,
+    categories=50,
+    channels_per_server=5,
+    members_per_server=25,
+    messages=0,
+    prefix="seed",
+    batch_size=10000,
+    seed=0,
+    log=None,
+):
+    """Fills the database with a synthetic chat dataset using `bulk_create`, and returns the row counts.
+
+    Every server gets an owner, a random category, `channels_per_server` channels with a
+    conversation each, and `members_per_server` members. Messages are spread over the
+    conversations with a long tail, a few channels get most of the traffic as they do in
+    real chats, and carry gapless sequence numbers. Signals do not fire, so the caches
+    they maintain are not warmed. Names start with `prefix`, so a dataset can be added
+    next to another one.
+    """
+    import random
+    from datetime import timedelta
+
+    from django.contrib.auth import get_user_model
+    from django.utils import timezone
+    from server.member_counts import refresh_member_counts
+    from server.models import Category, Channel, Server
+    from webchat.models import Conversation, Message
+
+    User = get_user_model()
+    rng = random.Random(seed)
+    log = log or (lambda text: None)
+
+    log(f"{accounts:,} accounts")
+    # "!" is an unusable password hash, hashing real passwords would dominate the run
+    User.objects.bulk_create(
+        (User(username=f"{prefix}-user-{i}", password="!") for i in range(accounts)), batch_size=batch_size
+    )
+    user_ids = list(User.objects.filter(username__startswith=f"{prefix}-user-").values_list("id", flat=True))
+
+    log(f"{categories:,} categories")
+    Category.objects.bulk_create(Category(name=f"{prefix}-category-{i}") for i in range(categories))
+    category_ids = list(Category.objects.filter(name__startswith=f"{prefix}-category-").values_list("id", flat=True))
+
+    log(f"{servers:,} servers")
+    Server.objects.bulk_create(
+        (
+            Server(
+                name=f"{prefix}-server-{i}",
+                owner_id=rng.choice(user_ids),
+                category_id=rng.choice(category_ids),
+                description=" ".join(rng.choices(WORDS, k=8)),
+            )
+            for i in range(servers)
+        ),
+        batch_size=batch_size,
+    )
+    server_rows = list(Server.objects.filter(name__startswith=f"{prefix}-server-").values_list("id", "owner_id"))
+
+    log(f"{servers * members_per_server:,} memberships")
+    Membership = Server.member.through
+    user_field = f"{Server.member.field.m2m_reverse_field_name()}_id"
+    members = {}
+    for server_id, owner_id in server_rows:
+        chosen = set(rng.sample(user_ids, min(members_per_server, len(user_ids))))
+        chosen.add(owner_id)
+        members[server_id] = list(chosen)
+    Membership.objects.bulk_create(
+        (
+            Membership(server_id=server_id, **{user_field: user_id})
+            for server_id, ids in members.items()
+            for user_id in ids
+        ),
+        batch_size=batch_size,
+    )
+    # bulk_create sends no m2m_changed, so the denormalized counts are set here
+    refresh_member_counts()
+
+    log(f"{servers * channels_per_server:,} channels")
+    Channel.objects.bulk_create(
+        (
+            Channel(name=f"channel-{i}", topic=rng.choice(WORDS), owner_id=owner_id, server_id=server_id)
+            for server_id, owner_id in server_rows
+            for i in range(channels_per_server)
+        ),
+        batch_size=batch_size,
+    )
+    channels = list(
+        Channel.objects.filter(server__name__startswith=f"{prefix}-server-")
+        .values_list("id", "server_id")
+        .order_by("id")
+        .iterator()
+    )
+    Conversation.objects.bulk_create(
+        (Conversation(channel_id=str(channel_id)) for channel_id, _ in channels),
+        batch_size=batch_size,
+        ignore_conflicts=True,
+    )
+    # Looked up by key rather than by a huge IN list, which SQLite caps at a few thousand parameters
+    conversations = dict(Conversation.objects.values_list("channel_id", "id").iterator())
+    # (conversation id, member ids of its server), in channel order
+    targets = [(conversations[str(channel_id)], members[server_id]) for channel_id, server_id in channels]
+
+    if messages and targets:
+        log(f"{messages:,} messages")
+        # Zipf-like weights: the n-th busiest channel gets 1/n of the busiest one's traffic
+        order = list(range(len(targets)))
+        rng.shuffle(order)
+        weights = [0.0] * len(targets)
+        for rank, index in enumerate(order, start=1):
+            weights[index] = 1 / rank
+        cumulative = []
+        total = 0.0
+        for weight in weights:
+            total += weight
+            cumulative.append(total)
+
+        # Messages skip bulk_create's per-row model instances and go straight to executemany,
+        # which is what makes tens of millions of rows practical
+        columns = ("conversation_id", "sender_id", "content", "timestamp", "sequence")
+        insert_message = "INSERT INTO {} ({}) VALUES ({})".format(
+            connection.ops.quote_name(Message._meta.db_table),
+            ", ".join(connection.ops.quote_name(column) for column in columns),
+            ", ".join(["%s"] * len(columns)),
+        )
+        adapt_timestamp = connection.ops.adapt_datetimefield_value
+        contents = [" ".join(rng.choices(WORDS, k=rng.randint(2, 30))) for _ in range(1000)]
+
+        sequences = [0] * len(targets)
+        started_at = timezone.now() - timedelta(days=90)
+        step = timedelta(days=90) / messages
+        written = 0
+        while written < messages:
+            count = min(batch_size, messages - written)
+            picks = rng.choices(range(len(targets)), cum_weights=cumulative, k=count)
+            rows = []
+            for offset, index in enumerate(picks):
+                conversation_id, member_ids = targets[index]
+                sequences[index] += 1
+                rows.append(
+                    (
+                        conversation_id,
+                        rng.choice(member_ids),
+                        rng.choice(contents),
+                        adapt_timestamp(started_at + step * (written + offset)),
+                        sequences[index],
+                    )
+                )
+            with connection.cursor() as cursor:
+                cursor.executemany(insert_message, rows)
+            written += count
+            if written % (batch_size * 100) == 0:
+                log(f"messages, {written:,} written so far")
+
+        Conversation.objects.bulk_update(
+            [
+                Conversation(id=conversation_id, last_sequence=sequence)
+                for (conversation_id, _), sequence in zip(targets, sequences)
+                if sequence
+            ],
+            ["last_sequence"],
+            batch_size=batch_size,
+        )
+
+    return {
+        "accounts": len(user_ids),
+        "categories": len(category_ids),
+        "servers": len(server_rows),
+        "memberships": sum(len(ids) for ids in members.values()),
+        "channels": len(channels),
+        "messages": messages if targets else 0,
+    }
@@ -0,0 +1,40 @@
+"""ASGI lifespan handling.
+
+uvicorn runs each `--workers` process as a multiprocessing child, which exits without
+running `atexit` hooks, so state that must survive a shutdown (e.g. buffered writes)
+registers a callback here and gets flushed on `lifespan.shutdown` instead.
+"""
+
+import logging
+
+from asgiref.sync import sync_to_async
+
+logger = logging.getLogger(__name__)
+
+_shutdown_callbacks = []
+
+
+def on_shutdown(callback):
+    """Registers a synchronous `callback` to run when the ASGI server shuts down."""
+    if callback not in _shutdown_callbacks:
+        _shutdown_callbacks.append(callback)
+    return callback
+
+
+def run_shutdown_callbacks():
+    for callback in list(_shutdown_callbacks):
+        try:
+            callback()
+        except Exception:
+            logger.exception("Shutdown callback %r failed", callback)
+
+
+async def lifespan_application(scope, receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await sync_to_async(run_shutdown_callbacks)()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
@@ -0,0 +1,172 @@
+"""Process-wide metrics for the realtime paths.
+
+Metrics are registered once, at import time of the module that updates them, and are
+read back by name. Each worker process counts on its own. `render_prometheus` writes
+every registered metric in the Prometheus text exposition format:
+
+* `Counter`, a number that only goes up,
+* `Gauge`, a number per label set that goes up and down, label sets at zero are dropped,
+* `Histogram`, counts of observations per bucket plus their sum,
+* `Collector`, a gauge whose values are computed by a function when metrics are read.
+
+Updating a metric is a lock and an addition, cheap enough to do on every message.
+"""
+
+import bisect
+import math
+import threading
+
+# Seconds, from a fast in-memory step to a slow database write
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, description=""):
+        self.name = name
+        self.description = description
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        yield self.name, {}, self.value
+
+
+class Gauge:
+    type = "gauge"
+
+    def __init__(self, name, description="", labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            value = self.values.get(label_values, 0) + amount
+            if value:
+                self.values[label_values] = value
+            else:
+                self.values.pop(label_values, None)
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def samples(self):
+        with self._lock:
+            values = list(self.values.items())
+        for label_values, value in values:
+            yield self.name, dict(zip(self.labels, label_values)), value
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, description="", buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def samples(self):
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            yield f"{self.name}_bucket", {"le": format_value(bound)}, cumulative
+        yield f"{self.name}_sum", {}, total
+        yield f"{self.name}_count", {}, cumulative
+
+
+class Collector:
+    type = "gauge"
+
+    def __init__(self, name, description, function, labels=()):
+        self.name = name
+        self.description = description
+        self.function = function
+        self.labels = labels
+
+    def samples(self):
+        for label_values, value in self.function().items():
+            yield self.name, dict(zip(self.labels, label_values)), value
+
+
+def _register(name, factory):
+    with _registry_lock:
+        if name not in _registry:
+            _registry[name] = factory()
+        return _registry[name]
+
+
+def counter(name, description=""):
+    """Returns the counter called `name`, registering it on first use."""
+    return _register(name, lambda: Counter(name, description))
+
+
+def gauge(name, description="", labels=()):
+    """Returns the gauge called `name`, registering it on first use."""
+    return _register(name, lambda: Gauge(name, description, labels))
+
+
+def histogram(name, description="", buckets=LATENCY_BUCKETS):
+    """Returns the histogram called `name`, registering it on first use."""
+    return _register(name, lambda: Histogram(name, description, buckets))
+
+
+def collector(name, description, function, labels=()):
+    """Registers a gauge read from `function()`, a `{label_values: value}` dict."""
+    return _register(name, lambda: Collector(name, description, function, labels))
+
+
+def get_metrics():
+    """Returns every registered metric, by name."""
+    with _registry_lock:
+        return dict(_registry)
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def render_prometheus():
+    """Returns every registered metric in the Prometheus text exposition format."""
+    lines = []
+    for name, metric in sorted(get_metrics().items()):
+        if metric.description:
+            lines.append(f"# HELP {name} {_escape(metric.description)}")
+        lines.append(f"# TYPE {name} {metric.type}")
+        for sample_name, labels, value in metric.samples():
+            if labels:
+                label_text = ",".join(f'{key}="{_escape(label)}"' for key, label in labels.items())
+                sample_name = f"{sample_name}{{{label_text}}}"
+            lines.append(f"{sample_name} {format_value(value)}")
+    return "\n".join(lines) + "\n"
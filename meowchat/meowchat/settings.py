@@ -235,8 +235,146 @@ CORS_ALLOW_METHODS = [
 ]
 
 
+# Shared by the worker processes of this deployment through Unix sockets, no broker
+# needed; the socket directory defaults to one derived from BASE_DIR, so other
+# checkouts on the same host form meshes of their own
 CHANNEL_LAYERS = {
-    "default": {"BACKEND": "channels.layers.InMemoryChannelLayer"},
+    "default": {
+        "BACKEND": "webchat.layers.UnixSocketChannelLayer",
+        "CONFIG": {
+            "socket_dir": os.environ.get("CHANNEL_LAYER_SOCKET_DIR"),
+        },
+    },
+}
+
+# WebSocket consumer implementation: "async" (event-loop native) or "sync" (thread per message)
+WEBCHAT_CONSUMER = os.environ.get("WEBCHAT_CONSUMER", "async").lower()
+
+# Seconds a server's member list is cached for WebSocket authorization
+SERVER_MEMBERSHIP_CACHE_TTL = 60
+
+# "listing" lives in files shared by the worker processes of this checkout, so a change
+# made through one worker invalidates the listings cached by all of them
+CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "listing": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": os.environ.get("SERVER_LIST_CACHE_DIR", os.path.join(BASE_DIR, "cache", "listing")),
+        "OPTIONS": {"MAX_ENTRIES": 2000},
+    },
+}
+
+# Server and category listing responses cached in the named Django cache, invalidated
+# whenever a server, channel, category or membership changes; TTL 0 disables the cache.
+# The cache must be shared by every worker, a per-process one serves stale listings
+SERVER_LIST_CACHE = {
+    "ALIAS": "listing",
+    "TTL": 300,
+}
+
+# Message history page size, and the most a client may ask for with `limit`
+WEBCHAT_MESSAGE_PAGE_SIZE = 50
+WEBCHAT_MESSAGE_PAGE_SIZE_MAX = 200
+
+# Most missed messages replayed to a resuming WebSocket before it is told to refetch history
+WEBCHAT_REPLAY_MAX = 500
+
+# Seconds a typing ping keeps a user listed as typing, and the shortest gap between
+# two typing snapshots broadcast to a channel
+WEBCHAT_TYPING_TTL = 3.0
+WEBCHAT_TYPING_INTERVAL = 0.5
+
+# Outbound frames queued per WebSocket before the slow-consumer policy kicks in:
+# "drop_oldest", "resync" (replace the backlog with a resync marker) or "close" (code 4008)
+WEBCHAT_SEND_QUEUE = {
+    "MAX_FRAMES": 256,
+    "POLICY": os.environ.get("WEBCHAT_SEND_QUEUE_POLICY", "resync"),
+}
+
+# Token buckets for incoming chat messages: messages per second and burst size, per
+# connection, per user on a server, and for all senders in a channel together
+WEBCHAT_RATE_LIMITS = {
+    "CONNECTION": {"RATE": 5, "BURST": 10},
+    "USER": {"RATE": 8, "BURST": 15},
+    "CHANNEL": {"RATE": 100, "BURST": 200},
+}
+# Per-server overrides of WEBCHAT_RATE_LIMITS, e.g. {42: {"CHANNEL": {"RATE": 20}}}
+WEBCHAT_SERVER_RATE_LIMITS = {}
+
+# MessagePack frames of at least this many bytes are zlib compressed, None disables compression
+WEBCHAT_MSGPACK_COMPRESS_MIN = 512
+# Largest MessagePack payload accepted from a client, after decompression
+WEBCHAT_MSGPACK_MAX_PAYLOAD = 64 * 1024
+
+# Log every step of each WebSocket handshake from startup, SIGUSR2 toggles it at runtime
+WEBCHAT_TRACE_CONNECTIONS = os.environ.get("WEBCHAT_TRACE_CONNECTIONS", "False").lower() in ("true", "1", "yes")
+
+# Fraction of the records of an event that are logged, events not listed are always logged
+WEBCHAT_LOG_SAMPLING = {
+    "ws.connected": 0.1,
+    "layer.message.dropped": 0.01,
+}
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "filters": {
+        "sample": {"()": "webchat.logs.SampleFilter", "rates": WEBCHAT_LOG_SAMPLING},
+        # At most 10 records of the same event per minute, the rest are counted
+        "repeats": {"()": "webchat.logs.RepeatFilter", "limit": 10, "window": 60},
+    },
+    "formatters": {
+        "structured": {"()": "webchat.logs.StructuredFormatter"},
+    },
+    "handlers": {
+        "realtime": {
+            "class": "webchat.logs.QueueingHandler",
+            "formatter": "structured",
+            "filters": ["sample", "repeats"],
+        },
+    },
+    "loggers": {
+        "webchat.realtime": {"handlers": ["realtime"], "level": "INFO", "propagate": False},
+        "webchat.trace": {"handlers": ["realtime"], "level": "INFO", "propagate": False},
+    },
+}
+
+# Messages older than AFTER_DAYS are moved out of the message table into compressed
+# segment files by `archive_messages`; AFTER_DAYS None keeps everything in the table
+WEBCHAT_ARCHIVE = {
+    "DIR": os.environ.get("WEBCHAT_ARCHIVE_DIR", os.path.join(BASE_DIR, "archive")),
+    "AFTER_DAYS": 90,
+    "SEGMENT_MESSAGES": 50000,  # Messages per segment file
+    "BLOCK_MESSAGES": 256,  # Messages per compressed block, the unit a read decompresses
+}
+# Per-server overrides of WEBCHAT_ARCHIVE["AFTER_DAYS"], e.g. {42: 30} or {7: None}
+WEBCHAT_SERVER_ARCHIVE_AFTER_DAYS = {}
+
+# Verified WebSocket access tokens kept per process, and the longest a cached token is
+# trusted before it is checked again; MAX_ENTRIES 0 disables the cache
+WEBCHAT_TOKEN_CACHE = {
+    "MAX_ENTRIES": 10000,
+    "TTL": 300,
+}
+
+# Rows fetched per round trip when streaming a channel export
+WEBCHAT_EXPORT_CHUNK_SIZE = 2000
+
+# Write-behind message persistence: broadcast first, then bulk insert queued messages
+WEBCHAT_WRITE_BEHIND = {
+    "ENABLED": os.environ.get("WEBCHAT_WRITE_BEHIND", "False").lower() in ("true", "1", "yes"),
+    "BATCH_SIZE": 200,  # Rows per bulk_create
+    "FLUSH_INTERVAL": 0.05,  # Seconds between timed flushes
+    "MAX_PENDING": 5000,  # Unsaved messages allowed before senders flush inline
+    # Counter file the workers draw message sequence numbers from, None for one in the
+    # temp directory private to this checkout and database
+    "SEQUENCE_FILE": os.environ.get("WEBCHAT_SEQUENCE_FILE"),
+}
+
+# Read acknowledgements are coalesced per user and conversation and saved together
+# every FLUSH_INTERVAL seconds
+WEBCHAT_READ_MARKERS = {
+    "FLUSH_INTERVAL": 1.0,
 }
 
 # Token Authentication Settings
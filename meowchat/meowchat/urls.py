@@ -18,8 +18,8 @@ from django.views.generic import TemplateView
 from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView
 from rest_framework.routers import DefaultRouter
 from server.views import CategoryListViewSet, ServerListViewSet, ServerMemebershipViewSet, cors_test
-from webchat.consumer import WebChatConsumer
-from webchat.views import MessageViewSet
+from webchat.consumer import get_consumer_class
+from webchat.views import MessageViewSet, MetricsView
 
 router = DefaultRouter()
 router.register("api/server/select", ServerListViewSet)
@@ -53,6 +53,7 @@ urlpatterns = [
     path("api/register/", RegisterView.as_view(), name="register"),
     
     path("api/cors-test/", cors_test, name="cors_test"),
+    path("api/metrics/", MetricsView.as_view(), name="metrics"),
 ] + router.urls
 
 # Serve React app for all non-API routes (catch-all)
@@ -60,7 +61,7 @@ urlpatterns += [
     re_path(r'^(?!api|admin|ws).*$', TemplateView.as_view(template_name='index.html'), name='react_app'),
 ]
 
-websocket_urlpatterns = [path("ws/<str:serverId>/<str:channelId>", WebChatConsumer.as_asgi())]
+websocket_urlpatterns = [path("ws/<str:serverId>/<str:channelId>", get_consumer_class().as_asgi())]
 
 if settings.DEBUG:
     urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
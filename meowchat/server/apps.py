@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class ServerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'server'
+
+    def ready(self):
+        from . import listing_cache  # noqa: F401 (connects the listing cache signals)
+        from . import member_counts  # noqa: F401 (connects the member count signals)
+        from . import membership  # noqa: F401 (connects the membership cache signals)
@@ -0,0 +1,109 @@
+"""Response cache for the server and category listings.
+
+Dashboards start with `/api/server/select/` and `/api/server/category/`, whose data
+changes far less often than it is read. Serialized responses are kept in the Django
+cache named by `SERVER_LIST_CACHE["ALIAS"]`, keyed by the normalized query parameters
+and stamped with a listing version. Any save or delete of a `Server`, `Channel` or
+`Category`, and any membership change, bumps the version, so every cached listing
+goes stale at once and nothing has to know which keys a change affects.
+
+The cache has to be shared by the worker processes for a bump to reach all of them.
+The default "listing" alias keeps it in files, which needs no broker; a per-process
+memory cache would let other workers serve their copy for up to
+`SERVER_LIST_CACHE["TTL"]` seconds. A TTL of 0 disables the cache.
+"""
+
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from meowchat.metrics import counter, histogram
+
+from .models import Category, Channel, Server
+
+VERSION_KEY = "server.listing.version"
+
+hits = counter("server_listing_cache_hits_total", "Server and category listings served from the cache")
+misses = counter("server_listing_cache_misses_total", "Server and category listings built from the database")
+hit_seconds = histogram("server_listing_cache_hit_seconds", "Time to serve a cached listing")
+miss_seconds = histogram("server_listing_cache_miss_seconds", "Time to build and cache a listing")
+
+
+def get_cache():
+    return caches[settings.SERVER_LIST_CACHE.get("ALIAS", "default")]
+
+
+def listing_version(cache):
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # Started from the clock, so an evicted counter never restarts at a version that
+        # entries were cached under before
+        cache.add(VERSION_KEY, time.time_ns(), timeout=None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def bump_version():
+    """Makes every cached listing stale."""
+    cache = get_cache()
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.add(VERSION_KEY, time.time_ns(), timeout=None)
+
+
+def listing_key(name, params):
+    digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+    return f"server.listing.{name}.{digest}"
+
+
+def cached_listing(name, params, build):
+    """Returns the cached data of listing `name` for `params`, calling `build()` on a miss.
+
+    `params` must be the normalized parameters the data depends on, or None to bypass
+    the cache, e.g. for a request that is going to be rejected.
+    """
+    ttl = settings.SERVER_LIST_CACHE.get("TTL", 0)
+    if not ttl or params is None:
+        return build()
+
+    started = time.perf_counter()
+    cache = get_cache()
+    version = listing_version(cache)
+    key = listing_key(name, params)
+    data = cache.get(key, version=version)
+    if data is not None:
+        hits.inc()
+        hit_seconds.observe(time.perf_counter() - started)
+        return data
+
+    data = build()
+    cache.set(key, data, timeout=ttl, version=version)
+    misses.inc()
+    miss_seconds.observe(time.perf_counter() - started)
+    return data
+
+
+def listing_changed(**kwargs):
+    bump_version()
+    # A request between this bump and the commit may cache what it read under the new
+    # version, bumping again once the change is visible throws that away
+    connection = transaction.get_connection()
+    if connection.in_atomic_block:
+        transaction.on_commit(bump_version)
+
+
+for model in (Server, Channel, Category):
+    post_save.connect(listing_changed, sender=model, dispatch_uid=f"server_listing_{model.__name__}_saved")
+    post_delete.connect(listing_changed, sender=model, dispatch_uid=f"server_listing_{model.__name__}_deleted")
+
+
+@receiver(m2m_changed, sender=Server.member.through)
+def server_member_changed(sender, action, **kwargs):
+    if action in ("post_add", "post_remove", "post_clear"):
+        listing_changed()
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from server.member_counts import drifted_member_counts, refresh_member_counts
+
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = "Recounts Server.member_count from the member table and repairs servers whose count drifted."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only report the servers that drifted")
+
+    def handle(self, *args, **options):
+        drifted = drifted_member_counts()
+        for server_id, member_count, actual in drifted:
+            self.stdout.write(f"Server {server_id}: member_count {member_count}, {actual} members")
+
+        if options["dry_run"]:
+            self.stdout.write(f"{len(drifted)} member counts drifted")
+            return
+
+        server_ids = [server_id for server_id, _, _ in drifted]
+        for start in range(0, len(server_ids), BATCH_SIZE):
+            refresh_member_counts(server_ids[start : start + BATCH_SIZE])
+        self.stdout.write(self.style.SUCCESS(f"Repaired {len(drifted)} member counts"))
@@ -0,0 +1,79 @@
+"""Denormalized member counts.
+
+`Server.member_count` mirrors the number of rows a server has in the member table, so
+listings can show, filter and order by it without a GROUP BY over that table. Every
+membership change recounts the servers it touched from the (server, account) index:
+`m2m_changed` covers adding, removing and clearing from either side, and deleting an
+account covers the member rows removed by the cascade. Writes that bypass the ORM
+relation, e.g. a `bulk_create` on the member table, leave the count stale until
+`reconcile_member_counts` runs. Cached server listings show the count, so they are made
+stale along with it when an account is deleted; `m2m_changed` already does that for the
+other changes.
+"""
+
+from django.conf import settings
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.signals import m2m_changed, post_delete, pre_delete
+from django.dispatch import receiver
+
+from .listing_cache import listing_changed
+from .models import Server
+
+
+def counted_members():
+    """The number of member rows of the outer server, as a subquery expression."""
+    Membership = Server.member.through
+    members = (
+        Membership.objects.filter(server_id=OuterRef("pk"))
+        .order_by()
+        .values("server_id")
+        .annotate(count=Count("*"))
+        .values("count")
+    )
+    return Coalesce(Subquery(members), 0)
+
+
+def refresh_member_counts(server_ids=None):
+    """Recounts the members of `server_ids`, or of every server, returning how many were updated."""
+    servers = Server.objects.all() if server_ids is None else Server.objects.filter(id__in=server_ids)
+    return servers.update(member_count=counted_members())
+
+
+def drifted_member_counts():
+    """Returns `(server_id, member_count, actual_count)` of every server whose count is wrong."""
+    return list(
+        Server.objects.annotate(actual=counted_members())
+        .exclude(member_count=F("actual"))
+        .order_by("id")
+        .values_list("id", "member_count", "actual")
+    )
+
+
+@receiver(m2m_changed, sender=Server.member.through)
+def server_member_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action == "post_clear" or (action in ("post_add", "post_remove") and pk_set):
+            refresh_member_counts([instance.pk])
+        return
+
+    # user.server_set.add/remove/clear, `instance` is the user and `pk_set` holds server ids
+    if action == "pre_clear":
+        instance._cleared_server_ids = list(instance.server_set.values_list("id", flat=True))
+    elif action == "post_clear":
+        refresh_member_counts(instance.__dict__.pop("_cleared_server_ids", []))
+    elif action in ("post_add", "post_remove") and pk_set:
+        refresh_member_counts(pk_set)
+
+
+@receiver(pre_delete, sender=settings.AUTH_USER_MODEL)
+def account_deleting(sender, instance, **kwargs):
+    instance._member_of_server_ids = list(instance.server_set.values_list("id", flat=True))
+
+
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def account_deleted(sender, instance, **kwargs):
+    server_ids = instance.__dict__.pop("_member_of_server_ids", None)
+    if server_ids:
+        refresh_member_counts(server_ids)
+        listing_changed()
@@ -0,0 +1,212 @@
+"""Process-local cache of server membership.
+
+Every server's member ids are loaded with one query the first time the server is
+looked up and kept for `SERVER_MEMBERSHIP_CACHE_TTL` seconds. `m2m_changed` on
+`Server.member` applies the change to the cache of the process that made it once the
+transaction commits, so a rolled back change is never cached, and broadcasts it on
+the server's membership group. `membership_subscriber` keeps one channel per process
+in the groups of the servers it has open sockets for, so those processes apply it
+too; the TTL bounds staleness everywhere else.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Server
+
+logger = logging.getLogger(__name__)
+
+MISSING = object()
+
+
+def membership_group(server_id):
+    return f"membership.{server_id}"
+
+
+class MembershipCache:
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._servers = {}
+        self._lock = threading.Lock()
+
+    def get(self, server_id, user_id):
+        """Returns whether the user is a member, None if the server does not exist, or MISSING."""
+        entry = self._servers.get(int(server_id))
+        if entry is None or entry[0] < time.monotonic():
+            return MISSING
+        member_ids = entry[1]
+        if member_ids is None:
+            return None
+        return user_id in member_ids
+
+    def is_member(self, server_id, user_id):
+        """Like `get`, but loads the server on a cache miss."""
+        is_member = self.get(server_id, user_id)
+        if is_member is MISSING:
+            self.load(server_id)
+            is_member = self.get(server_id, user_id)
+        return is_member
+
+    def load(self, *server_ids):
+        """Fetches the member ids of `server_ids` in a single query."""
+        server_ids = {int(server_id) for server_id in server_ids}
+        members = {server_id: None for server_id in server_ids}
+        for server_id, user_id in Server.objects.filter(id__in=server_ids).values_list("id", "member"):
+            if members[server_id] is None:
+                members[server_id] = set()
+            if user_id is not None:
+                members[server_id].add(user_id)
+
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            for server_id, member_ids in members.items():
+                self._servers[server_id] = (expires_at, member_ids)
+
+    def apply(self, server_id, added=(), removed=(), reset=False):
+        """Applies a membership change to the cached entry of `server_id`, if there is one."""
+        server_id = int(server_id)
+        with self._lock:
+            if reset:
+                self._servers.pop(server_id, None)
+                return
+            entry = self._servers.get(server_id)
+            if entry is None or entry[1] is None:
+                return
+            entry[1].update(added)
+            entry[1].difference_update(removed)
+
+    def invalidate(self, server_id=None):
+        with self._lock:
+            if server_id is None:
+                self._servers.clear()
+            else:
+                self._servers.pop(int(server_id), None)
+
+
+membership_cache = MembershipCache(ttl=getattr(settings, "SERVER_MEMBERSHIP_CACHE_TTL", 60))
+
+
+def publish_membership_change(server_id, added=(), removed=(), reset=False):
+    """Once the change commits, updates the local cache and tells every process with sockets on the server."""
+    event = {
+        "type": "membership.changed",
+        "server_id": server_id,
+        "added": list(added),
+        "removed": list(removed),
+        "reset": reset,
+    }
+
+    def publish():
+        membership_cache.apply(server_id, event["added"], event["removed"], reset)
+        channel_layer = get_channel_layer()
+        if channel_layer is not None:
+            async_to_sync(channel_layer.group_send)(membership_group(server_id), event)
+
+    transaction.on_commit(publish)
+
+
+class MembershipSubscriber:
+    """Receives membership changes once per process for every server it has sockets on.
+
+    One channel of this process is in `membership.<server_id>` while at least one of
+    its sockets is connected to the server, and a single task applies the changes that
+    arrive to `membership_cache`. A change then costs one channel-layer message per
+    process instead of one per socket. Sockets call `subscribe` on connect and
+    `unsubscribe` on disconnect.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._layer = None
+        self._channel = None
+        self._listener = None
+        self._sockets = {}
+
+    async def subscribe(self, server_id):
+        channel_layer = get_channel_layer()
+        channel = await self._listen(channel_layer)
+        server_id = int(server_id)
+        self._sockets[server_id] = self._sockets.get(server_id, 0) + 1
+        # Repeated for every socket, which also keeps the membership from expiring
+        await channel_layer.group_add(membership_group(server_id), channel)
+
+    async def unsubscribe(self, server_id):
+        server_id = int(server_id)
+        # Counted on another event loop, or never subscribed
+        if server_id not in self._sockets or self._loop is not asyncio.get_running_loop():
+            return
+        sockets = self._sockets.pop(server_id) - 1
+        if sockets > 0:
+            self._sockets[server_id] = sockets
+        else:
+            await self._layer.group_discard(membership_group(server_id), self._channel.result())
+
+    async def _listen(self, channel_layer):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._layer is not channel_layer:
+            # First socket, or a new event loop or channel layer, e.g. from one test to the next
+            if self._listener is not None and self._loop is loop:
+                self._listener.cancel()
+            self._loop, self._layer, self._sockets = loop, channel_layer, {}
+            self._channel = loop.create_future()
+            self._listener = loop.create_task(self._receive(channel_layer, self._channel))
+        return await asyncio.shield(self._channel)
+
+    async def _receive(self, channel_layer, channel):
+        try:
+            channel.set_result(await channel_layer.new_channel())
+        except Exception as error:
+            channel.set_exception(error)
+            self._loop = None
+            return
+        while True:
+            try:
+                event = await channel_layer.receive(channel.result())
+                if event.get("type") == "membership.changed":
+                    membership_cache.apply(event["server_id"], event["added"], event["removed"], event["reset"])
+            except Exception:
+                logger.exception("Applying a membership change failed")
+                await asyncio.sleep(1)
+
+
+membership_subscriber = MembershipSubscriber()
+
+
+@receiver(m2m_changed, sender=Server.member.through)
+def server_member_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+
+    if not reverse:
+        if action == "post_clear":
+            publish_membership_change(instance.id, reset=True)
+        elif action == "post_add":
+            publish_membership_change(instance.id, added=pk_set)
+        else:
+            publish_membership_change(instance.id, removed=pk_set)
+        return
+
+    # user.server_set.add/remove/clear, `instance` is the user and `pk_set` holds server ids
+    if action == "post_clear":
+        transaction.on_commit(membership_cache.invalidate)
+        return
+    for server_id in pk_set:
+        if action == "post_add":
+            publish_membership_change(server_id, added=[instance.id])
+        else:
+            publish_membership_change(server_id, removed=[instance.id])
+
+
+@receiver(post_save, sender=Server)
+@receiver(post_delete, sender=Server)
+def server_saved_or_deleted(sender, instance, **kwargs):
+    membership_cache.invalidate(instance.id)
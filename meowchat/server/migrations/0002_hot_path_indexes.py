@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("server", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="category",
+            name="name",
+            field=models.CharField(db_index=True, max_length=100),
+        ),
+        # The auto-created member table only indexes account_id on its own, this lets
+        # "servers of user X" (by_user) be answered from the index alone.
+        migrations.RunSQL(
+            'CREATE INDEX "server_member_account_server_idx" ON "server_server_member" ("account_id", "server_id")',
+            'DROP INDEX "server_member_account_server_idx"',
+        ),
+    ]
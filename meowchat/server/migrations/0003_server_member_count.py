@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:49
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_members(apps, schema_editor):
+    Server = apps.get_model("server", "Server")
+    Membership = Server.member.through
+    members = (
+        Membership.objects.filter(server_id=OuterRef("pk"))
+        .order_by()
+        .values("server_id")
+        .annotate(count=Count("*"))
+        .values("count")
+    )
+    Server.objects.update(member_count=Coalesce(Subquery(members), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("server", "0002_hot_path_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="server",
+            name="member_count",
+            field=models.PositiveIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.RunPython(count_members, migrations.RunPython.noop),
+    ]
@@ -19,7 +19,7 @@ def category_icon_upload_path(instance, filename):
 
 
 class Category(models.Model):
-    name = models.CharField(max_length=100)
+    name = models.CharField(max_length=100, db_index=True)
     description = models.TextField(blank=True, null=True)
     icon = models.FileField(
         upload_to=category_icon_upload_path,
@@ -53,6 +53,8 @@ class Server(models.Model):
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name="server_category")
     description = models.CharField(max_length=250, blank=True, null=True)
     member = models.ManyToManyField(settings.AUTH_USER_MODEL)
+    # Rows of `member`, kept in step by `server.member_counts`
+    member_count = models.PositiveIntegerField(default=0, db_index=True, editable=False)
     banner = models.ImageField(
         upload_to=server_banner_upload_path,
         null=True,
@@ -69,6 +71,8 @@ class Server(models.Model):
     def save(self, *args, **kwargs):
         if self.id:
             existing = get_object_or_404(Server, id=self.id)
+            # Owned by the membership signals, a stale instance must not write an old count back
+            self.member_count = existing.member_count
             if existing.icon != self.icon:
                 existing.icon.delete(save=False)
             if existing.banner != self.banner:
@@ -30,6 +30,25 @@ server_list_docs = extend_schema(
             location=OpenApiParameter.QUERY,
             description="Include the number of members for each server in the response",
         ),
+        OpenApiParameter(
+            name="num_members__gte",
+            type=OpenApiTypes.INT,
+            location=OpenApiParameter.QUERY,
+            description="Only servers with at least this many members",
+        ),
+        OpenApiParameter(
+            name="num_members__lte",
+            type=OpenApiTypes.INT,
+            location=OpenApiParameter.QUERY,
+            description="Only servers with at most this many members",
+        ),
+        OpenApiParameter(
+            name="ordering",
+            type=OpenApiTypes.STR,
+            location=OpenApiParameter.QUERY,
+            enum=["num_members", "-num_members"],
+            description="Order by number of members, -num_members for the largest servers first",
+        ),
         OpenApiParameter(
             name="by_serverid",
             type=OpenApiTypes.INT,
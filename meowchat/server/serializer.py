@@ -22,7 +22,8 @@ class ServerSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Server
-        exclude = ("member",)
+        # member_count is reported as num_members when asked for with_num_members
+        exclude = ("member", "member_count")
 
     def get_num_members(self, obj):
         if hasattr(obj, "num_members"):
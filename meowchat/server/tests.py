@@ -1,3 +1,322 @@
-from django.test import TestCase
+import io
+import itertools
+import tempfile
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.management import call_command
+from django.db import DatabaseError, connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from .listing_cache import VERSION_KEY, get_cache, hits, misses
+from .membership import MISSING, membership_cache
+from .models import Category, Channel, Server
+
+User = get_user_model()
+
+
+class MembershipCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(username="owner", password="password")
+        cls.user = User.objects.create_user(username="user", password="password")
+        category = Category.objects.create(name="general")
+        cls.server = Server.objects.create(name="meow", owner=cls.owner, category=category)
+        cls.empty_server = Server.objects.create(name="empty", owner=cls.owner, category=category)
+        cls.server.member.add(cls.owner)
+
+    def setUp(self):
+        membership_cache.invalidate()
+
+    def test_servers_are_loaded_in_one_query(self):
+        with self.assertNumQueries(1):
+            membership_cache.load(self.server.id, self.empty_server.id, 999999)
+
+        with self.assertNumQueries(0):
+            self.assertTrue(membership_cache.is_member(self.server.id, self.owner.id))
+            self.assertFalse(membership_cache.is_member(self.empty_server.id, self.owner.id))
+            self.assertIsNone(membership_cache.is_member(999999, self.owner.id))
+
+    def test_member_changes_update_the_cache(self):
+        membership_cache.load(self.server.id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.server.member.add(self.user)
+            # Not before the change commits
+            self.assertFalse(membership_cache.get(self.server.id, self.user.id))
+        self.assertTrue(membership_cache.get(self.server.id, self.user.id))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.server_set.remove(self.server)
+        self.assertFalse(membership_cache.get(self.server.id, self.user.id))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.server.member.clear()
+        self.assertIs(membership_cache.get(self.server.id, self.owner.id), MISSING)
+
+    def test_rolled_back_changes_never_reach_the_cache(self):
+        membership_cache.load(self.server.id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    self.server.member.add(self.user)
+                    raise DatabaseError("rolled back")
+            except DatabaseError:
+                pass
+
+        self.assertFalse(membership_cache.get(self.server.id, self.user.id))
+
+    def test_membership_endpoints_keep_the_cache_in_sync(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        membership_cache.load(self.server.id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            client.post(f"/api/membership/{self.server.id}/")
+        self.assertEqual(client.get(f"/api/membership/{self.server.id}/is_member/").data, {"is_member": True})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            client.delete(f"/api/membership/{self.server.id}/remove_member/")
+        self.assertEqual(client.get(f"/api/membership/{self.server.id}/is_member/").data, {"is_member": False})
+        self.assertEqual(client.get("/api/membership/999999/is_member/").status_code, 404)
+
+
+# Measures the queries behind the listing cache
+@override_settings(SERVER_LIST_CACHE={"TTL": 0})
+class ServerListViewTests(TestCase):
+    PARAMS = {
+        "category": "general",
+        "qty": "50",
+        "by_user": "true",
+        "with_num_members": "true",
+        "num_members__gte": "1",
+        "ordering": "-num_members",
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(username="owner", password="password")
+        cls.category = Category.objects.create(name="general")
+        cls.server = cls.add_servers(1)[0]
+
+    @classmethod
+    def add_servers(cls, count, channels=3):
+        servers = []
+        for i in range(count):
+            server = Server.objects.create(name=f"server {i}", owner=cls.owner, category=cls.category)
+            server.member.add(cls.owner)
+            Channel.objects.bulk_create(
+                Channel(name=f"channel {j}", topic="", owner=cls.owner, server=server) for j in range(channels)
+            )
+            servers.append(server)
+        return servers
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+
+    def combinations(self):
+        names = list(self.PARAMS) + ["by_serverid"]
+        for size in range(len(names) + 1):
+            for combination in itertools.combinations(names, size):
+                yield {name: self.PARAMS.get(name, str(self.server.id)) for name in combination}
+
+    def test_query_count_does_not_grow_with_servers_or_channels(self):
+        for servers, channels in ((2, 3), (20, 6)):
+            self.add_servers(servers, channels)
+            for params in self.combinations():
+                # The servers with their categories, then every channel of the page
+                with self.subTest(servers=servers, params=params), self.assertNumQueries(2):
+                    response = self.client.get("/api/server/select/", params)
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(response.data)
+
+    def test_channels_and_category_are_nested(self):
+        response = self.client.get("/api/server/select/", {"by_serverid": self.server.id})
+
+        (server,) = response.data
+        self.assertEqual(server["category"], "general")
+        self.assertEqual(
+            [channel["name"] for channel in server["channel_server"]], ["channel 0", "channel 1", "channel 2"]
+        )
+
+    def test_unknown_server_is_rejected_without_an_exists_query(self):
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/server/select/", {"by_serverid": 999999})
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(SERVER_LIST_CACHE={"ALIAS": "default", "TTL": 300})
+class ServerListingCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(username="owner", password="password")
+        cls.user = User.objects.create_user(username="user", password="password")
+        cls.category = Category.objects.create(name="general")
+        cls.server = Server.objects.create(name="meow", owner=cls.owner, category=cls.category)
+        cls.server.member.add(cls.owner)
+        cls.channel = Channel.objects.create(name="lobby", topic="", owner=cls.owner, server=cls.server)
+
+    def setUp(self):
+        get_cache().clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+
+    def servers(self, **params):
+        response = self.client.get("/api/server/select/", params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_repeated_requests_are_served_from_the_cache(self):
+        before = hits.value, misses.value
+        with self.assertNumQueries(2):
+            first = self.servers(qty="5", with_num_members="true")
+        # Parameters are normalized before they become the key
+        with self.assertNumQueries(0):
+            second = self.servers(qty="05", with_num_members="true", unrelated="x")
+
+        self.assertEqual(first, second)
+        self.assertEqual((hits.value - before[0], misses.value - before[1]), (1, 1))
+
+    def test_changes_make_the_listing_stale(self):
+        changes = [
+            lambda: Server.objects.create(name="woof", owner=self.owner, category=self.category),
+            lambda: Channel.objects.create(name="garden", topic="", owner=self.owner, server=self.server),
+            lambda: self.channel.delete(),
+            lambda: Category.objects.create(name="games"),
+            lambda: self.server.member.add(self.user),
+            lambda: self.user.server_set.remove(self.server),
+            lambda: self.server.member.add(self.user),
+            # The cascade removes the member row without `m2m_changed`
+            lambda: self.user.delete(),
+        ]
+        for change in changes:
+            self.servers(with_num_members="true")
+            change()
+            with self.assertNumQueries(2):
+                self.servers(with_num_members="true")
+
+        self.assertEqual(len(self.servers()), 2)
+        self.assertEqual([channel["name"] for channel in self.servers()[0]["channel_server"]], ["garden"])
+
+    def test_by_user_is_cached_per_user(self):
+        self.assertEqual(len(self.servers(by_user="true")), 1)
+
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.servers(by_user="true"), [])
+        self.client.force_authenticate(None)
+        self.assertEqual(self.client.get("/api/server/select/", {"by_user": "true"}).status_code, 401)
+
+    def test_categories_are_cached(self):
+        self.client.get("/api/server/category/")
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                [category["name"] for category in self.client.get("/api/server/category/").data], ["general"]
+            )
+
+        Category.objects.create(name="games")
+        self.assertEqual(len(self.client.get("/api/server/category/").data), 2)
+
+    def test_a_change_made_by_another_worker_makes_the_listing_stale(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        listing = {**settings.CACHES["listing"], "LOCATION": directory.name}
+        with override_settings(
+            CACHES={**settings.CACHES, "listing": listing}, SERVER_LIST_CACHE={"ALIAS": "listing", "TTL": 300}
+        ):
+            self.servers()
+            with self.assertNumQueries(0):
+                self.servers()
+
+            # Another process bumps the version through its own handle on the same files
+            FileBasedCache(directory.name, {}).incr(VERSION_KEY)
+            with self.assertNumQueries(2):
+                self.servers()
+
+
+@override_settings(SERVER_LIST_CACHE={"TTL": 0})
+class MemberCountTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(username="owner", password="password")
+        cls.users = [User.objects.create_user(username=f"user-{i}", password="password") for i in range(3)]
+        category = Category.objects.create(name="general")
+        cls.server = Server.objects.create(name="meow", owner=cls.owner, category=category)
+        cls.small_server = Server.objects.create(name="purr", owner=cls.owner, category=category)
+        cls.server.member.add(cls.owner, *cls.users)
+        cls.small_server.member.add(cls.owner)
+
+    def counts(self):
+        return dict(Server.objects.values_list("name", "member_count"))
+
+    def test_counts_follow_membership_changes(self):
+        self.assertEqual(self.counts(), {"meow": 4, "purr": 1})
+
+        self.server.member.remove(self.users[0], self.users[0])
+        self.small_server.member.remove(self.users[1])
+        self.assertEqual(self.counts(), {"meow": 3, "purr": 1})
+
+        self.users[1].server_set.add(self.small_server)
+        self.assertEqual(self.counts(), {"meow": 3, "purr": 2})
+
+        self.users[1].server_set.clear()
+        self.assertEqual(self.counts(), {"meow": 2, "purr": 1})
+
+        self.users[2].delete()
+        self.assertEqual(self.counts(), {"meow": 1, "purr": 1})
+
+        self.server.member.clear()
+        self.assertEqual(self.counts(), {"meow": 0, "purr": 1})
+
+    def test_membership_endpoints_keep_the_count(self):
+        client = APIClient()
+        client.force_authenticate(self.users[0])
+
+        client.post(f"/api/membership/{self.small_server.id}/")
+        self.assertEqual(self.counts()["purr"], 2)
+        client.delete(f"/api/membership/{self.small_server.id}/remove_member/")
+        self.assertEqual(self.counts()["purr"], 1)
+
+    def test_saving_a_stale_instance_keeps_the_count(self):
+        stale = Server.objects.get(id=self.small_server.id)
+        self.small_server.member.add(self.users[0])
+
+        stale.description = "edited"
+        stale.save()
+        self.assertEqual(self.counts()["purr"], 2)
+
+    def test_reconcile_repairs_drift(self):
+        Server.objects.filter(id=self.server.id).update(member_count=42)
+
+        output = io.StringIO()
+        call_command("reconcile_member_counts", "--dry-run", stdout=output)
+        self.assertIn(f"Server {self.server.id}: member_count 42, 4 members", output.getvalue())
+        self.assertEqual(self.counts()["meow"], 42)
+
+        call_command("reconcile_member_counts", stdout=io.StringIO())
+        self.assertEqual(self.counts(), {"meow": 4, "purr": 1})
+
+    def test_list_filters_and_orders_without_the_member_table(self):
+        client = APIClient()
+        params = {"with_num_members": "true", "ordering": "-num_members"}
+        with CaptureQueriesContext(connection) as queries:
+            largest = client.get("/api/server/select/", params).data
+        self.assertEqual([(server["name"], server["num_members"]) for server in largest], [("meow", 4), ("purr", 1)])
+        self.assertFalse(any("server_server_member" in query["sql"] for query in queries))
+
+        smallest = client.get("/api/server/select/", {"ordering": "num_members"}).data
+        self.assertEqual([server["name"] for server in smallest], ["purr", "meow"])
+        filtered = client.get("/api/server/select/", {"num_members__gte": "2", "num_members__lte": "10"}).data
+        self.assertEqual([server["name"] for server in filtered], ["meow"])
+
+        # Filtering by member no longer narrows the count down to that member
+        client.force_authenticate(self.users[0])
+        mine = client.get("/api/server/select/", {"by_user": "true", "with_num_members": "true"}).data
+        self.assertEqual([server["num_members"] for server in mine], [4])
+
+        self.assertEqual(client.get("/api/server/select/", {"ordering": "name"}).status_code, 400)
+        self.assertEqual(client.get("/api/server/select/", {"num_members__gte": "many"}).status_code, 400)
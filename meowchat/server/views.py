@@ -1,4 +1,4 @@
-from django.db.models import Count
+from django.db.models import F, Prefetch
 from django.shortcuts import get_object_or_404
 from drf_spectacular.utils import extend_schema
 from rest_framework import status, viewsets
@@ -6,14 +6,36 @@ from rest_framework.decorators import action
 from rest_framework.exceptions import AuthenticationFailed, ValidationError
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
-from django.http import JsonResponse
+from django.http import Http404, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 
-from .models import Category, Server
+from .listing_cache import cached_listing
+from .membership import membership_cache
+from .models import Category, Channel, Server
 from .schema import server_list_docs
 from .serializer import CategorySerializer, ServerSerializer
 
+# Values of the server list's `ordering` parameter, ties broken by id
+MEMBER_ORDERINGS = {"num_members": ("member_count", "id"), "-num_members": ("-member_count", "id")}
+
+
+def parse_member_count(request, name):
+    value = request.query_params.get(name)
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValidationError(detail=f"{name} must be a number")
+
+
+def parse_ordering(request):
+    ordering = request.query_params.get("ordering")
+    if ordering and ordering not in MEMBER_ORDERINGS:
+        raise ValidationError(detail=f"ordering must be one of {', '.join(MEMBER_ORDERINGS)}")
+    return ordering or None
+
 
 @csrf_exempt
 @require_http_methods(["GET", "OPTIONS"])
@@ -58,10 +80,10 @@ class ServerMemebershipViewSet(viewsets.ViewSet):
 
     @action(detail=False, methods=["GET"])
     def is_member(self, request, server_id=None):
-        server = get_object_or_404(Server, id=server_id)
-        user = request.user
+        is_member = membership_cache.is_member(server_id, request.user.id)
 
-        is_member = server.member.filter(id=user.id).exists()
+        if is_member is None:
+            raise Http404
 
         return Response({"is_member": is_member})
 
@@ -72,8 +94,11 @@ class CategoryListViewSet(viewsets.ViewSet):
 
     @extend_schema(responses=CategorySerializer)
     def list(self, request):
-        serializer = CategorySerializer(self.queryset, many=True)
-        return Response(serializer.data)
+        return Response(cached_listing("categories", {}, self.serialize_categories))
+
+    def serialize_categories(self):
+        # .all() for a fresh queryset, the class attribute would keep its first results
+        return list(CategorySerializer(self.queryset.all(), many=True).data)
 
 
 class ServerListViewSet(viewsets.ViewSet):
@@ -92,6 +117,11 @@ class ServerListViewSet(viewsets.ViewSet):
         - `by_user`: Filters servers by user ID, only returning servers that the user is a member of.
         - `by_serverid`: Filters servers by server ID.
         - `with_num_members`: Annotates each server with the number of members it has.
+        - `num_members__gte`, `num_members__lte`: Filters servers by their number of members.
+        - `ordering`: `-num_members` for the largest servers first, `num_members` for the smallest.
+
+        Member numbers come from the denormalized `Server.member_count`, so none of these
+        touch the member table.
 
         Args:
         request: A Django Request object containing query parameters.
@@ -117,12 +147,51 @@ class ServerListViewSet(viewsets.ViewSet):
 
             GET /servers/?by_user=true&qty=10
 
+        Responses are cached per normalized set of parameters, see `server.listing_cache`.
         """
+        data = cached_listing("servers", self.listing_params(request), lambda: self.serialize_servers(request))
+        return Response(data)
+
+    def listing_params(self, request):
+        """Returns the parameters a server list depends on, or None when it must not be cached."""
+        params = request.query_params
+        try:
+            qty = int(params["qty"]) if params.get("qty") else None
+            by_serverid = int(params["by_serverid"]) if params.get("by_serverid") else None
+        except ValueError:
+            return None
+        by_user = None
+        if params.get("by_user") == "true":
+            # Rejected by serialize_servers
+            if not request.user.is_authenticated:
+                return None
+            by_user = request.user.id
+        return {
+            "category": params.get("category") or None,
+            "qty": qty,
+            "by_user": by_user,
+            "by_serverid": by_serverid,
+            "with_num_members": params.get("with_num_members") == "true",
+            "num_members__gte": parse_member_count(request, "num_members__gte"),
+            "num_members__lte": parse_member_count(request, "num_members__lte"),
+            "ordering": parse_ordering(request),
+        }
+
+    def serialize_servers(self, request):
         category = request.query_params.get("category")
         qty = request.query_params.get("qty")
         by_user = request.query_params.get("by_user") == "true"
         by_serverid = request.query_params.get("by_serverid")
         with_num_members = request.query_params.get("with_num_members") == "true"
+        min_members = parse_member_count(request, "num_members__gte")
+        max_members = parse_member_count(request, "num_members__lte")
+        ordering = parse_ordering(request)
+
+        # The serializer nests each server's category name and channels: one join and one
+        # prefetch query for the whole page, however many servers and channels it has
+        self.queryset = self.queryset.select_related("category").prefetch_related(
+            Prefetch("channel_server", queryset=Channel.objects.order_by("id"))
+        )
 
         if category:
             self.queryset = self.queryset.filter(category__name=category)
@@ -135,7 +204,16 @@ class ServerListViewSet(viewsets.ViewSet):
                 raise AuthenticationFailed()
 
         if with_num_members:
-            self.queryset = self.queryset.annotate(num_members=Count("member"))
+            self.queryset = self.queryset.annotate(num_members=F("member_count"))
+
+        if min_members is not None:
+            self.queryset = self.queryset.filter(member_count__gte=min_members)
+
+        if max_members is not None:
+            self.queryset = self.queryset.filter(member_count__lte=max_members)
+
+        if ordering:
+            self.queryset = self.queryset.order_by(*MEMBER_ORDERINGS[ordering])
 
         if by_serverid:
             # if not request.user.is_authenticated:
@@ -143,13 +221,16 @@ class ServerListViewSet(viewsets.ViewSet):
 
             try:
                 self.queryset = self.queryset.filter(id=by_serverid)
-                if not self.queryset.exists():
-                    raise ValidationError(detail=f"Server with id {by_serverid} not found")
             except ValueError:
                 raise ValidationError(detail="Server value error")
 
         if qty:
             self.queryset = self.queryset[: int(qty)]
 
-        serializer = ServerSerializer(self.queryset, many=True, context={"num_members": with_num_members})
-        return Response(serializer.data)
+        # Evaluated here so that an unknown by_serverid is found without a separate EXISTS query
+        servers = list(self.queryset)
+        if by_serverid and not servers:
+            raise ValidationError(detail=f"Server with id {by_serverid} not found")
+
+        serializer = ServerSerializer(servers, many=True, context={"num_members": with_num_members})
+        return list(serializer.data)
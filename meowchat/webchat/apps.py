@@ -1,6 +1,15 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class WebchatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'webchat'
+
+    def ready(self):
+        from . import tokens  # noqa: F401 (connects the token cache signals)
+        from .logs import install_tracing_toggle
+        from .search import restore_triggers
+
+        install_tracing_toggle()
+        post_migrate.connect(restore_triggers, sender=self)
@@ -0,0 +1,224 @@
+"""Cold storage for old chat messages.
+
+`archive_messages` moves each conversation's messages older than its server's
+retention out of `webchat_message` into segment files under
+`WEBCHAT_ARCHIVE["DIR"]`. A conversation is always archived from its oldest message
+on, so every cold message has a smaller id than every hot one, and
+`Conversation.archived_through` is the id where the hot table takes over. Readers
+that need older rows than the hot table has continue in the segments.
+
+A segment holds one id range of one conversation and is never modified once written.
+It is a run of zlib compressed MessagePack blocks of `[id, sequence, sender_id,
+content, timestamp_us]` rows, followed by an index of the blocks' id ranges, the
+index's offset and a magic trailer. Readers map the file into memory and decompress
+only the blocks a page touches. `ArchivedSegment` rows catalogue the files by
+conversation and id range.
+
+Sender names are looked up when segments are read, so renames show in old messages
+too. Archived messages leave the full-text search index along with the hot table.
+"""
+
+import bisect
+import mmap
+import os
+import struct
+import zlib
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+import msgpack
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+
+from .models import ArchivedSegment, Conversation, Message
+
+MAGIC = b"MCSEG001"
+TRAILER = struct.Struct("<Q8s")
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def archive_dir():
+    return settings.WEBCHAT_ARCHIVE["DIR"]
+
+
+def retention_for(server_id):
+    """Returns the days a server's messages stay in the hot table, None to keep them there."""
+    overrides = settings.WEBCHAT_SERVER_ARCHIVE_AFTER_DAYS
+    if server_id is not None and int(server_id) in overrides:
+        return overrides[int(server_id)]
+    return settings.WEBCHAT_ARCHIVE["AFTER_DAYS"]
+
+
+def to_microseconds(timestamp):
+    return (timestamp - EPOCH) // timedelta(microseconds=1)
+
+
+def from_microseconds(value):
+    return EPOCH + timedelta(microseconds=value)
+
+
+def write_segment(path, rows, block_size):
+    """Writes `rows`, sorted by id, to a new segment file at `path`."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f"{path}.tmp"
+    index = []
+    with open(temporary, "wb") as segment:
+        segment.write(MAGIC)
+        for start in range(0, len(rows), block_size):
+            block = rows[start : start + block_size]
+            data = zlib.compress(msgpack.packb(block))
+            index.append((block[0][0], block[-1][0], segment.tell(), len(data)))
+            segment.write(data)
+        index_offset = segment.tell()
+        segment.write(msgpack.packb(index))
+        segment.write(TRAILER.pack(index_offset, MAGIC))
+        segment.flush()
+        os.fsync(segment.fileno())
+    # Readers never see a half written file
+    os.replace(temporary, path)
+
+
+class SegmentReader:
+    def __init__(self, path):
+        with open(path, "rb") as segment:
+            self.data = mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ)
+        index_offset, magic = TRAILER.unpack(self.data[-TRAILER.size :])
+        if magic != MAGIC or self.data[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a message segment")
+        self.blocks = msgpack.unpackb(self.data[index_offset : -TRAILER.size])
+        self.last_ids = [block[1] for block in self.blocks]
+
+    def block(self, number):
+        _, _, offset, length = self.blocks[number]
+        return msgpack.unpackb(zlib.decompress(self.data[offset : offset + length]))
+
+    def rows(self, after=None, before=None, reverse=False):
+        """Yields the rows with `after < id < before` in id order, or newest first with `reverse`."""
+        first = 0 if after is None else bisect.bisect_right(self.last_ids, after)
+        last = len(self.blocks) - 1
+        if before is not None:
+            last = min(last, bisect.bisect_left(self.last_ids, before))
+        numbers = range(last, first - 1, -1) if reverse else range(first, last + 1)
+        for number in numbers:
+            rows = self.block(number)
+            for row in reversed(rows) if reverse else rows:
+                if (after is None or row[0] > after) and (before is None or row[0] < before):
+                    yield row
+
+
+def open_segment(path):
+    return _open_segment(os.path.join(archive_dir(), path))
+
+
+@lru_cache(maxsize=256)
+def _open_segment(path):
+    # Segments never change once written, so the mapping can be kept open and shared
+    return SegmentReader(path)
+
+
+def to_messages(conversation_id, rows):
+    """Builds unsaved `Message` instances from segment rows, with their senders in one query."""
+    senders = get_user_model().objects.only("id", "username").in_bulk({row[2] for row in rows})
+    messages = []
+    for message_id, sequence, sender_id, content, timestamp in rows:
+        message = Message(
+            id=message_id,
+            conversation_id=conversation_id,
+            sequence=sequence,
+            content=content,
+            timestamp=from_microseconds(timestamp),
+        )
+        # None when the account is gone, the serializer then reports no sender
+        message.sender = senders.get(sender_id)
+        messages.append(message)
+    return messages
+
+
+def cold_messages(conversation_id, limit, after=None, before=None):
+    """Returns up to `limit` archived messages with `after < id < before`.
+
+    Messages come oldest first from `after`, otherwise newest first from `before`.
+    """
+    segments = ArchivedSegment.objects.filter(conversation_id=conversation_id)
+    if after is not None:
+        segments = segments.filter(last_id__gt=after).order_by("first_id")
+    else:
+        if before is not None:
+            segments = segments.filter(first_id__lt=before)
+        segments = segments.order_by("-first_id")
+
+    rows = []
+    for path in segments.values_list("path", flat=True).iterator():
+        for row in open_segment(path).rows(after=after, before=before, reverse=after is None):
+            rows.append(row)
+            if len(rows) >= limit:
+                return to_messages(conversation_id, rows)
+    return to_messages(conversation_id, rows)
+
+
+def iter_cold_messages(conversation_id, chunk_size):
+    """Yields every archived message of a conversation in id order, in lists of up to `chunk_size`."""
+    paths = (
+        ArchivedSegment.objects.filter(conversation_id=conversation_id)
+        .order_by("first_id")
+        .values_list("path", flat=True)
+    )
+    for path in list(paths):
+        rows = []
+        for row in open_segment(path).rows():
+            rows.append(row)
+            if len(rows) >= chunk_size:
+                yield to_messages(conversation_id, rows)
+                rows = []
+        if rows:
+            yield to_messages(conversation_id, rows)
+
+
+def archive_conversation(conversation, cutoff):
+    """Moves a conversation's messages sent before `cutoff` to segments, returning how many moved.
+
+    Messages are moved oldest first, in segments of `WEBCHAT_ARCHIVE["SEGMENT_MESSAGES"]`.
+    A message sent before the cutoff but after a newer one, e.g. delayed by write-behind,
+    takes the newer ones along so the cold tier stays an id prefix of the conversation.
+    """
+    boundary = (
+        Message.objects.filter(conversation_id=conversation.id, timestamp__lt=cutoff)
+        .order_by("-id")
+        .values_list("id", flat=True)
+        .first()
+    )
+    moved = 0
+    archived_through = conversation.archived_through
+    while boundary is not None and archived_through < boundary:
+        rows = [
+            [message_id, sequence, sender_id, content, to_microseconds(timestamp)]
+            for message_id, sequence, sender_id, content, timestamp in Message.objects.filter(
+                conversation_id=conversation.id, id__gt=archived_through, id__lte=boundary
+            )
+            .order_by("id")
+            .values_list("id", "sequence", "sender_id", "content", "timestamp")[
+                : settings.WEBCHAT_ARCHIVE["SEGMENT_MESSAGES"]
+            ]
+        ]
+        if not rows:
+            break
+        first_id, last_id = rows[0][0], rows[-1][0]
+        path = os.path.join(str(conversation.id), f"{first_id}-{last_id}.seg")
+        write_segment(os.path.join(archive_dir(), path), rows, settings.WEBCHAT_ARCHIVE["BLOCK_MESSAGES"])
+
+        # A crash before this commits leaves an unreferenced file, which the next run overwrites
+        with transaction.atomic():
+            ArchivedSegment.objects.create(
+                conversation_id=conversation.id,
+                first_id=first_id,
+                last_id=last_id,
+                message_count=len(rows),
+                path=path,
+            )
+            Message.objects.filter(conversation_id=conversation.id, id__gte=first_id, id__lte=last_id).delete()
+            Conversation.objects.filter(id=conversation.id).update(archived_through=last_id)
+        archived_through = last_id
+        moved += len(rows)
+    return moved
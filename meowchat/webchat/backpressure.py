@@ -0,0 +1,140 @@
+"""Bounded outbound queues for WebSocket connections.
+
+Consumers do not write to the socket themselves. Everything they send is queued in
+a `SendQueue`, and a writer task on the event loop drains it into the ASGI `send` one
+frame at a time. A client that reads slowly therefore stalls only its own writer task,
+while the consumer keeps taking events off the channel layer. Once the queue holds
+`MAX_FRAMES` frames, the `POLICY` of `WEBCHAT_SEND_QUEUE` decides what happens:
+
+* "drop_oldest": the oldest queued frame is dropped to make room.
+* "resync": every queued frame is dropped and replaced by one `resync_frame`, by
+  default `{"type": "resync"}`, after which the client catches up by reconnecting with `since`.
+* "close": the connection is closed with code `SLOW_CONSUMER_CLOSE_CODE`.
+
+Control messages such as accept and close are never dropped.
+"""
+
+import asyncio
+import json
+import logging
+from collections import deque
+
+from django.conf import settings
+from meowchat.metrics import counter
+
+logger = logging.getLogger(__name__)
+
+SLOW_CONSUMER_CLOSE_CODE = 4008
+POLICIES = ("drop_oldest", "resync", "close")
+RESYNC_FRAME = {"type": "websocket.send", "text": json.dumps({"type": "resync"})}
+
+dropped_frames = counter("webchat_send_queue_dropped_frames_total", "Frames dropped because a client read too slowly")
+resyncs = counter("webchat_send_queue_resyncs_total", "Send queues collapsed into a resync marker")
+evictions = counter("webchat_slow_consumer_evictions_total", "Connections closed for reading too slowly")
+layer_dropped_messages = counter(
+    "webchat_channel_layer_dropped_messages_total", "Channel layer messages dropped because an inbox was full"
+)
+
+
+class SendQueue:
+    def __init__(self, send, max_frames=256, policy="resync"):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown send queue policy {policy!r}, expected one of {', '.join(POLICIES)}")
+        self.max_frames = max_frames
+        self.policy = policy
+        self.closed = False
+        self._send = send
+        self._messages = deque()
+        self._frames = 0
+        self._ready = asyncio.Event()
+        self._writer = None
+        self.resync_frame = RESYNC_FRAME
+
+    def __len__(self):
+        return self._frames
+
+    async def send(self, message):
+        """Queues an ASGI message for the socket, applying the policy when the queue is full."""
+        if self.closed:
+            return
+        if message["type"] == "websocket.send":
+            if self._frames >= self.max_frames:
+                if self.policy == "close":
+                    await self.evict()
+                    return
+                self._make_room()
+            self._frames += 1
+        self._messages.append(message)
+        self._ready.set()
+        if self._writer is None:
+            self._writer = asyncio.get_running_loop().create_task(self._drain())
+
+    async def evict(self):
+        """Drops everything queued and closes the connection as a slow consumer."""
+        evictions.inc()
+        dropped_frames.inc(self._frames)
+        self.close()
+        try:
+            await self._send({"type": "websocket.close", "code": SLOW_CONSUMER_CLOSE_CODE})
+        except Exception:
+            logger.debug("Could not close slow WebSocket consumer", exc_info=True)
+
+    def close(self):
+        """Stops the writer, discarding whatever has not been sent yet."""
+        self.closed = True
+        self._messages.clear()
+        self._frames = 0
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+
+    def _make_room(self):
+        if self.policy == "drop_oldest":
+            self._remove_frames(1)
+            dropped_frames.inc()
+        else:
+            resyncs.inc()
+            dropped_frames.inc(self._frames)
+            self._remove_frames(self._frames)
+            self._messages.append(self.resync_frame)
+            self._frames = 1
+
+    def _remove_frames(self, count):
+        kept = deque()
+        while self._messages and count:
+            message = self._messages.popleft()
+            if message["type"] == "websocket.send":
+                count -= 1
+                self._frames -= 1
+            else:
+                kept.append(message)
+        self._messages.extendleft(reversed(kept))
+
+    async def _drain(self):
+        while True:
+            while not self._messages:
+                self._ready.clear()
+                await self._ready.wait()
+            message = self._messages.popleft()
+            if message["type"] == "websocket.send":
+                self._frames -= 1
+            try:
+                await self._send(message)
+            except Exception:
+                # The socket is gone, the disconnect on its way will end the consumer
+                logger.debug("Dropping WebSocket frames for a closed connection", exc_info=True)
+                self._writer = None
+                self.close()
+                return
+
+
+class SendQueueMixin:
+    """Routes a consumer's outbound messages through a `SendQueue`."""
+
+    async def __call__(self, scope, receive, send):
+        config = settings.WEBCHAT_SEND_QUEUE
+        self.send_queue = SendQueue(send, max_frames=config["MAX_FRAMES"], policy=config["POLICY"])
+        try:
+            await super().__call__(scope, receive, self.send_queue.send)
+        finally:
+            self.send_queue.close()
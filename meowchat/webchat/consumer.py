@@ -1,80 +1,563 @@
+import json
+import logging
+import time
+from urllib.parse import parse_qs
+
 from asgiref.sync import async_to_sync
-from channels.generic.websocket import JsonWebsocketConsumer
-from django.contrib.auth import get_user_model
-from server.models import Server
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer, JsonWebsocketConsumer
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import connection, transaction
+from meowchat.metrics import collector, counter, gauge, histogram
+from server.membership import MISSING, membership_cache, membership_subscriber
 
+from .archive import cold_messages
+from .backpressure import SendQueueMixin
+from .logs import log_event, trace
 from .models import Conversation, Message
+from .persistence import get_message_writer
+from .protocol import FrameError, binary_frame, client_request, pack, select_subprotocol, unpack
+from .ratelimit import message_rate_limiter, rate_limited_frame, rate_limits_for
+from .read_markers import get_read_markers
+from .typing_indicators import schedule_snapshot, typing_tracker
+
+open_sockets = gauge("webchat_open_sockets", "WebSockets joined to a channel", labels=("server_id", "channel_id"))
+messages_received = counter("webchat_messages_received_total", "Chat messages accepted from clients")
+messages_sent = counter("webchat_messages_sent_total", "Chat messages forwarded to sockets")
+handle_seconds = histogram("webchat_message_handle_seconds", "Time from receive_json to the end of group_send")
+save_seconds = histogram("webchat_message_save_seconds", "Time spent saving a chat message, thread hop included")
+group_send_seconds = histogram("webchat_message_group_send_seconds", "Time spent in group_send for a chat message")
+delivery_seconds = histogram(
+    "webchat_message_delivery_seconds", "Time from group_send until a subscriber hands the message to its socket"
+)
+
+
+def channel_layer_queues():
+    """Returns the inbox queues of an in-memory channel layer in this process, if it is one."""
+    channels = getattr(get_channel_layer(), "channels", None)
+    return list(channels.values()) if channels is not None else []
+
+
+collector(
+    "webchat_channel_layer_queued_messages",
+    "Messages waiting in this process's channel layer inboxes",
+    lambda: {(): sum(queue.qsize() for queue in channel_layer_queues())},
+)
+collector(
+    "webchat_channel_layer_max_queue_depth",
+    "Messages waiting in the fullest channel layer inbox of this process",
+    lambda: {(): max((queue.qsize() for queue in channel_layer_queues()), default=0)},
+)
+
+
+def next_sequence(conversation_id):
+    """Allocates the next message sequence number of a conversation.
+
+    A single UPDATE ... RETURNING, so concurrent senders in any worker process get
+    distinct numbers without a gap between them.
+    """
+    table = connection.ops.quote_name(Conversation._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"UPDATE {table} SET last_sequence = last_sequence + 1 WHERE id = %s RETURNING last_sequence",
+            [conversation_id],
+        )
+        return cursor.fetchone()[0]
+
+
+def save_message(channel_id, sender, content, conversation_id=None):
+    """Persists a chat message and returns it with the id of its conversation.
+
+    Passing a known `conversation_id` skips the `get_or_create` lookup, so a consumer
+    only pays for it on the first message it sends. With write-behind enabled the
+    message is queued instead, and the queue is flushed here once it is full; its
+    sequence number then comes from the writer's allocator and is recorded in
+    `Conversation.last_sequence` when the message is saved. Either way the message
+    gets its sequence number before it is returned.
+    """
+    if conversation_id is None:
+        conversation, created = Conversation.objects.get_or_create(channel_id=channel_id)
+        conversation_id = conversation.id
+
+    writer = get_message_writer()
+    if writer is None:
+        # A failed insert rolls its sequence number back, leaving no hole for resuming clients
+        with transaction.atomic():
+            sequence = next_sequence(conversation_id)
+            new_message = Message.objects.create(
+                conversation_id=conversation_id, sender=sender, content=content, sequence=sequence
+            )
+    else:
+        if writer.is_full:
+            writer.flush()
+        sequence = writer.sequences.next_sequence(conversation_id)
+        new_message = writer.write(
+            Message(conversation_id=conversation_id, sender=sender, content=content, sequence=sequence)
+        )
+    return new_message, conversation_id
+
+
+def load_replay(channel_id, since, limit):
+    """Returns what a client that last saw sequence `since` has missed in a channel.
+
+    The result is `(conversation_id, sequence, events)`, where `sequence` is the newest
+    sequence number of the channel and `events` the `chat.message` events after `since`
+    in order. `events` is None when the missed messages cannot be replayed: there are
+    more than `limit` of them, `since` is ahead of the channel, or some of them are not
+    in the database, e.g. still queued for write-behind in another worker. Missed
+    messages that were archived already are read back from the newest segments.
+    """
+    writer = get_message_writer()
+    if writer is not None:
+        # Brings `last_sequence` up to date with this process's messages too
+        writer.flush()
+    conversation = (
+        Conversation.objects.filter(channel_id=channel_id)
+        .values_list("id", "last_sequence", "archived_through")
+        .first()
+    )
+    conversation_id, sequence, archived_through = conversation or (None, 0, 0)
+    missed = sequence - since
+    if missed == 0:
+        return conversation_id, sequence, []
+    if missed < 0 or missed > limit:
+        return conversation_id, sequence, None
+
+    messages = list(
+        Message.objects.filter(conversation_id=conversation_id, sequence__gt=since, sequence__lte=sequence)
+        .select_related("sender")
+        .only("id", "content", "timestamp", "sequence", "sender__username")
+        .order_by("sequence")
+    )
+    if len(messages) < missed and archived_through:
+        # The rest are at the end of the archive. Sequence numbers follow ids only roughly
+        # across workers, so twice as many rows are read as are missing
+        cold = cold_messages(conversation_id, 2 * (missed - len(messages)), before=archived_through + 1)
+        cold = [message for message in cold if since < message.sequence <= sequence]
+        messages = sorted(cold + messages, key=lambda message: message.sequence)
+    if len(messages) != missed:
+        return conversation_id, sequence, None
+    return conversation_id, sequence, [chat_message_event(message, message.sender) for message in messages]
+
+
+def conversation_for(channel_id):
+    return Conversation.objects.filter(channel_id=channel_id).values_list("id", flat=True).first()
+
+
+def valid_sequence(sequence):
+    return isinstance(sequence, int) and not isinstance(sequence, bool) and sequence >= 0
+
+
+def requested_since(scope):
+    """Returns the `since` sequence number from the socket's query string, if any."""
+    values = parse_qs(scope.get("query_string", b"").decode()).get("since")
+    try:
+        return int(values[-1]) if values else None
+    except ValueError:
+        return None
+
 
-User = get_user_model()
+def replay_frame(since, sequence, replayed):
+    """The frame that ends a replay: `replay.done`, or `replay.gap` when history must be refetched."""
+    return {"type": "replay.done" if replayed else "replay.gap", "since": since, "sequence": sequence}
 
 
-class WebChatConsumer(JsonWebsocketConsumer):
+def chat_message_event(message, sender):
+    """Builds the group event for a new message, with the client frame already encoded.
+
+    The frame is serialized once here instead of once per subscriber, and every
+    consumer in the group forwards `text` to its socket unchanged. `sequence` travels
+    next to it so consumers can drop messages they already replayed.
+    """
+    frame = {
+        "type": "chat.message",
+        "new_message": {
+            "id": message.id,
+            "sequence": message.sequence,
+            # None for archived messages whose account is gone
+            "sender": sender and sender.username,
+            "content": message.content,
+            "timestamp": message.timestamp.isoformat(),
+        },
+    }
+    return {"type": "chat.message", "sequence": message.sequence, "text": json.dumps(frame)}
+
+
+def decode_request(subprotocol, text_data, bytes_data):
+    """Decodes a client frame, raising `ValueError` for anything but a well-formed request map."""
+    if bytes_data is not None and subprotocol is not None:
+        return client_request(unpack(bytes_data))
+    if not text_data:
+        raise FrameError("frame without text")
+    return client_request(json.loads(text_data))
+
+
+def observe_message(received, started, saved):
+    """Records the stages of a chat message handled by this process, from `perf_counter` marks."""
+    finished = time.perf_counter()
+    messages_received.inc()
+    save_seconds.observe(saved - started)
+    group_send_seconds.observe(finished - saved)
+    handle_seconds.observe(finished - received)
+
+
+def observe_delivery(event):
+    messages_sent.inc()
+    # Wall clock, the sender may be another worker process
+    if "sent_at" in event:
+        delivery_seconds.observe(max(0.0, time.time() - event["sent_at"]))
+
+
+class ChatConsumerMixin:
+    """Per-socket state, validation and frame building shared by both chat consumers.
+
+    The consumers differ only in how they do I/O: the sync one sends directly and
+    wraps channel-layer calls in `async_to_sync`, the async one awaits them and moves
+    database work to a thread. Everything else lives here.
+    """
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.server_id = None
         self.channel_id = None
+        self.conversation_id = None
+        # Set when a read ack found no conversation for the channel, until a message arrives
+        self.conversation_missing = False
         self.user = None
+        self.subprotocol = None
+        self.replayed_through = None
+        self.rate_limits = None
+        self.rate_bucket = None
 
-    def connect(self):
+    def handshake(self):
+        """Reads the user from the scope and returns the subprotocol to accept."""
         self.user = self.scope["user"]
-        print(f"WebSocket connection attempt - User: {self.user}, Authenticated: {self.user.is_authenticated}")
-        
-        self.accept()
+        trace("ws.connect", user_id=self.user.id, authenticated=self.user.is_authenticated)
+        self.subprotocol = select_subprotocol(self.scope)
+        return self.subprotocol
+
+    def accepted(self):
+        """Returns `(close_code, server_id)`: a close code for anonymous users, else the server to check."""
+        if self.subprotocol is not None:
+            self.send_queue.resync_frame = {"type": "websocket.send", "bytes": pack({"type": "resync"})}
 
         if not self.user.is_authenticated:
-            print("WebSocket: User not authenticated, closing connection with code 4001")
-            self.close(code=4001)
-            return
+            log_event(logging.INFO, "ws.rejected", reason="unauthenticated", code=4001)
+            return 4001, None
 
         self.channel_id = self.scope["url_route"]["kwargs"]["channelId"]
         server_id = self.scope["url_route"]["kwargs"]["serverId"]
-        
-        print(f"WebSocket: Connecting to server {server_id}, channel {self.channel_id}")
+        trace("ws.joining", user_id=self.user.id, server_id=server_id, channel_id=self.channel_id)
+        return None, server_id
+
+    def membership_failed(self, server_id):
+        log_event(logging.ERROR, "ws.error", exc_info=True, user_id=self.user.id, server_id=server_id)
+        return 4000
+
+    def membership_checked(self, server_id, is_member):
+        """Returns the close code for an unknown server, otherwise takes the server for this socket."""
+        if is_member is None:
+            log_event(logging.INFO, "ws.rejected", reason="unknown_server", code=4004, server_id=server_id)
+            return 4004
+
+        self.server_id = server_id
+        self.rate_limits = rate_limits_for(server_id)
+        self.rate_bucket = message_rate_limiter.connection_bucket(self.rate_limits)
+        trace("ws.membership", user_id=self.user.id, server_id=server_id, is_member=is_member)
+        return None
+
+    def joined(self):
+        open_sockets.inc(self.server_id, self.channel_id)
+        log_event(
+            logging.INFO, "ws.connected", user_id=self.user.id, server_id=self.server_id, channel_id=self.channel_id
+        )
+
+    def replay_frames(self, since, replay):
+        """Takes what `load_replay` returned, returning the missed messages' text and the frame ending the replay.
+
+        Replays run after joining the group, live messages wait until it is done and
+        are then deduplicated against what was replayed.
+        """
+        conversation_id, sequence, events = replay
+        self.conversation_id = self.conversation_id or conversation_id
+        self.replayed_through = sequence
+        return [event["text"] for event in events or ()], replay_frame(since, sequence, events is not None)
+
+    def rate_limit_frame(self, content):
+        """Spends a token for a chat message, returning the error frame if it is rejected.
+
+        Spent before any database work, so a flood costs microseconds per frame. Callers
+        check membership first, so frames from non-members cannot spend the channel's
+        tokens.
+        """
+        if content.get("type") in ("typing", "read"):
+            return None
+        rejected = message_rate_limiter.check(
+            self.rate_bucket, self.server_id, self.user.id, self.channel_id, self.rate_limits
+        )
+        return None if rejected is None else rate_limited_frame(*rejected)
+
+    def message_event(self, new_message):
+        """Returns the group event for a message this socket's user just sent."""
+        # Senders have read their own message
+        get_read_markers().mark(self.user.id, self.conversation_id, new_message.sequence)
+        event = chat_message_event(new_message, self.user)
+        event["sent_at"] = time.time()
+        return event
+
+    def needs_conversation(self):
+        # Looked up once per socket, later acks are a dictionary update. A channel without
+        # messages is not looked up again until one is delivered
+        return self.conversation_id is None and not self.conversation_missing
+
+    def found_conversation(self, conversation_id):
+        self.conversation_id = conversation_id
+        self.conversation_missing = conversation_id is None
 
+    def mark_read(self, sequence):
+        if self.conversation_id is not None:
+            get_read_markers().mark(self.user.id, self.conversation_id, sequence)
+
+    def decode(self, text_data, bytes_data):
+        """Returns the request in a client frame, or None after logging why it was dropped."""
         try:
-            self.user = User.objects.get(id=self.user.id)
-            server = Server.objects.get(id=server_id)
-            self.is_member = server.member.filter(id=self.user.id).exists()
-            
-            print(f"WebSocket: User {self.user.username} is member of server {server.name}: {self.is_member}")
-            
-            async_to_sync(self.channel_layer.group_add)(self.channel_id, self.channel_name)
-            print(f"WebSocket: Successfully connected to channel {self.channel_id}")
-            
-        except Server.DoesNotExist:
-            print(f"WebSocket: Server {server_id} not found, closing connection")
-            self.close(code=4004)
-        except Exception as e:
-            print(f"WebSocket: Error during connection: {e}")
-            self.close(code=4000)
+            return decode_request(self.subprotocol, text_data, bytes_data)
+        except ValueError as error:
+            log_event(logging.INFO, "ws.frame.rejected", error=str(error), user_id=self.user.id)
+            return None
 
-    def receive_json(self, content):
-        if not self.is_member:
+    def encoded(self, content):
+        """Returns the `send` arguments for a frame, encoded for the negotiated subprotocol."""
+        if self.subprotocol is None:
+            return {"text_data": json.dumps(content)}
+        return {"bytes_data": pack(content)}
+
+    def encoded_text(self, text):
+        """Returns the `send` arguments for a frame already encoded as JSON text."""
+        if self.subprotocol is None:
+            return {"text_data": text}
+        return {"bytes_data": binary_frame(text)}
+
+    def should_deliver(self, event):
+        self.conversation_missing = False
+        return self.replayed_through is None or event.get("sequence", 0) > self.replayed_through
+
+    def leaving(self):
+        """Returns whether the socket had joined a channel, which the caller then leaves."""
+        if self.server_id is None:
+            return False
+        open_sockets.dec(self.server_id, self.channel_id)
+        return True
+
+
+class WebChatConsumer(SendQueueMixin, ChatConsumerMixin, JsonWebsocketConsumer):
+    def connect(self):
+        self.accept(subprotocol=self.handshake())
+        close_code, server_id = self.accepted()
+        if close_code is None:
+            try:
+                is_member = membership_cache.is_member(server_id, self.user.id)
+            except Exception:
+                close_code = self.membership_failed(server_id)
+            else:
+                close_code = self.membership_checked(server_id, is_member)
+        if close_code is not None:
+            self.close(code=close_code)
             return
 
-        channel_id = self.channel_id
-        sender = self.user
-        message = content["message"]
+        async_to_sync(self.channel_layer.group_add)(self.channel_id, self.channel_name)
+        async_to_sync(membership_subscriber.subscribe)(server_id)
+        self.joined()
 
-        conversation, created = Conversation.objects.get_or_create(channel_id=channel_id)
+        since = requested_since(self.scope)
+        if since is not None:
+            self.replay(since)
 
-        new_message = Message.objects.create(conversation=conversation, sender=sender, content=message)
-
-        async_to_sync(self.channel_layer.group_send)(
-            self.channel_id,
-            {
-                "type": "chat.message",
-                "new_message": {
-                    "id": new_message.id,
-                    "sender": new_message.sender.username,
-                    "content": new_message.content,
-                    "timestamp": new_message.timestamp.isoformat(),
-                },
-            },
+    def replay(self, since):
+        texts, done = self.replay_frames(since, load_replay(self.channel_id, since, settings.WEBCHAT_REPLAY_MAX))
+        for text in texts:
+            self.send_frame(text)
+        self.send_json(done)
+
+    def receive_json(self, content):
+        received = time.perf_counter()
+        if self.server_id is None:
+            return
+        # Checked per message so that revoked members are cut off without reconnecting
+        if not membership_cache.is_member(self.server_id, self.user.id):
+            return
+        rejected = self.rate_limit_frame(content)
+        if rejected is not None:
+            self.send_json(rejected)
+            return
+
+        if content.get("type") == "typing":
+            self.typing()
+            return
+        if content.get("type") == "read":
+            self.read(content.get("sequence"))
+            return
+
+        typing_tracker.stop(self.channel_id, self.user.username)
+        started = time.perf_counter()
+        new_message, self.conversation_id = save_message(
+            self.channel_id, self.user, content["message"], self.conversation_id
         )
+        saved = time.perf_counter()
+        async_to_sync(self.channel_layer.group_send)(self.channel_id, self.message_event(new_message))
+        observe_message(received, started, saved)
+
+    def typing(self):
+        delay = typing_tracker.ping(self.channel_id, self.user.username)
+        if delay is not None:
+            async_to_sync(schedule_snapshot)(self.channel_layer, self.channel_id, typing_tracker, delay)
+
+    def read(self, sequence):
+        if not valid_sequence(sequence):
+            return
+        if self.needs_conversation():
+            self.found_conversation(conversation_for(self.channel_id))
+        self.mark_read(sequence)
+
+    def receive(self, text_data=None, bytes_data=None, **kwargs):
+        content = self.decode(text_data, bytes_data)
+        if content is not None:
+            self.receive_json(content)
+
+    def send_json(self, content, close=False):
+        self.send(**self.encoded(content), close=close)
+
+    def send_frame(self, text):
+        """Sends a frame encoded as JSON text, converted for the negotiated subprotocol."""
+        self.send(**self.encoded_text(text))
+
+    def typing_snapshot(self, event):
+        self.send_frame(event["text"])
 
     def chat_message(self, event):
-        self.send_json(event)
+        if self.should_deliver(event):
+            self.send_frame(event["text"])
+            observe_delivery(event)
 
     def disconnect(self, close_code):
-        async_to_sync(self.channel_layer.group_discard)(self.channel_id, self.channel_name)
+        if self.leaving():
+            async_to_sync(self.channel_layer.group_discard)(self.channel_id, self.channel_name)
+            async_to_sync(membership_subscriber.unsubscribe)(self.server_id)
         super().disconnect(close_code)
+
+
+class AsyncWebChatConsumer(SendQueueMixin, ChatConsumerMixin, AsyncJsonWebsocketConsumer):
+    """Event-loop native variant of `WebChatConsumer`.
+
+    Channel-layer calls are awaited directly and database work is done in one
+    thread hop per message, so an in-flight message no longer pins a worker thread.
+    """
+
+    async def connect(self):
+        await self.accept(subprotocol=self.handshake())
+        close_code, server_id = self.accepted()
+        if close_code is None:
+            try:
+                is_member = await self.check_membership(server_id)
+            except Exception:
+                close_code = self.membership_failed(server_id)
+            else:
+                close_code = self.membership_checked(server_id, is_member)
+        if close_code is not None:
+            await self.close(code=close_code)
+            return
+
+        await self.channel_layer.group_add(self.channel_id, self.channel_name)
+        await membership_subscriber.subscribe(server_id)
+        self.joined()
+
+        since = requested_since(self.scope)
+        if since is not None:
+            await self.replay(since)
+
+    async def replay(self, since):
+        replay = await database_sync_to_async(load_replay)(self.channel_id, since, settings.WEBCHAT_REPLAY_MAX)
+        texts, done = self.replay_frames(since, replay)
+        for text in texts:
+            await self.send_frame(text)
+        await self.send_json(done)
+
+    async def check_membership(self, server_id):
+        is_member = membership_cache.get(server_id, self.user.id)
+        if is_member is MISSING:
+            is_member = await database_sync_to_async(membership_cache.is_member)(server_id, self.user.id)
+        return is_member
+
+    async def receive_json(self, content):
+        received = time.perf_counter()
+        if self.server_id is None:
+            return
+        # Checked per message so that revoked members are cut off without reconnecting
+        if not await self.check_membership(self.server_id):
+            return
+        rejected = self.rate_limit_frame(content)
+        if rejected is not None:
+            await self.send_json(rejected)
+            return
+
+        if content.get("type") == "typing":
+            await self.typing()
+            return
+        if content.get("type") == "read":
+            await self.read(content.get("sequence"))
+            return
+
+        typing_tracker.stop(self.channel_id, self.user.username)
+        started = time.perf_counter()
+        new_message, self.conversation_id = await database_sync_to_async(save_message)(
+            self.channel_id, self.user, content["message"], self.conversation_id
+        )
+        saved = time.perf_counter()
+        await self.channel_layer.group_send(self.channel_id, self.message_event(new_message))
+        observe_message(received, started, saved)
+
+    async def typing(self):
+        delay = typing_tracker.ping(self.channel_id, self.user.username)
+        if delay is not None:
+            await schedule_snapshot(self.channel_layer, self.channel_id, typing_tracker, delay)
+
+    async def read(self, sequence):
+        if not valid_sequence(sequence):
+            return
+        if self.needs_conversation():
+            self.found_conversation(await database_sync_to_async(conversation_for)(self.channel_id))
+        self.mark_read(sequence)
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        content = self.decode(text_data, bytes_data)
+        if content is not None:
+            await self.receive_json(content)
+
+    async def send_json(self, content, close=False):
+        await self.send(**self.encoded(content), close=close)
+
+    async def send_frame(self, text):
+        """Sends a frame encoded as JSON text, converted for the negotiated subprotocol."""
+        await self.send(**self.encoded_text(text))
+
+    async def typing_snapshot(self, event):
+        await self.send_frame(event["text"])
+
+    async def chat_message(self, event):
+        if self.should_deliver(event):
+            await self.send_frame(event["text"])
+            observe_delivery(event)
+
+    async def disconnect(self, close_code):
+        if self.leaving():
+            await self.channel_layer.group_discard(self.channel_id, self.channel_name)
+            await membership_subscriber.unsubscribe(self.server_id)
+        await super().disconnect(close_code)
+
+
+def get_consumer_class():
+    """Returns the consumer selected by the `WEBCHAT_CONSUMER` setting ("async" or "sync")."""
+    if getattr(settings, "WEBCHAT_CONSUMER", "async") == "sync":
+        return WebChatConsumer
+    return AsyncWebChatConsumer
@@ -0,0 +1,255 @@
+"""Channel layer shared by the worker processes of one host, with no broker.
+
+Each process keeps its channels and groups in memory exactly like
+`InMemoryChannelLayer`, and listens on its own Unix domain socket in `socket_dir`.
+Channel names embed the name of the process that owns them, so `send` goes straight
+to that process, while `group_send` is delivered locally and forwarded to every
+other process listening in `socket_dir`, which delivers it to its own members.
+
+Messages cross process boundaries as JSON, so they must be JSON serializable.
+
+A group message for a channel whose inbox already holds `capacity` messages is
+dropped, like `InMemoryChannelLayer` does, but counted in
+`webchat_channel_layer_dropped_messages_total` and logged as a sampled
+`layer.message.dropped` warning. A peer that does not read its socket within
+`send_timeout` seconds is disconnected rather than allowed to stall every group send.
+
+Every process listening in a directory is part of the same mesh, so each deployment
+needs a directory of its own. The default is derived from the project's `BASE_DIR`;
+set `socket_dir` explicitly when one checkout runs several deployments.
+"""
+
+import asyncio
+import atexit
+import hashlib
+import json
+import logging
+import os
+import random
+import string
+import struct
+import tempfile
+import time
+from copy import deepcopy
+
+from channels.layers import InMemoryChannelLayer
+
+from .backpressure import layer_dropped_messages
+from .logs import log_event
+
+logger = logging.getLogger(__name__)
+
+FRAME_HEADER = struct.Struct("!I")
+
+
+def default_socket_dir():
+    """A socket directory private to this project checkout, shared by its worker processes."""
+    from django.conf import settings
+
+    digest = hashlib.sha256(str(settings.BASE_DIR).encode()).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(), f"meowchat-channels-{digest}")
+
+
+def random_name(length=12):
+    return "".join(random.choice(string.ascii_letters) for _ in range(length))
+
+
+class UnixSocketChannelLayer(InMemoryChannelLayer):
+    def __init__(self, socket_dir=None, peer_refresh=1.0, send_timeout=5.0, **kwargs):
+        super().__init__(**kwargs)
+        self.socket_dir = socket_dir or default_socket_dir()
+        self.peer_refresh = peer_refresh
+        self.send_timeout = send_timeout
+        self.node = f"{os.getpid()}-{random_name(6)}"
+        self.socket_path = os.path.join(self.socket_dir, f"{self.node}.sock")
+        self._server = None
+        self._server_loop = None
+        self._loop = None
+        self._writers = {}
+        self._connecting = {}
+        self._peers = []
+        self._peers_expire_at = 0
+        self._next_sweep = 0
+        atexit.register(self._unlink_socket)
+
+    # Channel layer API
+
+    async def new_channel(self, prefix="specific."):
+        await self._listen()
+        return f"{prefix}.{self.node}!{random_name()}"
+
+    async def send(self, channel, message):
+        node = self._channel_node(channel)
+        if node is None or node == self.node:
+            await super().send(channel, message)
+        else:
+            await self._forward(node, {"op": "send", "channel": channel, "message": message})
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        self.require_valid_group_name(group)
+        self._clean_expired()
+        for channel in list(self.groups.get(group, ())):
+            self._put(channel, message)
+        frame = self._encode({"op": "group_send", "group": group, "message": message})
+        await asyncio.gather(*(self._forward(node, frame=frame) for node in self._list_peers()))
+
+    async def flush(self):
+        await super().flush()
+        self._peers_expire_at = 0
+
+    async def close(self):
+        self._close_writers()
+        self._writers = {}
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        self._unlink_socket()
+
+    def _clean_expired(self):
+        # The parent walks every channel and group on each receive and group_send,
+        # which makes fan-out quadratic in the number of sockets; once a second is plenty.
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self._next_sweep = now + 1.0
+            super()._clean_expired()
+
+    # Peer to peer transport
+
+    def _channel_node(self, channel):
+        if "!" not in channel:
+            return None
+        return channel.split("!", 1)[0].rsplit(".", 1)[-1]
+
+    def _bind_to_running_loop(self):
+        # Connections belong to the loop that opened them, and every async_to_sync
+        # call from plain sync code runs on a brand new loop.
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._close_writers()
+            self._loop = loop
+            self._writers = {}
+            self._connecting = {}
+
+    def _close_writers(self):
+        for writer in self._writers.values():
+            if self._loop is not None and self._loop.is_closed():
+                # Its transport can no longer close through the loop, so release the socket
+                # itself instead of leaving it open until the transport is collected
+                sock = getattr(writer.transport, "_sock", None)
+                if sock is not None:
+                    sock.close()
+            else:
+                writer.close()
+
+    async def _listen(self):
+        loop = asyncio.get_running_loop()
+        if self._server is not None and self._server_loop is loop:
+            return
+        os.makedirs(self.socket_dir, mode=0o700, exist_ok=True)
+        self._unlink_socket()
+        self._server = await loop.create_unix_server(lambda: PeerProtocol(self), path=self.socket_path)
+        self._server_loop = loop
+        self._peers_expire_at = 0
+
+    def _unlink_socket(self):
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+    def _list_peers(self):
+        now = time.monotonic()
+        if now >= self._peers_expire_at:
+            try:
+                names = os.listdir(self.socket_dir)
+            except FileNotFoundError:
+                names = []
+            self._peers = [name[:-5] for name in names if name.endswith(".sock") and name[:-5] != self.node]
+            self._peers_expire_at = now + self.peer_refresh
+        return self._peers
+
+    def _encode(self, payload):
+        data = json.dumps(payload, separators=(",", ":")).encode()
+        return FRAME_HEADER.pack(len(data)) + data
+
+    async def _forward(self, node, payload=None, frame=None):
+        self._bind_to_running_loop()
+        if frame is None:
+            frame = self._encode(payload)
+        writer = self._writers.get(node)
+        if writer is None or writer.is_closing():
+            writer = await self._connect(node)
+            if writer is None:
+                return
+        try:
+            writer.write(frame)
+            await asyncio.wait_for(writer.drain(), self.send_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Dropping channel layer peer %s, it has not read for %s seconds", node, self.send_timeout)
+            self._writers.pop(node, None)
+            writer.close()
+        except (ConnectionError, OSError):
+            self._writers.pop(node, None)
+
+    async def _connect(self, node):
+        pending = self._connecting.get(node)
+        if pending is None:
+            pending = self._connecting[node] = asyncio.ensure_future(self._open_connection(node))
+        try:
+            return await asyncio.shield(pending)
+        finally:
+            self._connecting.pop(node, None)
+
+    async def _open_connection(self, node):
+        path = os.path.join(self.socket_dir, f"{node}.sock")
+        try:
+            _, writer = await asyncio.open_unix_connection(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            # Nobody is listening any more, the owning process exited without cleaning up
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            self._peers_expire_at = 0
+            return None
+        except OSError:
+            logger.exception("Could not connect to channel layer peer %s", node)
+            return None
+        self._writers[node] = writer
+        return writer
+
+    def _deliver(self, payload):
+        if payload["op"] == "send":
+            self._put(payload["channel"], payload["message"])
+        elif payload["op"] == "group_send":
+            self._clean_expired()
+            for channel in list(self.groups.get(payload["group"], ())):
+                self._put(channel, payload["message"])
+
+    def _put(self, channel, message):
+        queue = self.channels.setdefault(channel, asyncio.Queue(maxsize=self.get_capacity(channel)))
+        try:
+            queue.put_nowait((time.time() + self.expiry, deepcopy(message)))
+        except asyncio.QueueFull:
+            layer_dropped_messages.inc()
+            log_event(logging.WARNING, "layer.message.dropped", channel=channel, type=message.get("type"))
+
+
+class PeerProtocol(asyncio.Protocol):
+    """Reads length-prefixed JSON frames from another process and delivers them locally."""
+
+    def __init__(self, layer):
+        self.layer = layer
+        self.buffer = bytearray()
+
+    def data_received(self, data):
+        self.buffer += data
+        while len(self.buffer) >= FRAME_HEADER.size:
+            (size,) = FRAME_HEADER.unpack_from(self.buffer)
+            end = FRAME_HEADER.size + size
+            if len(self.buffer) < end:
+                return
+            payload = json.loads(self.buffer[FRAME_HEADER.size : end])
+            del self.buffer[:end]
+            self.layer._deliver(payload)
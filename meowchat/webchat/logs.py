@@ -0,0 +1,185 @@
+"""Structured logging for the WebSocket path.
+
+Events are logged with `log_event(level, "ws.connected", server_id=..., ...)`: a name and
+keyword fields, which nothing formats unless a handler actually emits the record. The
+`LOGGING` setting routes the `webchat.realtime` and `webchat.trace` loggers through:
+
+* `SampleFilter`, which keeps only a fraction of the records of chatty events,
+* `RepeatFilter`, which lets each event through a few times per window and reports how
+  many repeats it held back on the next record that gets through,
+* `QueueingHandler`, which hands records to a background thread instead of writing to
+  the stream on the event loop, and drops them when that thread falls behind,
+* `StructuredFormatter`, which writes one JSON object per record.
+
+Step by step connection tracing goes through `trace()`, which costs one attribute read
+while tracing is off. Tracing starts off unless `WEBCHAT_TRACE_CONNECTIONS` is set and
+is flipped at runtime by sending the worker SIGUSR2, or by calling `set_tracing`.
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import signal
+import threading
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+from meowchat.lifespan import on_shutdown
+from meowchat.metrics import counter
+
+logger = logging.getLogger("webchat.realtime")
+trace_logger = logging.getLogger("webchat.trace")
+
+dropped_records = counter("webchat_log_records_dropped_total", "Log records dropped because the log queue was full")
+
+_tracing = getattr(settings, "WEBCHAT_TRACE_CONNECTIONS", False)
+
+
+class Fields:
+    """Renders event fields as `key=value` pairs, only when a record is formatted."""
+
+    __slots__ = ("fields",)
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __str__(self):
+        return " ".join(f"{key}={value}" for key, value in self.fields.items())
+
+
+def log_event(level, event, exc_info=None, **fields):
+    if logger.isEnabledFor(level):
+        logger.log(level, "%s %s", event, Fields(fields), exc_info=exc_info, extra={"event": event, "fields": fields})
+
+
+def trace(event, **fields):
+    """Logs a connection tracing event, a no-op unless tracing is switched on."""
+    if _tracing:
+        trace_logger.info("%s %s", event, Fields(fields), extra={"event": event, "fields": fields})
+
+
+def tracing_enabled():
+    return _tracing
+
+
+def set_tracing(enabled):
+    global _tracing
+    _tracing = enabled
+    log_event(logging.INFO, "log.tracing", enabled=enabled)
+
+
+def _toggle_tracing(signum, frame):
+    # Only flips the flag, logging from a signal handler can deadlock on the handler's locks
+    global _tracing
+    _tracing = not _tracing
+
+
+def install_tracing_toggle():
+    """Makes SIGUSR2 switch connection tracing on and off in this process."""
+    try:
+        signal.signal(signal.SIGUSR2, _toggle_tracing)
+    except (ValueError, AttributeError):
+        # Not the main thread, or a platform without SIGUSR2
+        pass
+
+
+class SampleFilter(logging.Filter):
+    def __init__(self, rates=None):
+        super().__init__()
+        self.rates = rates or {}
+
+    def filter(self, record):
+        rate = self.rates.get(getattr(record, "event", None))
+        return rate is None or random.random() < rate
+
+
+class RepeatFilter(logging.Filter):
+    def __init__(self, limit=10, window=60.0, clock=time.monotonic):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self.clock = clock
+        self._counts = {}
+        self._next_prune = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.levelno, getattr(record, "event", record.msg))
+        now = self.clock()
+        with self._lock:
+            if now >= self._next_prune:
+                self._prune(now)
+            window_end, count, suppressed = self._counts.get(key, (now + self.window, 0, 0))
+            if now >= window_end:
+                window_end, count = now + self.window, 0
+            if count >= self.limit:
+                self._counts[key] = (window_end, count, suppressed + 1)
+                return False
+            self._counts[key] = (window_end, count + 1, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+    def _prune(self, now):
+        # Keys still holding back repeats are kept, so the count is reported when they come back
+        self._next_prune = now + self.window
+        expired = [key for key, (window_end, _, suppressed) in self._counts.items() if window_end <= now]
+        for key in expired:
+            if not self._counts[key][2]:
+                del self._counts[key]
+
+
+class StructuredFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+        }
+        if hasattr(record, "event"):
+            entry["event"] = record.event
+            entry.update(record.fields)
+        else:
+            entry["message"] = record.getMessage()
+        if getattr(record, "suppressed", 0):
+            entry["suppressed_repeats"] = record.suppressed
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class QueueingHandler(logging.handlers.QueueHandler):
+    """Writes records to a stream from a background thread, dropping them when it falls behind."""
+
+    def __init__(self, stream=None, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.target = logging.StreamHandler(stream)
+        self.listener = logging.handlers.QueueListener(self.queue, self.target)
+        self.listener.start()
+        self._stopped = False
+        atexit.register(self.stop)
+        on_shutdown(self.stop)
+
+    def setFormatter(self, fmt):
+        # Formatting happens on the listener thread
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # The queue never leaves the process, so the record is passed on unformatted
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped_records.inc()
+
+    def stop(self):
+        """Writes out the queued records and stops the background thread."""
+        if not self._stopped:
+            self._stopped = True
+            self.listener.stop()
@@ -0,0 +1,43 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from server.models import Channel
+from webchat.archive import archive_conversation, retention_for
+from webchat.models import Conversation
+
+
+class Command(BaseCommand):
+    help = "Moves messages older than their server's retention from the message table to archive segments."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--vacuum", action="store_true", help="Reclaim the freed space of an SQLite database")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        now = timezone.now()
+        servers = {
+            str(channel_id): server_id for channel_id, server_id in Channel.objects.values_list("id", "server_id")
+        }
+
+        conversations = moved = 0
+        for conversation in Conversation.objects.only("id", "channel_id", "archived_through").iterator():
+            days = retention_for(servers.get(conversation.channel_id))
+            if days is None:
+                continue
+            count = archive_conversation(conversation, now - timedelta(days=days))
+            if count:
+                conversations += 1
+                moved += count
+
+        if options["vacuum"] and connection.vendor == "sqlite":
+            with connection.cursor() as cursor:
+                cursor.execute("VACUUM")
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Archived {moved} messages of {conversations} conversations in {time.perf_counter() - started:.1f} s"
+            )
+        )
@@ -0,0 +1,70 @@
+import asyncio
+import multiprocessing
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from webchat.layers import UnixSocketChannelLayer
+
+
+def run_worker(socket_dir, subscribers, messages, ready, results):
+    async def main():
+        layer = UnixSocketChannelLayer(socket_dir=socket_dir, capacity=messages)
+        channels = [await layer.new_channel() for _ in range(subscribers)]
+        for channel in channels:
+            await layer.group_add("bench", channel)
+        ready.put(True)
+
+        async def drain(channel):
+            for _ in range(messages):
+                await layer.receive(channel)
+
+        await asyncio.gather(*(drain(channel) for channel in channels))
+        results.put((subscribers * messages, time.perf_counter()))
+        await layer.close()
+
+    asyncio.run(main())
+
+
+class Command(BaseCommand):
+    help = "Measures group_send fan-out throughput of the Unix socket channel layer across worker processes."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+        parser.add_argument("--subscribers", type=int, default=400, help="Group members, split across workers")
+        parser.add_argument("--messages", type=int, default=500, help="Messages sent to the group")
+
+    def handle(self, *args, **options):
+        for workers in options["workers"]:
+            deliveries, elapsed = self.run(workers, options["subscribers"] // workers, options["messages"])
+            self.stdout.write(
+                f"{workers} worker(s): {deliveries} deliveries in {elapsed:.2f}s, "
+                f"{deliveries / elapsed:,.0f} deliveries/s, {options['messages'] / elapsed:,.0f} group sends/s"
+            )
+
+    def run(self, workers, subscribers, messages):
+        with tempfile.TemporaryDirectory() as socket_dir:
+            ready, results = multiprocessing.Queue(), multiprocessing.Queue()
+            processes = [
+                multiprocessing.Process(target=run_worker, args=(socket_dir, subscribers, messages, ready, results))
+                for _ in range(workers)
+            ]
+            for process in processes:
+                process.start()
+            for _ in processes:
+                ready.get()
+
+            async def send_all():
+                layer = UnixSocketChannelLayer(socket_dir=socket_dir)
+                for i in range(messages):
+                    await layer.group_send("bench", {"type": "chat.message", "n": i})
+                await layer.close()
+
+            started = time.perf_counter()
+            asyncio.run(send_all())
+            finished = [results.get() for _ in processes]
+            for process in processes:
+                process.join()
+
+        return sum(count for count, _ in finished), max(end for _, end in finished) - started
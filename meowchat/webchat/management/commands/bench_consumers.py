@@ -0,0 +1,95 @@
+import asyncio
+import time
+
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from django.urls import path
+
+from meowchat.benchmark import (
+    UNLIMITED_RATES,
+    ScopeUser,
+    benchmark_database,
+    create_chat_server,
+    percentile,
+    receive_chat_messages,
+)
+from webchat.backpressure import layer_dropped_messages
+from webchat.consumer import AsyncWebChatConsumer, WebChatConsumer
+
+
+class Command(BaseCommand):
+    help = "Compares messages/sec and fan-out latency of the sync and async chat consumers."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=50, help="Sockets connected to the channel")
+        parser.add_argument("--senders", type=int, default=5, help="How many of the clients send messages")
+        parser.add_argument("--messages", type=int, default=40, help="Messages sent by each sender")
+        parser.add_argument(
+            "--idle-timeout", type=float, default=5.0, help="Seconds a receiver waits for a missing message"
+        )
+
+    def handle(self, *args, **options):
+        # Senders go flat out, the default limits would drop most of their messages
+        with benchmark_database(), override_settings(WEBCHAT_RATE_LIMITS=UNLIMITED_RATES):
+            server, members = create_chat_server(options["clients"])
+            for consumer_class in (WebChatConsumer, AsyncWebChatConsumer):
+                result = async_to_sync(self.run_fanout)(consumer_class, server, members, options)
+                self.stdout.write(
+                    f"{consumer_class.__name__:>22}: {result['messages_per_sec']:10.1f} msg/s delivered, "
+                    f"p50 {result['p50_ms']:.2f} ms, p99 {result['p99_ms']:.2f} ms, "
+                    f"{result['delivered']:,} of {result['expected']:,} delivered"
+                )
+                if result["delivered"] < result["expected"]:
+                    self.stdout.write(
+                        f"{'':>22}  {result['expected'] - result['delivered']:,} deliveries missing, "
+                        f"{result['layer_dropped']:,} dropped by full channel layer inboxes"
+                    )
+
+    async def run_fanout(self, consumer_class, server, members, options):
+        router = URLRouter([path("ws/<str:serverId>/<str:channelId>", consumer_class.as_asgi())])
+        channel_id = f"bench-{consumer_class.__name__}"
+        communicators = [
+            WebsocketCommunicator(ScopeUser(router, member), f"ws/{server.id}/{channel_id}") for member in members
+        ]
+        for communicator in communicators:
+            connected, _ = await communicator.connect()
+            assert connected
+
+        total = options["senders"] * options["messages"]
+        latencies = []
+        last_received = []
+
+        async def receive_all(communicator):
+            frames = await receive_chat_messages(communicator, total, options["idle_timeout"])
+            for received, frame in frames:
+                latencies.append(received - float(frame["new_message"]["content"]))
+            if frames:
+                last_received.append(frames[-1][0])
+
+        async def send_all(communicator):
+            for _ in range(options["messages"]):
+                await communicator.send_json_to({"message": repr(time.perf_counter())})
+                await asyncio.sleep(0)
+
+        dropped_before = layer_dropped_messages.value
+        started = time.perf_counter()
+        receivers = [asyncio.ensure_future(receive_all(c)) for c in communicators]
+        await asyncio.gather(*(send_all(c) for c in communicators[: options["senders"]]))
+        await asyncio.gather(*receivers)
+        # Up to the last delivery, not including the time receivers spent waiting for lost ones
+        elapsed = max(last_received, default=started) - started or 1e-9
+
+        for communicator in communicators:
+            await communicator.disconnect()
+
+        return {
+            "messages_per_sec": len(latencies) / elapsed,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "expected": total * len(communicators),
+            "delivered": len(latencies),
+            "layer_dropped": layer_dropped_messages.value - dropped_before,
+        }
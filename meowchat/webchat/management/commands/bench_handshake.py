@@ -0,0 +1,59 @@
+import time
+
+import jwt
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test.utils import CaptureQueriesContext
+
+from meowchat.benchmark import benchmark_database, create_chat_server, percentile
+from webchat.middleware import JWTAuthMiddleWare
+from webchat.tokens import token_cache
+
+
+class Command(BaseCommand):
+    help = "Compares WebSocket handshake authentication time with and without the verified-token cache."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=100, help="Distinct users, each with its own token")
+        parser.add_argument("--handshakes", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            _, members = create_chat_server(options["users"])
+            expires = int(time.time()) + 3600
+            tokens = [
+                jwt.encode({"user_id": member.id, "exp": expires}, settings.SECRET_KEY, "HS256") for member in members
+            ]
+            scopes = [
+                {"type": "websocket", "headers": [(b"cookie", f"access_token={tokens[i % len(tokens)]}".encode())]}
+                for i in range(options["handshakes"])
+            ]
+
+            configured = token_cache.max_entries
+            for label, max_entries in (("without cache", 0), ("with cache", configured or 10000)):
+                token_cache.clear()
+                token_cache.max_entries = max_entries
+                # The coroutine queries from another thread, so capture on this thread's connection object
+                with CaptureQueriesContext(connections[DEFAULT_DB_ALIAS]) as queries:
+                    latencies = async_to_sync(self.run_handshakes)(scopes)
+                self.stdout.write(
+                    f"{label:>13}: p50 {percentile(latencies, 50) * 1e6:.1f} us, "
+                    f"p99 {percentile(latencies, 99) * 1e6:.1f} us, "
+                    f"{len(queries) / len(scopes):.3f} queries per handshake"
+                )
+            token_cache.max_entries = configured
+            token_cache.clear()
+
+    async def run_handshakes(self, scopes):
+        async def app(scope, receive, send):
+            pass
+
+        middleware = JWTAuthMiddleWare(app)
+        latencies = []
+        for scope in scopes:
+            started = time.perf_counter()
+            await middleware(dict(scope), None, None)
+            latencies.append(time.perf_counter() - started)
+        return latencies
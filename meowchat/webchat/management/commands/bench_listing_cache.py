@@ -0,0 +1,104 @@
+import itertools
+import random
+import tempfile
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from meowchat.benchmark import benchmark_database, percentile, seed_dataset
+from server.listing_cache import get_cache, hits, misses
+from server.models import Category, Server
+from server.views import CategoryListViewSet, ServerListViewSet
+
+
+class Command(BaseCommand):
+    help = "Replays a mix of server and category listing requests with and without the listing response cache."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--accounts", type=int, default=2_000)
+        parser.add_argument("--servers", type=int, default=500)
+        parser.add_argument("--users", type=int, default=50, help="Distinct users sending the requests")
+        parser.add_argument("--requests", type=int, default=2_000)
+        parser.add_argument(
+            "--write-every", type=int, default=200, help="Requests between two membership changes, 0 for none"
+        )
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            self.stdout.write("Seeding...")
+            seed_dataset(options["accounts"], options["servers"])
+            requests = self.workload(options)
+            # The shipped file cache, in a directory of its own so a running server's cache is left alone
+            with tempfile.TemporaryDirectory(prefix="meowchat-bench-") as directory:
+                listing = {**settings.CACHES["listing"], "LOCATION": directory}
+                for label, ttl in (("uncached", 0), ("cached", 300)):
+                    with override_settings(
+                        CACHES={**settings.CACHES, "listing": listing},
+                        SERVER_LIST_CACHE={"ALIAS": "listing", "TTL": ttl},
+                    ):
+                        get_cache().clear()
+                        self.run(label, requests, options["write_every"])
+
+    def workload(self, options):
+        rng = random.Random(options["seed"])
+        users = list(get_user_model().objects.order_by("id")[: options["users"]])
+        server_ids = list(Server.objects.values_list("id", flat=True))
+        categories = list(Category.objects.values_list("name", flat=True))
+        servers = ServerListViewSet.as_view({"get": "list"})
+        listing_categories = CategoryListViewSet.as_view({"get": "list"})
+
+        requests = []
+        for _ in range(options["requests"]):
+            user = rng.choice(users)
+            # A dashboard load: the categories, then servers filtered a few popular ways
+            if rng.random() < 0.2:
+                requests.append((listing_categories, {}, user))
+                continue
+            names = ("category", "qty", "by_user", "by_serverid", "with_num_members")
+            chosen = [name for name in names if rng.random() < 0.3]
+            params = {
+                "category": rng.choice(categories[:5]),
+                "qty": "20",
+                "by_user": "true",
+                "by_serverid": str(rng.choice(server_ids[:20])),
+                "with_num_members": "true",
+            }
+            requests.append((servers, {name: params[name] for name in chosen}, user))
+        self.members = list(itertools.product(server_ids[:20], [user.id for user in users]))
+        return requests
+
+    def run(self, label, requests, write_every):
+        factory = APIRequestFactory()
+        rng = random.Random(1)
+        before = hits.value, misses.value
+        latencies = []
+        queries = []
+
+        def count_query(execute, sql, params, many, context):
+            queries.append(None)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count_query):
+            for number, (view, params, user) in enumerate(requests, 1):
+                request = factory.get("/", params)
+                force_authenticate(request, user)
+                started = time.perf_counter()
+                response = view(request)
+                response.render()
+                latencies.append(time.perf_counter() - started)
+                if write_every and number % write_every == 0:
+                    server_id, user_id = rng.choice(self.members)
+                    Server.objects.get(id=server_id).member.add(user_id)
+        served_hits, served_misses = hits.value - before[0], misses.value - before[1]
+        lookups = served_hits + served_misses
+        self.stdout.write(
+            f"{label:>8}: p50 {percentile(latencies, 50) * 1000:.2f} ms, p99 {percentile(latencies, 99) * 1000:.2f} ms, "
+            f"{len(queries) / len(requests):.2f} queries per request, "
+            f"hit ratio {served_hits / lookups if lookups else 0:.1%}"
+        )
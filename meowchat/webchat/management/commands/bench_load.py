@@ -0,0 +1,145 @@
+import asyncio
+import json
+import platform
+import time
+
+import django
+import jwt
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from meowchat.benchmark import (
+    UNLIMITED_RATES,
+    benchmark_database,
+    create_chat_server,
+    percentile,
+    receive_chat_messages,
+    rss_bytes,
+)
+from webchat.backpressure import layer_dropped_messages
+from webchat.tokens import token_cache
+
+
+class Command(BaseCommand):
+    help = (
+        "Drives the full ASGI application in-process with simulated chatters and reports connect rate, "
+        "messages/sec, fan-out latency and memory per connection."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=200, help="Simulated users, one socket each")
+        parser.add_argument("--channels", type=int, default=10, help="Channels the users are spread across")
+        parser.add_argument("--messages", type=int, default=5, help="Messages sent by each user")
+        parser.add_argument("--interval", type=float, default=0.0, help="Seconds each user waits between messages")
+        parser.add_argument("--concurrency", type=int, default=50, help="Handshakes in flight at once")
+        parser.add_argument(
+            "--idle-timeout", type=float, default=5.0, help="Seconds a receiver waits for a missing message"
+        )
+        parser.add_argument("--output", help="Write the results to this JSON file")
+
+    def handle(self, *args, **options):
+        # Imported here so the application is built after settings are configured
+        from meowchat.asgi import application
+
+        with benchmark_database(), override_settings(WEBCHAT_RATE_LIMITS=UNLIMITED_RATES):
+            server, members = create_chat_server(options["users"], name="load")
+            expires = int(time.time()) + 3600
+            clients = [
+                (
+                    f"ws/{server.id}/load-{i % options['channels']}",
+                    jwt.encode({"user_id": member.id, "exp": expires}, settings.SECRET_KEY, "HS256"),
+                )
+                for i, member in enumerate(members)
+            ]
+            token_cache.clear()
+            results = async_to_sync(self.run_load)(application, clients, options)
+
+        report = {
+            "parameters": {key: options[key] for key in ("users", "channels", "messages", "interval", "concurrency")},
+            "environment": {
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "consumer": getattr(settings, "WEBCHAT_CONSUMER", "async"),
+                "channel_layer": settings.CHANNEL_LAYERS["default"]["BACKEND"],
+            },
+            "results": results,
+        }
+        for key, value in results.items():
+            self.stdout.write(f"{key:>28}: {value:,.2f}" if isinstance(value, float) else f"{key:>28}: {value:,}")
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                json.dump(report, output, indent=2)
+                output.write("\n")
+            self.stdout.write(f"Results written to {options['output']}")
+
+    async def run_load(self, application, clients, options):
+        rss_before = rss_bytes()
+        semaphore = asyncio.Semaphore(options["concurrency"])
+        communicators = [
+            WebsocketCommunicator(application, path, headers=[(b"cookie", f"access_token={token}".encode())])
+            for path, token in clients
+        ]
+
+        async def connect(communicator):
+            async with semaphore:
+                connected, _ = await communicator.connect(timeout=60)
+                assert connected
+
+        started = time.perf_counter()
+        await asyncio.gather(*(connect(communicator) for communicator in communicators))
+        connect_elapsed = time.perf_counter() - started
+        # Let every consumer finish joining its channel group before anyone talks
+        await asyncio.gather(*(communicator.receive_nothing(timeout=0.2) for communicator in communicators))
+        rss_connected = rss_bytes()
+
+        listeners = {}
+        for path, _ in clients:
+            listeners[path] = listeners.get(path, 0) + 1
+        latencies = []
+        last_received = []
+
+        async def receive_all(communicator, path):
+            expected = listeners[path] * options["messages"]
+            frames = await receive_chat_messages(communicator, expected, options["idle_timeout"])
+            for received, frame in frames:
+                latencies.append(received - float(frame["new_message"]["content"]))
+            if frames:
+                last_received.append(frames[-1][0])
+
+        async def send_all(communicator):
+            for _ in range(options["messages"]):
+                await communicator.send_json_to({"message": repr(time.perf_counter())})
+                await asyncio.sleep(options["interval"])
+
+        dropped_before = layer_dropped_messages.value
+        started = time.perf_counter()
+        receivers = [asyncio.ensure_future(receive_all(c, path)) for c, (path, _) in zip(communicators, clients)]
+        await asyncio.gather(*(send_all(communicator) for communicator in communicators))
+        await asyncio.gather(*receivers)
+        # Up to the last delivery, not including the time receivers spent waiting for lost ones
+        chat_elapsed = max(last_received, default=started) - started or 1e-9
+
+        for communicator in communicators:
+            await communicator.disconnect()
+
+        sent = len(communicators) * options["messages"]
+        expected = sum(count * count for count in listeners.values()) * options["messages"]
+        return {
+            "connections": len(communicators),
+            "connects_per_sec": len(communicators) / connect_elapsed,
+            "messages_sent": sent,
+            "messages_expected": expected,
+            "messages_delivered": len(latencies),
+            "deliveries_dropped": expected - len(latencies),
+            "layer_dropped_messages": layer_dropped_messages.value - dropped_before,
+            "sent_per_sec": sent / chat_elapsed,
+            "delivered_per_sec": len(latencies) / chat_elapsed,
+            "fanout_p50_ms": percentile(latencies, 50) * 1000,
+            "fanout_p90_ms": percentile(latencies, 90) * 1000,
+            "fanout_p99_ms": percentile(latencies, 99) * 1000,
+            "fanout_max_ms": max(latencies, default=0.0) * 1000,
+            "rss_per_connection_kb": (rss_connected - rss_before) / len(communicators) / 1024,
+        }
@@ -0,0 +1,58 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from meowchat.benchmark import benchmark_database, create_chat_server
+from webchat.models import Conversation
+from webchat.views import MessageViewSet
+
+
+class Command(BaseCommand):
+    help = "Times message history page fetches at different depths of a very large channel."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=1_000_000)
+        parser.add_argument("--repeat", type=int, default=50)
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            server, (user,) = create_chat_server(1)
+            conversation = Conversation.objects.create(channel_id="bench")
+            self.stdout.write(f"Seeding {options['messages']:,} messages...")
+            self.seed(conversation.id, user.id, options["messages"])
+
+            view = MessageViewSet.as_view({"get": "list"})
+            factory = APIRequestFactory()
+            total = options["messages"]
+            cursors = {
+                "newest page": {},
+                "25% deep": {"before": int(total * 0.75)},
+                "50% deep": {"before": total // 2},
+                "oldest page": {"before": 51},
+                "forward from start": {"after": 0},
+            }
+            for label, params in cursors.items():
+                timings = []
+                for _ in range(options["repeat"]):
+                    request = factory.get("/api/messages/", {"channel_id": "bench", **params})
+                    force_authenticate(request, user)
+                    started = time.perf_counter()
+                    response = view(request)
+                    response.render()
+                    timings.append(time.perf_counter() - started)
+                self.stdout.write(f"{label:>20}: median {statistics.median(timings) * 1000:.2f} ms")
+
+    def seed(self, conversation_id, sender_id, count):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                WITH RECURSIVE seq(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM seq WHERE n < %s)
+                INSERT INTO webchat_message (id, conversation_id, sender_id, content, timestamp)
+                SELECT n, %s, %s, 'message ' || n, %s FROM seq
+                """,
+                [count, conversation_id, sender_id, timezone.now()],
+            )
@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from webchat.consumer import observe_delivery, observe_message
+
+
+class Command(BaseCommand):
+    help = "Measures the time the realtime metrics add to each chat message."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=200_000)
+        parser.add_argument("--subscribers", type=int, default=10, help="Sockets each message is delivered to")
+
+    def handle(self, *args, **options):
+        messages = options["messages"]
+        event = {"type": "chat.message", "sent_at": time.time()}
+
+        started = time.perf_counter()
+        for _ in range(messages):
+            mark = time.perf_counter()
+            observe_message(mark, mark, mark)
+        sender = (time.perf_counter() - started) / messages
+
+        started = time.perf_counter()
+        for _ in range(messages):
+            observe_delivery(event)
+        delivery = (time.perf_counter() - started) / messages
+
+        self.stdout.write(f"  sender: {sender * 1e6:.3f} us per message")
+        self.stdout.write(f"delivery: {delivery * 1e6:.3f} us per subscriber")
+        self.stdout.write(
+            f"   total: {(sender + delivery * options['subscribers']) * 1e6:.3f} us per message "
+            f"with {options['subscribers']} subscribers"
+        )
@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from webchat.ratelimit import MessageRateLimiter
+
+
+class Command(BaseCommand):
+    help = "Measures the time the message rate limiter adds to each incoming chat message."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--checks", type=int, default=1_000_000)
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--channels", type=int, default=100)
+
+    def handle(self, *args, **options):
+        checks = options["checks"]
+        unlimited = {scope: {"RATE": 1e9, "BURST": 1e9} for scope in ("CONNECTION", "USER", "CHANNEL")}
+        limited = {scope: {"RATE": 1, "BURST": 1} for scope in ("CONNECTION", "USER", "CHANNEL")}
+
+        for label, limits in (("allowed", unlimited), ("rejected", limited)):
+            limiter = MessageRateLimiter()
+            buckets = [limiter.connection_bucket(limits) for _ in range(options["users"])]
+            senders = [
+                (buckets[i % len(buckets)], i % options["users"], str(i % options["channels"])) for i in range(checks)
+            ]
+
+            started = time.perf_counter()
+            for bucket, user_id, channel_id in senders:
+                limiter.check(bucket, 1, user_id, channel_id, limits)
+            elapsed = time.perf_counter() - started
+
+            self.stdout.write(f"{label:>8}: {elapsed / checks * 1e6:.3f} us per message over {checks:,} checks")
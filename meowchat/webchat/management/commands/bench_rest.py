@@ -0,0 +1,114 @@
+import itertools
+import json
+import statistics
+import time
+import tracemalloc
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from account.views import AccountViewSet
+from meowchat.benchmark import benchmark_database, percentile, seed_dataset
+from server.models import Server
+from server.views import CategoryListViewSet, ServerListViewSet
+from webchat.models import Conversation, Message
+from webchat.views import MessageViewSet
+
+
+class Command(BaseCommand):
+    help = "Seeds a throwaway database and records latency, query count and allocated memory of the REST endpoints."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--accounts", type=int, default=10_000)
+        parser.add_argument("--servers", type=int, default=1_000)
+        parser.add_argument("--messages", type=int, default=200_000)
+        parser.add_argument("--repeat", type=int, default=20, help="Timed requests per case")
+        parser.add_argument("--only", help="Only run the cases whose name contains this text")
+        parser.add_argument("--output", help="Write the results to this JSON file")
+
+    def handle(self, *args, **options):
+        # Every repeat after the first would be a listing cache hit, bench_listing_cache measures those
+        with benchmark_database(), override_settings(SERVER_LIST_CACHE={"TTL": 0}):
+            self.stdout.write("Seeding...")
+            counts = seed_dataset(options["accounts"], options["servers"], messages=options["messages"])
+            results = []
+            for name, view, params in self.cases():
+                if options["only"] and options["only"] not in name:
+                    continue
+                result = self.measure(view, params, options["repeat"])
+                results.append({"case": name, "params": params, **result})
+                self.stdout.write(
+                    f"{name:<60} median {result['median_ms']:8.2f} ms, p95 {result['p95_ms']:8.2f} ms, "
+                    f"{result['queries']:4d} queries, {result['allocated_kb']:9.1f} KiB"
+                )
+
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                json.dump({"dataset": counts, "repeat": options["repeat"], "results": results}, output, indent=2)
+                output.write("\n")
+            self.stdout.write(f"Results written to {options['output']}")
+
+    def cases(self):
+        server = Server.objects.select_related("category").order_by("id").first()
+        self.user = server.owner
+        busiest = Conversation.objects.order_by("-last_sequence").first()
+        message_ids = Message.objects.filter(conversation=busiest).order_by("id").values_list("id", flat=True)
+        middle_id = message_ids[busiest.last_sequence // 2] if busiest.last_sequence else 0
+
+        servers = ServerListViewSet.as_view({"get": "list"})
+        options = {
+            "category": server.category.name,
+            "qty": "10",
+            "by_user": "true",
+            "by_serverid": str(server.id),
+            "with_num_members": "true",
+        }
+        # Every combination of the list filters, from none to all five
+        for size in range(len(options) + 1):
+            for names in itertools.combinations(options, size):
+                label = "+".join(names) or "all"
+                yield f"servers [{label}]", servers, {name: options[name] for name in names}
+
+        yield "categories", CategoryListViewSet.as_view({"get": "list"}), {}
+
+        messages = MessageViewSet.as_view({"get": "list"})
+        yield "messages [newest page]", messages, {"channel_id": busiest.channel_id}
+        yield "messages [middle page]", messages, {"channel_id": busiest.channel_id, "before": middle_id}
+        yield "messages [forward from start]", messages, {"channel_id": busiest.channel_id, "after": 0}
+
+        user_id = get_user_model().objects.order_by("-id").values_list("id", flat=True).first()
+        yield "accounts", AccountViewSet.as_view({"get": "list"}), {"user_id": user_id}
+
+    def request(self, view, params):
+        request = APIRequestFactory().get("/", params)
+        force_authenticate(request, self.user)
+        response = view(request)
+        response.render()
+        return response
+
+    def measure(self, view, params, repeat):
+        with CaptureQueriesContext(connection) as queries:
+            self.request(view, params)
+
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            self.request(view, params)
+            timings.append(time.perf_counter() - started)
+
+        # A separate run, tracing allocations slows everything down
+        tracemalloc.start()
+        self.request(view, params)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        return {
+            "median_ms": statistics.median(timings) * 1000,
+            "p95_ms": percentile(timings, 95) * 1000,
+            "queries": len(queries),
+            "allocated_kb": peak / 1024,
+        }
@@ -0,0 +1,63 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from meowchat.benchmark import benchmark_database, percentile, seed_dataset
+from server.models import Channel, Server
+from webchat.consumer import save_message
+from webchat.search import create_triggers, drop_triggers
+from webchat.views import MessageViewSet
+
+
+class Command(BaseCommand):
+    help = "Measures what the full-text index adds to each message insert, and how fast searches are."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=500_000, help="Messages already in the database")
+        parser.add_argument("--inserts", type=int, default=5000, help="Messages saved with and without the index each")
+        parser.add_argument("--repeat", type=int, default=20, help="Requests per search query")
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            self.stdout.write(f"Seeding {options['messages']:,} messages...")
+            seed_dataset(2000, 100, messages=options["messages"])
+            server = Server.objects.order_by("id").first()
+            user = server.owner
+
+            channel_id = str(Channel.objects.filter(server=server).order_by("id").values_list("id", flat=True)[0])
+
+            # Same path as receive_json: sequence bump and insert in one transaction per message.
+            # Alternating rounds, so both sides see the same table size
+            results = {"without index": [], "with index": []}
+            rounds = 10
+            for turn in range(rounds):
+                for label, toggle in (("without index", drop_triggers), ("with index", create_triggers)):
+                    toggle()
+                    for i in range(options["inserts"] // rounds):
+                        started = time.perf_counter()
+                        save_message(channel_id, user, f"purr number {turn}-{i} with some tuna and a laser")
+                        results[label].append(time.perf_counter() - started)
+            for label, timings in results.items():
+                self.stdout.write(
+                    f"{label:>13}: insert median {statistics.median(timings) * 1e6:.1f} us, "
+                    f"p99 {percentile(timings, 99) * 1e6:.1f} us"
+                )
+            without, with_index = (statistics.median(timings) for timings in results.values())
+            self.stdout.write(
+                f"{'overhead':>13}: {(with_index - without) * 1e6:+.1f} us ({(with_index / without - 1) * 100:+.1f}%) "
+                "per insert"
+            )
+
+            view = MessageViewSet.as_view({"get": "search"})
+            factory = APIRequestFactory()
+            for query in ("tuna", "laser sunbeam", "purr number 3-42", "whisk"):
+                timings = []
+                for _ in range(options["repeat"]):
+                    request = factory.get("/", {"q": query, "server_id": server.id})
+                    force_authenticate(request, user)
+                    started = time.perf_counter()
+                    view(request).render()
+                    timings.append(time.perf_counter() - started)
+                self.stdout.write(f"{query!r:>16}: search median {statistics.median(timings) * 1000:.2f} ms")
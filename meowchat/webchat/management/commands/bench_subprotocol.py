@@ -0,0 +1,56 @@
+import json
+import time
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from webchat.consumer import chat_message_event
+from webchat.protocol import compact, pack, unpack
+
+
+class Command(BaseCommand):
+    help = "Compares bytes per chat message and encode/decode time of the JSON and MessagePack frames."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[20, 200, 2000], help="Message lengths")
+        parser.add_argument("--repeat", type=int, default=20000)
+
+    def handle(self, *args, **options):
+        sender = SimpleNamespace(username="bench-user")
+        words = "the quick brown cat jumps over the lazy dog and meows "
+        for size in options["sizes"]:
+            content = (words * (size // len(words) + 1))[:size]
+            message = SimpleNamespace(id=123456789, sequence=4242, content=content, timestamp=timezone.now())
+            text = chat_message_event(message, sender)["text"]
+            frame = json.loads(text)
+
+            results = {
+                "json": (
+                    len(text.encode()),
+                    self.time(lambda: json.dumps(frame), options["repeat"]),
+                    self.time(lambda: json.loads(text), options["repeat"]),
+                ),
+                "msgpack": self.measure_binary(compact(frame), options["repeat"], compress_min=None),
+                "msgpack+zlib": self.measure_binary(compact(frame), options["repeat"], compress_min=0),
+            }
+
+            self.stdout.write(f"{size}-character message:")
+            for label, (size_bytes, encode, decode) in results.items():
+                self.stdout.write(
+                    f"  {label:>13}: {size_bytes:>5} bytes, encode {encode * 1e6:.2f} us, decode {decode * 1e6:.2f} us"
+                )
+
+    def measure_binary(self, payload, repeat, compress_min):
+        with override_settings(WEBCHAT_MSGPACK_COMPRESS_MIN=compress_min):
+            data = pack(payload)
+            encode = self.time(lambda: pack(payload), repeat)
+        return len(data), encode, self.time(lambda: unpack(data), repeat)
+
+    @staticmethod
+    def time(function, repeat):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            function()
+        return (time.perf_counter() - started) / repeat
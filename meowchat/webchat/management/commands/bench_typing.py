@@ -0,0 +1,59 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+from webchat.consumer import AsyncWebChatConsumer
+from webchat.typing_indicators import typing_tracker
+
+
+class CountingChannelLayer(InMemoryChannelLayer):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.group_sends = 0
+
+    async def group_send(self, group, message):
+        self.group_sends += 1
+
+
+class Command(BaseCommand):
+    help = "Counts the channel layer messages typing indicators cost as the number of typists in a channel grows."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--typists", type=int, nargs="+", default=[1, 10, 100, 1000])
+        parser.add_argument("--seconds", type=float, default=3.0)
+        parser.add_argument("--keystroke-interval", type=float, default=0.1, help="Seconds between a typist's pings")
+        parser.add_argument("--interval", type=float, default=0.5, help="WEBCHAT_TYPING_INTERVAL to use")
+
+    def handle(self, *args, **options):
+        for typists in options["typists"]:
+            pings, group_sends = async_to_sync(self.run)(typists, options)
+            self.stdout.write(
+                f"{typists:>5} typist(s): {pings:>7} pings -> {group_sends:>3} group sends "
+                f"({group_sends / options['seconds']:.1f}/s)"
+            )
+
+    async def run(self, typists, options):
+        layer = CountingChannelLayer()
+        typing_tracker.interval = options["interval"]
+        consumers = []
+        for i in range(typists):
+            consumer = AsyncWebChatConsumer()
+            consumer.channel_layer = layer
+            consumer.channel_id = f"bench-{typists}"
+            consumer.user = SimpleNamespace(username=f"typist-{i}")
+            consumers.append(consumer)
+
+        pings = 0
+        deadline = time.monotonic() + options["seconds"]
+        while time.monotonic() < deadline:
+            for consumer in consumers:
+                await consumer.typing()
+            pings += typists
+            await asyncio.sleep(options["keystroke_interval"])
+        # Let the last scheduled snapshot go out
+        await asyncio.sleep(options["interval"])
+        return pings, layer.group_sends
@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from server.models import Channel, Server
+from webchat.models import Conversation, Message
+
+
+def hot_queries():
+    """The queries run on every message, socket connect or Dashboard load, as the code builds them."""
+    conversation_id = 1
+    user_id = 1
+    return {
+        "conversation by channel_id": Conversation.objects.filter(channel_id="1").values_list("id", flat=True),
+        "newest message page": Message.objects.filter(conversation_id=conversation_id).order_by("-id")[:51],
+        "older message page": Message.objects.filter(conversation_id=conversation_id, id__lt=1000).order_by("-id")[
+            :51
+        ],
+        "newer message page": Message.objects.filter(conversation_id=conversation_id, id__gt=1000).order_by("id")[
+            :51
+        ],
+        "replay since sequence": Message.objects.filter(
+            conversation_id=conversation_id, sequence__gt=1000, sequence__lte=1050
+        ).order_by("sequence"),
+        "servers by category name": Server.objects.filter(category__name="gaming"),
+        "servers of a user": Server.objects.filter(member=user_id),
+        "membership cache load": Server.objects.filter(id__in=[1, 2]).values_list("id", "member"),
+        "membership check": Server(id=1).member.filter(id=user_id),
+        "channels of servers": Channel.objects.filter(server_id__in=[1, 2]),
+    }
+
+
+def full_scans(plan):
+    return [line for line in plan.splitlines() if " SCAN " in f" {line} " and "USING" not in line]
+
+
+class Command(BaseCommand):
+    help = "Prints the EXPLAIN QUERY PLAN of every chat and server hot-path query."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--check", action="store_true", help="Exit with an error if any hot query does a full table scan"
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != "sqlite":
+            raise CommandError("EXPLAIN QUERY PLAN output is only available on SQLite")
+
+        unindexed = []
+        for label, queryset in hot_queries().items():
+            plan = queryset.explain()
+            scans = full_scans(plan)
+            status = self.style.ERROR("FULL SCAN") if scans else self.style.SUCCESS("indexed")
+            self.stdout.write(f"{label} [{status}]")
+            self.stdout.write(f"  {queryset.query}")
+            for line in plan.splitlines():
+                self.stdout.write(f"    {line}")
+            if scans:
+                unindexed.append(label)
+
+        if options["check"] and unindexed:
+            raise CommandError(f"Hot queries without an index: {', '.join(unindexed)}")
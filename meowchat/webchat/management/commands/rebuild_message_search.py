@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from webchat.search import create_triggers, drop_triggers, optimize_index, rebuild_index
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the full-text message search index from the message table."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--optimize", action="store_true", help="Also merge the index into a single b-tree")
+        parser.add_argument("--triggers", action="store_true", help="Also recreate the triggers that keep it in sync")
+
+    def handle(self, *args, **options):
+        if connection.vendor != "sqlite":
+            raise CommandError("Message search needs SQLite's FTS5")
+
+        started = time.perf_counter()
+        with transaction.atomic():
+            if options["triggers"]:
+                drop_triggers()
+                create_triggers()
+            rebuild_index()
+        if options["optimize"]:
+            optimize_index()
+        self.stdout.write(
+            self.style.SUCCESS(f"Rebuilt the message search index in {time.perf_counter() - started:.1f} s")
+        )
@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from meowchat.benchmark import seed_dataset
+
+
+class Command(BaseCommand):
+    help = "Fills the database with a synthetic dataset of accounts, servers, channels and messages."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--accounts", type=int, default=100_000)
+        parser.add_argument("--servers", type=int, default=10_000)
+        parser.add_argument("--categories", type=int, default=50)
+        parser.add_argument("--channels-per-server", type=int, default=5)
+        parser.add_argument("--members-per-server", type=int, default=25)
+        parser.add_argument("--messages", type=int, default=10_000_000)
+        parser.add_argument("--prefix", default="seed", help="Prefix of generated names, change it to seed again")
+        parser.add_argument("--batch-size", type=int, default=10000)
+        parser.add_argument("--seed", type=int, default=0, help="Random seed, the same seed gives the same data")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        with transaction.atomic():
+            counts = seed_dataset(
+                options["accounts"],
+                options["servers"],
+                categories=options["categories"],
+                channels_per_server=options["channels_per_server"],
+                members_per_server=options["members_per_server"],
+                messages=options["messages"],
+                prefix=options["prefix"],
+                batch_size=options["batch_size"],
+                seed=options["seed"],
+                log=lambda text: self.stdout.write(f"Seeding {text}..."),
+            )
+        elapsed = time.perf_counter() - started
+        summary = ", ".join(f"{count:,} {name}" for name, count in counts.items())
+        self.stdout.write(self.style.SUCCESS(f"Seeded {summary} in {elapsed:.1f} s"))
@@ -1,9 +1,14 @@
+import logging
+
 import jwt
 from channels.db import database_sync_to_async
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
 
+from .logs import log_event, trace
+from .tokens import SNAPSHOT_FIELDS, token_cache
+
 
 @database_sync_to_async
 def get_user(scope):
@@ -12,22 +17,27 @@ def get_user(scope):
 
     try:
         if token:
-            print(f"WebSocket: Attempting to decode token: {token[:20]}...")
-            user_id = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])["user_id"]
-            user = model.objects.get(id=user_id)
-            print(f"WebSocket: User authenticated: {user.username}")
+            trace("ws.auth.decode")
+            claims = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
+            user = model.objects.only(*SNAPSHOT_FIELDS).get(id=claims["user_id"])
+            if not user.is_active:
+                # Never cached, so reactivating the account takes effect on the next handshake
+                log_event(logging.INFO, "ws.auth.inactive_user", user_id=user.id)
+                return AnonymousUser()
+            token_cache.put(token, claims, user)
+            trace("ws.auth.ok", user_id=user.id)
             return user
         else:
-            print("WebSocket: No token provided")
+            trace("ws.auth.anonymous")
             return AnonymousUser()
-    except jwt.exceptions.DecodeError as e:
-        print(f"WebSocket: JWT decode error: {e}")
+    except jwt.exceptions.InvalidTokenError as e:
+        log_event(logging.INFO, "ws.auth.invalid_token", error=e)
         return AnonymousUser()
     except model.DoesNotExist:
-        print("WebSocket: User not found")
+        log_event(logging.INFO, "ws.auth.unknown_user")
         return AnonymousUser()
-    except Exception as e:
-        print(f"WebSocket: Unexpected auth error: {e}")
+    except Exception:
+        log_event(logging.ERROR, "ws.auth.error", exc_info=True)
         return AnonymousUser()
 
 
@@ -49,11 +59,17 @@ class JWTAuthMiddleWare:
                         key, value = cookie.split("=", 1)
                         cookies[key] = value
                 access_token = cookies.get("access_token")
-        except Exception as e:
-            print(f"Cookie parsing error: {e}")
+        except Exception:
+            log_event(logging.WARNING, "ws.auth.bad_cookie", exc_info=True)
             access_token = None
 
         scope["token"] = access_token
-        scope["user"] = await get_user(scope)
+        cached = token_cache.get(access_token) if access_token else None
+        if cached is not None and cached[1].is_active:
+            # Verified on an earlier handshake, no thread hop or query needed
+            trace("ws.auth.cached", user_id=cached[1].id)
+            scope["user"] = cached[1]
+        else:
+            scope["user"] = await get_user(scope)
 
         return await self.app(scope, recieve, send)
@@ -0,0 +1,55 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:47
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def merge_duplicate_conversations(apps, schema_editor):
+    """Moves messages of duplicate conversations into the oldest one so channel_id can be unique."""
+    Conversation = apps.get_model("webchat", "Conversation")
+    Message = apps.get_model("webchat", "Message")
+
+    duplicates = (
+        Conversation.objects.values("channel_id")
+        .annotate(first_id=Min("id"), total=Count("id"))
+        .filter(total__gt=1)
+    )
+    for duplicate in duplicates:
+        others = Conversation.objects.filter(channel_id=duplicate["channel_id"]).exclude(id=duplicate["first_id"])
+        Message.objects.filter(conversation__in=others).update(conversation_id=duplicate["first_id"])
+        others.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("webchat", "0002_message_timestamp_default"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_conversations, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="conversation",
+            name="channel_id",
+            field=models.CharField(max_length=255, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                fields=["conversation", "id"], name="message_conversation_id_idx"
+            ),
+        ),
+        migrations.AlterField(
+            model_name="message",
+            name="conversation",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="message",
+                to="webchat.conversation",
+            ),
+        ),
+    ]
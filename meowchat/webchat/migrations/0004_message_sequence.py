@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:53
+
+from django.conf import settings
+from django.db import migrations, models
+
+BATCH_SIZE = 2000
+
+
+def number_existing_messages(apps, schema_editor):
+    """Numbers each conversation's existing messages 1, 2, 3... in id order."""
+    Conversation = apps.get_model("webchat", "Conversation")
+    Message = apps.get_model("webchat", "Message")
+
+    for conversation in Conversation.objects.all():
+        ids = list(Message.objects.filter(conversation=conversation).order_by("id").values_list("id", flat=True))
+        messages = [Message(id=message_id, sequence=i + 1) for i, message_id in enumerate(ids)]
+        Message.objects.bulk_update(messages, ["sequence"], batch_size=BATCH_SIZE)
+        conversation.last_sequence = len(ids)
+        conversation.save(update_fields=["last_sequence"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("webchat", "0003_conversation_unique_message_indexes"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="conversation",
+            name="last_sequence",
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="message",
+            name="sequence",
+            field=models.PositiveBigIntegerField(editable=False, null=True),
+        ),
+        migrations.RunPython(number_existing_messages, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="message",
+            constraint=models.UniqueConstraint(
+                fields=("conversation", "sequence"),
+                name="message_conversation_sequence_uniq",
+            ),
+        ),
+    ]
@@ -0,0 +1,56 @@
+from django.db import migrations
+
+# An external-content FTS5 index over webchat_message.content: the index stores only
+# tokens and reads the text back from the message table by rowid
+CREATE_INDEX = [
+    """
+    CREATE VIRTUAL TABLE webchat_message_fts USING fts5(
+        content, content='webchat_message', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER webchat_message_fts_insert AFTER INSERT ON webchat_message BEGIN
+        INSERT INTO webchat_message_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER webchat_message_fts_delete AFTER DELETE ON webchat_message BEGIN
+        INSERT INTO webchat_message_fts(webchat_message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER webchat_message_fts_update AFTER UPDATE OF content ON webchat_message BEGIN
+        INSERT INTO webchat_message_fts(webchat_message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO webchat_message_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    "INSERT INTO webchat_message_fts(webchat_message_fts) VALUES ('rebuild')",
+]
+
+DROP_INDEX = [
+    "DROP TRIGGER IF EXISTS webchat_message_fts_insert",
+    "DROP TRIGGER IF EXISTS webchat_message_fts_delete",
+    "DROP TRIGGER IF EXISTS webchat_message_fts_update",
+    "DROP TABLE IF EXISTS webchat_message_fts",
+]
+
+
+def run(statements):
+    def apply(apps, schema_editor):
+        # FTS5 is SQLite only, other databases go without message search
+        if schema_editor.connection.vendor == "sqlite":
+            for statement in statements:
+                schema_editor.execute(statement)
+
+    return apply
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("webchat", "0004_message_sequence"),
+    ]
+
+    operations = [
+        migrations.RunPython(run(CREATE_INDEX), run(DROP_INDEX)),
+    ]
@@ -1,14 +1,63 @@
 from django.contrib.auth import get_user_model
 from django.db import models
+from django.utils import timezone
 
 
 class Conversation(models.Model):
-    channel_id = models.CharField(max_length=255)
+    channel_id = models.CharField(max_length=255, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Sequence number of the newest message, bumped atomically for every new message
+    last_sequence = models.PositiveBigIntegerField(default=0)
+    # Id of the newest message moved to an archive segment, older ones are only there
+    archived_through = models.BigIntegerField(default=0)
 
 
 class Message(models.Model):
-    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name="message")
+    # Indexed by the (conversation, id) composite below instead of a single-column index
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name="message", db_index=False)
     sender = models.ForeignKey(get_user_model(), on_delete=models.CASCADE)
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Not auto_now_add, so write-behind rows keep the timestamp they were broadcast with
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
+    # Gapless per-conversation counter that resuming WebSocket clients replay from
+    sequence = models.PositiveBigIntegerField(null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["conversation", "id"], name="message_conversation_id_idx"),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=["conversation", "sequence"], name="message_conversation_sequence_uniq"),
+        ]
+
+
+class ArchivedSegment(models.Model):
+    """A compressed file of a conversation's messages, see `webchat.archive`."""
+
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name="segments", db_index=False)
+    first_id = models.BigIntegerField()
+    last_id = models.BigIntegerField()
+    message_count = models.PositiveIntegerField()
+    # Relative to WEBCHAT_ARCHIVE["DIR"]
+    path = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["conversation", "first_id"], name="segment_conversation_id_idx"),
+        ]
+
+
+class ReadMarker(models.Model):
+    """The newest message a user has read in a conversation, see `webchat.read_markers`."""
+
+    # Indexed by the (user, conversation) unique constraint below
+    user = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, related_name="read_markers", db_index=False)
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name="read_markers")
+    last_read_sequence = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "conversation"], name="read_marker_user_conversation_uniq"),
+        ]
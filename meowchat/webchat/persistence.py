@@ -0,0 +1,353 @@
+"""Write-behind persistence for chat messages.
+
+With `WEBCHAT_WRITE_BEHIND["ENABLED"]` set, a message gets its id and timestamp in
+memory, is broadcast straight away, and is inserted later together with other queued
+messages in one `bulk_create`. This turns one SQLite write transaction per chat line
+into one per batch.
+
+Sequence numbers cannot wait for the insert, since the broadcast carries them. They
+come from a `SequenceAllocator`, a counter file shared by the worker processes of the
+deployment, and `Conversation.last_sequence` catches up when the batch holding them
+is saved. Allocating one is a locked read and write of eight bytes instead of a
+database write per message. The trade-off: `last_sequence`, and with it unread counts
+and resume points, trails the broadcast by up to one flush, and a message dropped for
+conflicting with a saved row leaves a hole in the sequence.
+"""
+
+import atexit
+import fcntl
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import DatabaseError, IntegrityError, close_old_connections, transaction
+from django.db.migrations.recorder import MigrationRecorder
+from django.dispatch import receiver
+from django.utils import timezone
+from meowchat.lifespan import on_shutdown
+from meowchat.metrics import counter
+
+from .models import Conversation, Message
+
+logger = logging.getLogger(__name__)
+
+dropped_messages = counter(
+    "webchat_write_behind_dropped_total", "Queued chat messages dropped because they conflict with saved rows"
+)
+
+ID_EPOCH_MS = 1735689600000  # 2025-01-01T00:00:00Z
+WORKER_ID_BITS = 4
+SEQUENCE_BITS = 8
+MAX_WORKERS = 1 << WORKER_ID_BITS
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+_worker_lock_file = None
+
+
+def deployment_key():
+    """A short digest of this project checkout and database, for naming files its worker processes share."""
+    key = f"{settings.BASE_DIR}:{settings.DATABASES['default']['NAME']}"
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def claim_worker_id():
+    """Returns a worker id that is unique among the processes of this deployment.
+
+    The id comes from `WEBCHAT_WORKER_ID` when set, otherwise from the first of
+    `MAX_WORKERS` lock files this process can hold an exclusive `flock` on. The lock
+    files are named after `deployment_key()`, so deployments on one host each get
+    all the slots.
+    """
+    global _worker_lock_file
+
+    if os.environ.get("WEBCHAT_WORKER_ID"):
+        return int(os.environ["WEBCHAT_WORKER_ID"]) % MAX_WORKERS
+
+    for worker_id in range(MAX_WORKERS):
+        name = f"meowchat-worker-{deployment_key()}-{worker_id}.lock"
+        lock_file = open(os.path.join(tempfile.gettempdir(), name), "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            continue
+        _worker_lock_file = lock_file
+        return worker_id
+
+    raise RuntimeError(f"All {MAX_WORKERS} message id worker slots are taken, set WEBCHAT_WORKER_ID")
+
+
+class MessageIdGenerator:
+    """Time-ordered 53-bit ids: 41 bits of milliseconds, 4 bits of worker id, 8 bits of sequence.
+
+    Ids stay below 2**53 so browsers can handle them as plain numbers, and they sort
+    after every id the table's own autoincrement has handed out so far.
+    """
+
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self._lock = threading.Lock()
+        self._last_ms = 0
+        self._sequence = 0
+
+    def next_id(self):
+        with self._lock:
+            now_ms = max(int(time.time() * 1000), self._last_ms)
+            if now_ms == self._last_ms:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    now_ms += 1
+                    while int(time.time() * 1000) < now_ms:
+                        time.sleep(0.0001)
+            else:
+                self._sequence = 0
+            self._last_ms = now_ms
+            return (
+                ((now_ms - ID_EPOCH_MS) << (WORKER_ID_BITS + SEQUENCE_BITS))
+                | (self.worker_id << SEQUENCE_BITS)
+                | self._sequence
+            )
+
+
+def default_sequence_file():
+    """A counter file private to this project checkout and database, shared by its worker processes."""
+    return os.path.join(tempfile.gettempdir(), f"meowchat-sequences-{deployment_key()}")
+
+
+def database_generation():
+    """Identifies this incarnation of the database: when its first migration was applied, in microseconds.
+
+    Returns 0 when the database has no migration history yet.
+    """
+    try:
+        applied = MigrationRecorder.Migration.objects.order_by("id").values_list("applied", flat=True).first()
+    except DatabaseError:
+        return 0
+    return int(applied.timestamp() * 1_000_000) if applied else 0
+
+
+class SequenceAllocator:
+    """Hands out gapless per-conversation sequence numbers without touching the database.
+
+    The counter of conversation `n` is the 8 bytes at offset `8 * n` of `path`, read and
+    advanced under a lock on just those bytes, so every process using the file draws
+    from the same counters. The first allocation for a conversation in a process raises
+    its counter to `Conversation.last_sequence`, covering messages saved while
+    write-behind was off.
+
+    Conversation ids start at 1, the first 8 bytes hold the `database_generation()` the
+    counters belong to. A file left over from a database that was since recreated is
+    emptied when it is opened, its counters would skip ahead of the new conversations.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or default_sequence_file()
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        # Record locks are held per process, threads take turns on this one first
+        self._lock = threading.Lock()
+        self._seeded = set()
+        self._check_generation(database_generation())
+
+    def _check_generation(self, generation):
+        if not generation:
+            return
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 8, 0)
+        try:
+            recorded = int.from_bytes(os.pread(self._fd, 8, 0).ljust(8, b"\0"), "little")
+            if recorded != generation:
+                os.ftruncate(self._fd, 0)
+                os.pwrite(self._fd, generation.to_bytes(8, "little"), 0)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 8, 0)
+
+    def next_sequence(self, conversation_id):
+        floor = 0
+        if conversation_id not in self._seeded:
+            floor = Conversation.objects.filter(id=conversation_id).values_list("last_sequence", flat=True).first()
+        offset = conversation_id * 8
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 8, offset)
+            try:
+                current = int.from_bytes(os.pread(self._fd, 8, offset).ljust(8, b"\0"), "little")
+                sequence = max(current, floor or 0) + 1
+                os.pwrite(self._fd, sequence.to_bytes(8, "little"), offset)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 8, offset)
+        self._seeded.add(conversation_id)
+        return sequence
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def advance_last_sequences(messages):
+    """Raises `Conversation.last_sequence` to the highest sequence among saved `messages`."""
+    highest = {}
+    for message in messages:
+        if message.sequence is not None:
+            highest[message.conversation_id] = max(message.sequence, highest.get(message.conversation_id, 0))
+    for conversation_id, sequence in highest.items():
+        Conversation.objects.filter(id=conversation_id, last_sequence__lt=sequence).update(last_sequence=sequence)
+
+
+class MessageWriteBehind:
+    """Buffers unsaved `Message` rows and flushes them with `bulk_create`.
+
+    A background thread flushes whenever `batch_size` rows are queued or
+    `flush_interval` seconds have passed. Once `max_pending` rows are waiting,
+    `is_full` turns true and the caller is expected to `flush()` itself before
+    queueing more, which pushes back on senders instead of growing without bound.
+    Each batch is saved together with the `last_sequence` of its conversations.
+    """
+
+    def __init__(self, batch_size=200, flush_interval=0.05, max_pending=5000, id_generator=None, sequences=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.id_generator = id_generator or MessageIdGenerator(claim_worker_id())
+        self.sequences = sequences
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._closed = False
+
+    @property
+    def is_full(self):
+        return len(self._pending) >= self.max_pending
+
+    def write(self, message):
+        """Assigns `message` an id and timestamp, queues it and returns it."""
+        message.id = self.id_generator.next_id()
+        message.timestamp = timezone.now()
+        with self._lock:
+            self._pending.append(message)
+            pending = len(self._pending)
+
+        if pending >= self.batch_size:
+            self._wakeup.set()
+        if self._thread is None and self.flush_interval:
+            self._start()
+        return message
+
+    def pending_messages(self):
+        with self._lock:
+            return list(self._pending)
+
+    def flush(self):
+        """Inserts every queued message, one `bulk_create` per batch.
+
+        Database errors other than integrity errors, e.g. a locked or unreachable
+        database, propagate and leave the unsaved messages queued for the next flush.
+        """
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = self._pending[: self.batch_size]
+                if not batch:
+                    return
+                self._insert(batch)
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self.flush()
+        if self.sequences is not None:
+            self.sequences.close()
+
+    def _insert(self, batch):
+        try:
+            with transaction.atomic():
+                Message.objects.bulk_create(batch)
+                advance_last_sequences(batch)
+        except IntegrityError:
+            logger.warning("Bulk insert of %d messages conflicts with saved rows, retrying one by one", len(batch))
+        else:
+            self._settle(len(batch))
+            return
+
+        for message in batch:
+            try:
+                with transaction.atomic():
+                    Message.objects.bulk_create([message])
+                    advance_last_sequences([message])
+            except IntegrityError:
+                # Retrying cannot help a row that conflicts, unlike one that met a locked database
+                logger.exception("Dropping message %s that conflicts with a saved row", message.id)
+                dropped_messages.inc()
+            self._settle(1)
+
+    def _settle(self, count):
+        """Removes the first `count` queued messages, saved or dropped."""
+        with self._lock:
+            del self._pending[:count]
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="message-write-behind", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Write-behind flush failed")
+            finally:
+                close_old_connections()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_message_writer():
+    """Returns the process-wide write-behind queue, or None when write-behind is disabled."""
+    global _writer
+
+    config = settings.WEBCHAT_WRITE_BEHIND
+    if not config.get("ENABLED"):
+        return None
+
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                writer = MessageWriteBehind(
+                    batch_size=config.get("BATCH_SIZE", 200),
+                    flush_interval=config.get("FLUSH_INTERVAL", 0.05),
+                    max_pending=config.get("MAX_PENDING", 5000),
+                    sequences=SequenceAllocator(config.get("SEQUENCE_FILE")),
+                )
+                atexit.register(writer.close)
+                on_shutdown(writer.close)
+                _writer = writer
+    return _writer
+
+
+def close_message_writer():
+    """Flushes and stops the process-wide write-behind queue, if one was started."""
+    global _writer
+
+    if _writer is not None:
+        _writer.close()
+        _writer = None
+
+
+@receiver(setting_changed)
+def reset_message_writer(setting, **kwargs):
+    if setting == "WEBCHAT_WRITE_BEHIND":
+        close_message_writer()
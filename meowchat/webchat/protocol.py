@@ -0,0 +1,115 @@
+"""The `meowchat.msgpack.v1` WebSocket subprotocol.
+
+Clients that offer this subprotocol exchange binary frames instead of JSON text. Each
+frame is one flag byte followed by a MessagePack payload, zlib compressed when the
+flag is `DEFLATE`. The server compresses payloads of `WEBCHAT_MSGPACK_COMPRESS_MIN`
+bytes or more, and clients may compress theirs too.
+
+The frames sent most often are packed as arrays led by a type code, with timestamps
+as integer milliseconds since the epoch:
+
+* `[CHAT_MESSAGE, id, sequence, sender, content, timestamp_ms]`
+* `[TYPING, users, ttl]`
+
+Every other frame is the same map as its JSON counterpart. JSON stays the default for
+clients that do not ask for the subprotocol.
+
+Client payloads are never decompressed past `WEBCHAT_MSGPACK_MAX_PAYLOAD` bytes, and
+frames that do not decode to a non-empty map are rejected in either format.
+"""
+
+import json
+import zlib
+from datetime import datetime
+from functools import lru_cache
+
+import msgpack
+from django.conf import settings
+
+MSGPACK_SUBPROTOCOL = "meowchat.msgpack.v1"
+
+RAW = 0
+DEFLATE = 1
+
+CHAT_MESSAGE = 1
+TYPING = 2
+
+
+class FrameError(ValueError):
+    """A client frame that cannot be decoded or is not a request."""
+
+
+def select_subprotocol(scope):
+    """Returns the subprotocol to accept for a connection, None for plain JSON."""
+    if MSGPACK_SUBPROTOCOL in scope.get("subprotocols", ()):
+        return MSGPACK_SUBPROTOCOL
+    return None
+
+
+def pack(payload):
+    data = msgpack.packb(payload)
+    compress_min = settings.WEBCHAT_MSGPACK_COMPRESS_MIN
+    if compress_min is not None and len(data) >= compress_min:
+        return bytes((DEFLATE,)) + zlib.compress(data)
+    return bytes((RAW,)) + data
+
+
+def unpack(frame):
+    if not frame:
+        raise FrameError("empty frame")
+    max_payload = settings.WEBCHAT_MSGPACK_MAX_PAYLOAD
+    data = frame[1:]
+    if frame[0] == DEFLATE:
+        decompressor = zlib.decompressobj()
+        try:
+            data = decompressor.decompress(data, max_payload)
+        except zlib.error as error:
+            raise FrameError(f"invalid compressed payload: {error}") from error
+        # Output stopped at the limit with input left over, a compression bomb or just too big
+        if decompressor.unconsumed_tail:
+            raise FrameError(f"payload larger than {max_payload} bytes")
+    elif frame[0] != RAW:
+        raise FrameError(f"unknown frame flag {frame[0]}")
+    elif len(data) > max_payload:
+        raise FrameError(f"payload larger than {max_payload} bytes")
+    try:
+        return msgpack.unpackb(data)
+    except (ValueError, TypeError) as error:
+        raise FrameError(f"invalid MessagePack payload: {error}") from error
+
+
+def client_request(content):
+    """Returns a decoded client frame if it is a non-empty map, raises `FrameError` otherwise."""
+    if not isinstance(content, dict) or not content:
+        raise FrameError("frame is not a non-empty map")
+    if content.get("type") not in ("typing", "read") and not isinstance(content.get("message"), str):
+        raise FrameError("chat frame without a message")
+    return content
+
+
+def compact(frame):
+    """Returns the MessagePack payload for a frame in its JSON form."""
+    if frame["type"] == "chat.message":
+        message = frame["new_message"]
+        timestamp = datetime.fromisoformat(message["timestamp"])
+        return [
+            CHAT_MESSAGE,
+            message["id"],
+            message["sequence"],
+            message["sender"],
+            message["content"],
+            int(timestamp.timestamp() * 1000),
+        ]
+    if frame["type"] == "typing":
+        return [TYPING, frame["users"], frame["ttl"]]
+    return frame
+
+
+@lru_cache(maxsize=1024)
+def binary_frame(text):
+    """Converts an encoded JSON frame to its binary form.
+
+    Group events carry their frame as JSON text, encoded once by the sender. Every
+    subscriber in this process converts the same text, so only the first one pays.
+    """
+    return pack(compact(json.loads(text)))
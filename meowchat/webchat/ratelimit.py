@@ -0,0 +1,117 @@
+"""In-memory token buckets limiting how fast chat messages are accepted.
+
+Every message must get a token from three buckets, checked in this order before any
+database work: the sending connection's, the sending user's on that server, and the
+channel's aggregate. Consumers only check senders that are members of the server, so
+frames from anyone else never reach the shared channel bucket. Rates and burst sizes come from `WEBCHAT_RATE_LIMITS`, with
+per-server overrides in `WEBCHAT_SERVER_RATE_LIMITS`. A message rejected by a later
+bucket has still spent its token in the earlier ones, so a client that keeps sending
+while limited stays limited.
+
+Buckets live in the worker process, a user connected to several workers gets the
+user limit in each of them.
+"""
+
+import time
+
+from django.conf import settings
+from meowchat.metrics import counter
+
+SCOPES = ("CONNECTION", "USER", "CHANNEL")
+
+rate_limited_messages = counter("webchat_rate_limited_messages_total", "Chat messages rejected by a rate limit")
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated_at")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = now
+
+    def take(self, now):
+        """Takes a token, returning 0 on success or the seconds until a token is available."""
+        tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if tokens >= 1:
+            self.tokens = tokens - 1
+            return 0
+        self.tokens = tokens
+        return (1 - tokens) / self.rate
+
+    def is_full(self, now):
+        return self.tokens + (now - self.updated_at) * self.rate >= self.burst
+
+
+def rate_limits_for(server_id):
+    """Returns the `{scope: {"RATE": ..., "BURST": ...}}` limits of a server."""
+    overrides = settings.WEBCHAT_SERVER_RATE_LIMITS.get(int(server_id), {})
+    return {scope: {**settings.WEBCHAT_RATE_LIMITS[scope], **overrides.get(scope, {})} for scope in SCOPES}
+
+
+class MessageRateLimiter:
+    def __init__(self, sweep_interval=60.0, clock=time.monotonic):
+        self.sweep_interval = sweep_interval
+        self.clock = clock
+        self._users = {}
+        self._channels = {}
+        self._next_sweep = 0
+
+    def connection_bucket(self, limits):
+        """Returns a new bucket for a connection, which the consumer owns."""
+        return TokenBucket(limits["CONNECTION"]["RATE"], limits["CONNECTION"]["BURST"], self.clock())
+
+    def check(self, connection_bucket, server_id, user_id, channel_id, limits):
+        """Spends a token for one message.
+
+        Returns None when the message is allowed, otherwise the scope that rejected it
+        and the seconds until it would be allowed.
+        """
+        now = self.clock()
+        if now >= self._next_sweep:
+            self._sweep(now)
+
+        retry_after = connection_bucket.take(now)
+        if retry_after:
+            return self._rejected("connection", retry_after)
+
+        bucket = self._users.get((server_id, user_id))
+        if bucket is None:
+            bucket = self._users[server_id, user_id] = TokenBucket(limits["USER"]["RATE"], limits["USER"]["BURST"], now)
+        retry_after = bucket.take(now)
+        if retry_after:
+            return self._rejected("user", retry_after)
+
+        bucket = self._channels.get(channel_id)
+        if bucket is None:
+            bucket = self._channels[channel_id] = TokenBucket(
+                limits["CHANNEL"]["RATE"], limits["CHANNEL"]["BURST"], now
+            )
+        retry_after = bucket.take(now)
+        if retry_after:
+            return self._rejected("channel", retry_after)
+        return None
+
+    def reset(self):
+        self._users.clear()
+        self._channels.clear()
+
+    def _rejected(self, scope, retry_after):
+        rate_limited_messages.inc()
+        return scope, retry_after
+
+    def _sweep(self, now):
+        # A full bucket behaves exactly like a missing one, so idle users and channels are forgotten
+        self._next_sweep = now + self.sweep_interval
+        for buckets in (self._users, self._channels):
+            for key in [key for key, bucket in buckets.items() if bucket.is_full(now)]:
+                del buckets[key]
+
+
+def rate_limited_frame(scope, retry_after):
+    return {"type": "error", "code": "rate_limited", "limit": scope, "retry_after": round(retry_after, 3)}
+
+
+message_rate_limiter = MessageRateLimiter()
@@ -0,0 +1,184 @@
+"""Read markers and the unread counts derived from them.
+
+A `ReadMarker` holds the sequence number of the newest message a user has read in a
+conversation. Sequence numbers are gapless per conversation, so a channel's unread
+count is `Conversation.last_sequence` minus the marker: `unread_counts` answers for
+every channel of a user in one query over indexed lookups, without counting messages.
+
+Clients acknowledge what they have read over the WebSocket or REST, typically on
+every message that scrolls into view. `ReadMarkerBuffer` keeps only the highest
+acknowledged sequence per user and conversation in memory and upserts them together
+every `WEBCHAT_READ_MARKERS["FLUSH_INTERVAL"]` seconds, so scrolling through a
+thousand messages writes one row once. Markers never move backwards.
+"""
+
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import close_old_connections, connection
+from django.db.models import CharField, FilteredRelation, Q
+from django.db.models.functions import Cast, Coalesce
+from django.dispatch import receiver
+from django.utils import timezone
+from meowchat.lifespan import on_shutdown
+from meowchat.metrics import counter
+
+from server.models import Channel
+
+from .models import Conversation, ReadMarker
+
+logger = logging.getLogger(__name__)
+
+acks = counter("webchat_read_acks_total", "Read acknowledgements received from clients")
+marker_writes = counter("webchat_read_marker_writes_total", "Read marker rows upserted after coalescing")
+
+
+def save_markers(markers):
+    """Upserts `{(user_id, conversation_id): (sequence, updated_at)}`, keeping the higher sequence."""
+    table = connection.ops.quote_name(ReadMarker._meta.db_table)
+    greatest = "MAX" if connection.vendor == "sqlite" else "GREATEST"
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"""
+            INSERT INTO {table} (user_id, conversation_id, last_read_sequence, updated_at)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (user_id, conversation_id) DO UPDATE SET
+                last_read_sequence = {greatest}({table}.last_read_sequence, excluded.last_read_sequence),
+                updated_at = excluded.updated_at
+            """,
+            [
+                (user_id, conversation_id, sequence, connection.ops.adapt_datetimefield_value(updated_at))
+                for (user_id, conversation_id), (sequence, updated_at) in markers.items()
+            ],
+        )
+    marker_writes.inc(len(markers))
+
+
+class ReadMarkerBuffer:
+    """Coalesces read acknowledgements in memory and saves them in one upsert.
+
+    A background thread flushes every `flush_interval` seconds. Without an interval
+    nothing is saved until `flush()` is called.
+    """
+
+    def __init__(self, flush_interval=1.0):
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._closed = False
+
+    def mark(self, user_id, conversation_id, sequence):
+        """Records that a user has read a conversation up to `sequence`."""
+        acks.inc()
+        key = (user_id, conversation_id)
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is not None and pending[0] >= sequence:
+                return
+            self._pending[key] = (sequence, timezone.now())
+
+        if self._thread is None and self.flush_interval:
+            self._start()
+
+    def pending_markers(self):
+        with self._lock:
+            return {key: sequence for key, (sequence, _) in self._pending.items()}
+
+    def flush(self):
+        """Saves every pending marker, returning how many rows were written."""
+        with self._flush_lock:
+            with self._lock:
+                markers, self._pending = self._pending, {}
+            if not markers:
+                return 0
+            try:
+                save_markers(markers)
+            except Exception:
+                # Put them back unless a newer ack came in meanwhile, the next flush retries
+                with self._lock:
+                    for key, marker in markers.items():
+                        if key not in self._pending:
+                            self._pending[key] = marker
+                raise
+            return len(markers)
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self.flush()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="read-marker-flush", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Read marker flush failed")
+            finally:
+                close_old_connections()
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_read_markers():
+    """Returns the process-wide read marker buffer."""
+    global _buffer
+
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                buffer = ReadMarkerBuffer(flush_interval=settings.WEBCHAT_READ_MARKERS.get("FLUSH_INTERVAL", 1.0))
+                atexit.register(buffer.close)
+                on_shutdown(buffer.close)
+                _buffer = buffer
+    return _buffer
+
+
+def close_read_markers():
+    """Flushes and stops the process-wide buffer, the next `get_read_markers` starts a new one."""
+    global _buffer
+
+    if _buffer is not None:
+        _buffer.close()
+        _buffer = None
+
+
+@receiver(setting_changed)
+def reset_read_markers(setting, **kwargs):
+    if setting == "WEBCHAT_READ_MARKERS":
+        close_read_markers()
+
+
+def unread_counts(user):
+    """Returns `(channel_id, last_sequence, read_sequence)` for every channel of the user's servers.
+
+    One query: the user's memberships give the channels, each channel's conversation
+    is found by its unique channel id and the user's marker by the (user, conversation)
+    unique index. Channels without messages have no conversation and are left out.
+    """
+    # Conversations are keyed by the channel id as text
+    channel_keys = Channel.objects.filter(server__member=user).annotate(key=Cast("id", CharField())).values("key")
+    return list(
+        Conversation.objects.filter(channel_id__in=channel_keys)
+        .annotate(marker=FilteredRelation("read_markers", condition=Q(read_markers__user=user)))
+        .annotate(read_sequence=Coalesce("marker__last_read_sequence", 0))
+        .order_by("channel_id")
+        .values_list("channel_id", "last_sequence", "read_sequence")
+    )
@@ -1,16 +1,110 @@
 from drf_spectacular.types import OpenApiTypes
-from drf_spectacular.utils import OpenApiParameter, extend_schema
+from drf_spectacular.utils import OpenApiParameter, extend_schema, inline_serializer
+from rest_framework import serializers
 
-from .serializers import MessageSerializer
+from .serializers import MessageSearchResultSerializer, MessageSerializer, ReadAckSerializer, UnreadCountSerializer
 
 list_message_docs = extend_schema(
-    responses=MessageSerializer(many=True),
+    responses=inline_serializer(
+        name="MessagePage",
+        fields={
+            "results": MessageSerializer(many=True),
+            "before": serializers.IntegerField(allow_null=True),
+            "after": serializers.IntegerField(allow_null=True),
+        },
+    ),
     parameters=[
         OpenApiParameter(
             name="channel_id",
             type=OpenApiTypes.STR,
             location=OpenApiParameter.QUERY,
             description="ID of the channel",
-        )
+        ),
+        OpenApiParameter(
+            name="before",
+            type=OpenApiTypes.INT,
+            location=OpenApiParameter.QUERY,
+            description="Only return messages older than this message id",
+        ),
+        OpenApiParameter(
+            name="after",
+            type=OpenApiTypes.INT,
+            location=OpenApiParameter.QUERY,
+            description="Only return messages newer than this message id",
+        ),
+        OpenApiParameter(
+            name="limit",
+            type=OpenApiTypes.INT,
+            location=OpenApiParameter.QUERY,
+            description="Number of messages to return (capped by the server)",
+        ),
+    ],
+)
+
+export_message_docs = extend_schema(
+    responses={(200, "application/x-ndjson"): OpenApiTypes.STR, (200, "application/gzip"): OpenApiTypes.BINARY},
+    parameters=[
+        OpenApiParameter(
+            name="channel_id",
+            type=OpenApiTypes.STR,
+            location=OpenApiParameter.QUERY,
+            description="ID of the channel",
+        ),
+        OpenApiParameter(
+            name="gzip",
+            type=OpenApiTypes.BOOL,
+            location=OpenApiParameter.QUERY,
+            description="Gzip compress the export",
+        ),
     ],
 )
+
+search_message_docs = extend_schema(
+    responses=inline_serializer(
+        name="MessageSearchPage",
+        fields={
+            "results": MessageSearchResultSerializer(many=True),
+            "next": serializers.CharField(allow_null=True),
+        },
+    ),
+    parameters=[
+        OpenApiParameter(
+            name="q",
+            type=OpenApiTypes.STR,
+            location=OpenApiParameter.QUERY,
+            description="Words to search for, the last one also matches as a prefix",
+        ),
+        OpenApiParameter(
+            name="server_id",
+            type=OpenApiTypes.INT,
+            location=OpenApiParameter.QUERY,
+            description="ID of the server to search",
+        ),
+        OpenApiParameter(
+            name="channel_id",
+            type=OpenApiTypes.STR,
+            location=OpenApiParameter.QUERY,
+            description="Only search this channel of the server",
+        ),
+        OpenApiParameter(
+            name="cursor",
+            type=OpenApiTypes.STR,
+            location=OpenApiParameter.QUERY,
+            description="The `next` value of the previous page",
+        ),
+        OpenApiParameter(
+            name="limit",
+            type=OpenApiTypes.INT,
+            location=OpenApiParameter.QUERY,
+            description="Number of results to return (capped by the server)",
+        ),
+    ],
+)
+
+read_message_docs = extend_schema(request=ReadAckSerializer, responses={202: ReadAckSerializer})
+
+unread_message_docs = extend_schema(
+    responses=inline_serializer(name="UnreadCounts", fields={"results": UnreadCountSerializer(many=True)}),
+)
+
+metrics_docs = extend_schema(responses={(200, "text/plain"): OpenApiTypes.STR})
@@ -0,0 +1,166 @@
+"""Full-text search over chat messages, backed by SQLite FTS5.
+
+`webchat_message_fts` (migration 0005) is an external-content FTS5 table: it holds
+only the token index and reads message text back from `webchat_message` by rowid.
+Triggers on `webchat_message` update it in the same statement as every insert, update
+and delete, so bulk and write-behind inserts are indexed too, and a message is
+searchable as soon as its transaction commits. `rebuild_message_search` rebuilds the
+index from scratch.
+
+The triggers belong to the message table, so a migration that remakes it drops them.
+`restore_triggers` runs after every `migrate` and recreates any that are missing.
+
+Archiving deletes messages from the table, which takes them out of the index too, so
+search only covers messages that have not been archived yet.
+
+Results are ordered by BM25 rank, best first, then by id. A cursor is the rank and id
+of the last result of a page; ranks shift a little as the index grows, so a page
+fetched much later may overlap its predecessor slightly.
+"""
+
+import base64
+import html
+import json
+
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+
+FTS_TABLE = "webchat_message_fts"
+
+# Control characters cannot occur in the HTML-escaped snippet, so they mark matches safely
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+
+SNIPPET_TOKENS = 16
+
+TRIGGERS = {
+    "webchat_message_fts_insert": f"""
+        CREATE TRIGGER webchat_message_fts_insert AFTER INSERT ON webchat_message BEGIN
+            INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.id, new.content);
+        END
+    """,
+    "webchat_message_fts_delete": f"""
+        CREATE TRIGGER webchat_message_fts_delete AFTER DELETE ON webchat_message BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.id, old.content);
+        END
+    """,
+    "webchat_message_fts_update": f"""
+        CREATE TRIGGER webchat_message_fts_update AFTER UPDATE OF content ON webchat_message BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.id, new.content);
+        END
+    """,
+}
+
+
+def match_expression(query):
+    """Turns free text into an FTS5 query that needs every word, the last one as a prefix.
+
+    Each word is quoted, so operators and punctuation typed by users are searched for
+    instead of being parsed. Returns None for a query without words.
+    """
+    terms = ['"{}"'.format(term.replace('"', '""')) for term in query.split()]
+    if not terms:
+        return None
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def highlight(snippet, start="<mark>", end="</mark>"):
+    return html.escape(snippet).replace(MATCH_START, start).replace(MATCH_END, end)
+
+
+def encode_cursor(rank, message_id):
+    return base64.urlsafe_b64encode(json.dumps([rank, message_id]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Returns the `(rank, id)` of a cursor, raising ValueError for anything malformed."""
+    try:
+        rank, message_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError("invalid cursor") from e
+    if not isinstance(rank, (int, float)) or not isinstance(message_id, int):
+        raise ValueError("invalid cursor")
+    return float(rank), message_id
+
+
+def search_messages(expression, conversation_ids, limit, after=None):
+    """Returns up to `limit` `(message_id, rank, snippet)` rows of the given conversations.
+
+    `after` is the `(rank, id)` of the last row of the previous page.
+    """
+    if not conversation_ids:
+        return []
+    placeholders = ", ".join(["%s"] * len(conversation_ids))
+    params = [MATCH_START, MATCH_END, SNIPPET_TOKENS, expression, *conversation_ids]
+    page_filter = ""
+    if after is not None:
+        page_filter = "WHERE rank > %s OR (rank = %s AND id > %s)"
+        params += [after[0], after[0], after[1]]
+    params.append(limit)
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT id, rank, snippet FROM (
+                SELECT message.id AS id,
+                       bm25({FTS_TABLE}) AS rank,
+                       snippet({FTS_TABLE}, 0, %s, %s, '…', %s) AS snippet
+                FROM {FTS_TABLE}
+                JOIN webchat_message AS message ON message.id = {FTS_TABLE}.rowid
+                WHERE {FTS_TABLE} MATCH %s AND message.conversation_id IN ({placeholders})
+            )
+            {page_filter}
+            ORDER BY rank, id
+            LIMIT %s
+            """,
+            params,
+        )
+        return cursor.fetchall()
+
+
+def rebuild_index():
+    """Rebuilds the whole index from the message table."""
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+
+def optimize_index():
+    """Merges the index's b-trees into one, which makes queries faster after many inserts."""
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
+
+
+def drop_triggers():
+    with connection.cursor() as cursor:
+        for name in TRIGGERS:
+            cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+
+def create_triggers():
+    with connection.cursor() as cursor:
+        for statement in TRIGGERS.values():
+            cursor.execute(statement)
+
+
+def restore_triggers(using=DEFAULT_DB_ALIAS, **kwargs):
+    """Recreates missing sync triggers and returns their names, a `post_migrate` receiver.
+
+    Messages written while a trigger was missing are not in the index, so it is rebuilt
+    when any had to be recreated.
+    """
+    database = connections[using]
+    if database.vendor != "sqlite":
+        return []
+    with database.cursor() as cursor:
+        cursor.execute("SELECT name, type FROM sqlite_master WHERE name = %s OR type = 'trigger'", [FTS_TABLE])
+        existing = dict(cursor.fetchall())
+        if FTS_TABLE not in existing:
+            # Migration 0005 has not run yet
+            return []
+        missing = [name for name in TRIGGERS if name not in existing]
+        for name in missing:
+            cursor.execute(TRIGGERS[name])
+        if missing:
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+    return missing
@@ -4,8 +4,31 @@ from .models import Message
 
 
 class MessageSerializer(serializers.ModelSerializer):
-    sender = serializers.StringRelatedField()
+    # Read from the joined sender row, callers select_related("sender") to avoid a query per message
+    sender = serializers.CharField(source="sender.username", read_only=True)
 
     class Meta:
         model = Message
-        fields = ["id", "sender", "content", "timestamp"]
+        fields = ["id", "sequence", "sender", "content", "timestamp"]
+
+
+class MessageSearchResultSerializer(MessageSerializer):
+    channel_id = serializers.CharField(source="conversation.channel_id", read_only=True)
+    # HTML-escaped excerpt with the matched words wrapped in <mark>, set by the search view
+    snippet = serializers.CharField(read_only=True)
+
+    class Meta(MessageSerializer.Meta):
+        fields = MessageSerializer.Meta.fields + ["channel_id", "snippet"]
+
+
+class ReadAckSerializer(serializers.Serializer):
+    channel_id = serializers.CharField()
+    # Sequence number of the newest message the user has read in the channel
+    sequence = serializers.IntegerField(min_value=0)
+
+
+class UnreadCountSerializer(serializers.Serializer):
+    channel_id = serializers.CharField()
+    sequence = serializers.IntegerField(help_text="Sequence number of the channel's newest message")
+    read_sequence = serializers.IntegerField(help_text="Sequence number of the newest message the user has read")
+    unread = serializers.IntegerField()
@@ -1,3 +1,1720 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import io
+import json
+import logging
+import os
+import socket
+import tempfile
+import time
+import tracemalloc
+import warnings
+import zlib
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import jwt
+import msgpack
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.conf import settings
+from django.core import signals
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management import call_command
+from django.core.management.sql import emit_post_migrate_signal
+from django.db import DEFAULT_DB_ALIAS, OperationalError, close_old_connections, connections
+from django.db.migrations.recorder import MigrationRecorder
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import path, reverse
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from meowchat.benchmark import ScopeUser, seed_dataset
+from meowchat.metrics import Histogram, counter, gauge, render_prometheus
+from server.membership import membership_cache, membership_group
+from server.models import Category, Channel, Server
+
+from .archive import cold_messages
+from .backpressure import (
+    SLOW_CONSUMER_CLOSE_CODE,
+    SendQueue,
+    dropped_frames,
+    evictions,
+    layer_dropped_messages,
+    resyncs,
+)
+from .consumer import (
+    AsyncWebChatConsumer,
+    WebChatConsumer,
+    delivery_seconds,
+    load_replay,
+    messages_received,
+    messages_sent,
+    open_sockets,
+    save_seconds,
+)
+from .layers import UnixSocketChannelLayer
+from .logs import (
+    QueueingHandler,
+    RepeatFilter,
+    SampleFilter,
+    StructuredFormatter,
+    dropped_records,
+    log_event,
+    set_tracing,
+    trace,
+    tracing_enabled,
+)
+from .middleware import JWTAuthMiddleWare
+from .models import Conversation, Message, ReadMarker
+from .persistence import (
+    MessageIdGenerator,
+    MessageWriteBehind,
+    SequenceAllocator,
+    dropped_messages,
+    get_message_writer,
+)
+from .protocol import (
+    CHAT_MESSAGE,
+    DEFLATE,
+    MSGPACK_SUBPROTOCOL,
+    RAW,
+    TYPING,
+    FrameError,
+    binary_frame,
+    pack,
+    unpack,
+)
+from .ratelimit import MessageRateLimiter, message_rate_limiter, rate_limits_for
+from .read_markers import ReadMarkerBuffer, close_read_markers, get_read_markers, unread_counts
+from .search import drop_triggers, restore_triggers
+from .tokens import VerifiedTokenCache, token_cache
+from .typing_indicators import TypingTracker
+
+User = get_user_model()
+
+
+# Read acks stay in memory until a test flushes them, and group messages never leave
+# the test process
+@override_settings(
+    WEBCHAT_READ_MARKERS={"FLUSH_INTERVAL": None},
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+)
+class ConsumerTestCase(TestCase):
+    consumer_class = AsyncWebChatConsumer
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(username="owner", password="password")
+        cls.outsider = User.objects.create_user(username="outsider", password="password")
+        cls.category = Category.objects.create(name="general")
+        cls.server = Server.objects.create(name="meow", owner=cls.owner, category=cls.category)
+        cls.server.member.add(cls.owner)
+
+    def setUp(self):
+        membership_cache.invalidate()
+        message_rate_limiter.reset()
+        self.addCleanup(get_read_markers().flush)
+
+    def communicator(self, user, server_id=None, channel_id="1", since=None, stalled=False, subprotocols=None):
+        router = URLRouter([path("ws/<str:serverId>/<str:channelId>", self.consumer_class.as_asgi())])
+        url = f"ws/{server_id or self.server.id}/{channel_id}"
+        if since is not None:
+            url += f"?since={since}"
+        application = ScopeUser(router, user)
+        return WebsocketCommunicator(
+            StalledReader(application) if stalled else application, url, subprotocols=subprotocols
+        )
+
+
+class StalledReader:
+    """Wraps an ASGI application whose client never reads: every frame sent to it blocks."""
+
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope, receive, send):
+        async def stalled_send(message):
+            if message["type"] == "websocket.send":
+                await asyncio.Event().wait()
+            await send(message)
+
+        await self.application(scope, receive, stalled_send)
+
+
+class ConsumerTestMixin:
+    async def test_member_message_is_saved_and_broadcast(self):
+        sender = self.communicator(self.owner)
+        listener = self.communicator(self.outsider)
+        self.assertTrue((await sender.connect())[0])
+        self.assertTrue((await listener.connect())[0])
+
+        await sender.send_json_to({"message": "hello"})
+        event = await listener.receive_json_from()
+
+        self.assertEqual(event["type"], "chat.message")
+        self.assertEqual(event["new_message"]["sender"], "owner")
+        self.assertEqual(event["new_message"]["content"], "hello")
+        self.assertEqual(await Message.objects.filter(content="hello").acount(), 1)
+        await sender.disconnect()
+        await listener.disconnect()
+
+    async def test_read_acks_move_the_read_marker(self):
+        reader = await database_sync_to_async(User.objects.create_user)(username="reader", password="password")
+        await database_sync_to_async(self.server.member.add)(reader)
+        sender = self.communicator(self.owner, channel_id="marked")
+        listener = self.communicator(reader, channel_id="marked")
+        for communicator in (sender, listener):
+            await communicator.connect()
+            await communicator.receive_nothing()
+
+        for content in ("one", "two", "three"):
+            await sender.send_json_to({"message": content})
+            await sender.receive_json_from()
+            await listener.receive_json_from()
+        await listener.send_json_to({"type": "read", "sequence": 2})
+        await listener.send_json_to({"type": "read", "sequence": "three"})
+        await listener.receive_nothing()
+        await sender.disconnect()
+        await listener.disconnect()
+
+        # Senders have read their own messages
+        await database_sync_to_async(get_read_markers().flush)()
+        markers = ReadMarker.objects.values_list("user__username", "last_read_sequence")
+        self.assertEqual(dict([marker async for marker in markers]), {"owner": 3, "reader": 2})
+
+    async def test_sockets_and_messages_show_up_in_the_metrics(self):
+        key = (str(self.server.id), "metered")
+        before = messages_received.value, messages_sent.value, save_seconds.count, delivery_seconds.count
+        sender = self.communicator(self.owner, channel_id="metered")
+        listener = self.communicator(self.outsider, channel_id="metered")
+        for communicator in (sender, listener):
+            await communicator.connect()
+            await communicator.receive_nothing()
+        self.assertEqual(open_sockets.values[key], 2)
+
+        await sender.send_json_to({"message": "counted"})
+        await sender.receive_json_from()
+        await listener.receive_json_from()
+        await listener.receive_nothing()
+
+        after = messages_received.value, messages_sent.value, save_seconds.count, delivery_seconds.count
+        self.assertEqual([b - a for a, b in zip(before, after)], [1, 2, 1, 2])
+        await sender.disconnect()
+        await listener.disconnect()
+        self.assertNotIn(key, open_sockets.values)
+
+    async def test_group_events_are_forwarded_without_reencoding(self):
+        communicator = self.communicator(self.owner, channel_id="frames")
+        await communicator.connect()
+        await communicator.receive_nothing()  # let connect() finish joining the group
+
+        frame = '{"type": "chat.message", "new_message": {"id": 1}}'
+        await get_channel_layer().group_send("frames", {"type": "chat.message", "text": frame})
+
+        self.assertEqual(await communicator.receive_from(), frame)
+        await communicator.disconnect()
+
+    def test_broadcast_costs_a_sequence_bump_and_an_insert_once_the_conversation_is_known(self):
+        membership_cache.load(self.server.id)
+        communicator = self.communicator(self.owner)
+        statements = []
+
+        async def chat(queries):
+            await communicator.connect()
+            for content in ("first", "second", "third"):
+                before = len(queries)
+                await communicator.send_json_to({"message": content})
+                await communicator.receive_json_from()
+                sql = [query["sql"] for query in queries.captured_queries[before:]]
+                statements.append([statement.split()[0] for statement in sql if "SAVEPOINT" not in statement])
+            await communicator.disconnect()
+
+        # The coroutine runs on another thread, so hand it this thread's connection explicitly
+        with CaptureQueriesContext(connections[DEFAULT_DB_ALIAS]) as queries:
+            async_to_sync(chat)(queries)
+
+        self.assertEqual(statements[1:], [["UPDATE", "INSERT"], ["UPDATE", "INSERT"]])
+
+    async def test_reconnecting_client_gets_missed_messages_replayed_before_live_ones(self):
+        sender = self.communicator(self.owner)
+        await sender.connect()
+        sequences = []
+        for content in ("one", "two", "three"):
+            await sender.send_json_to({"message": content})
+            sequences.append((await sender.receive_json_from())["new_message"]["sequence"])
+        self.assertEqual(sequences, [1, 2, 3])
+
+        resumed = self.communicator(self.owner, since=1)
+        await resumed.connect()
+        replayed = [await resumed.receive_json_from() for _ in range(3)]
+        await sender.send_json_to({"message": "four"})
+        live = await resumed.receive_json_from()
+
+        self.assertEqual([frame["new_message"]["content"] for frame in replayed[:2]], ["two", "three"])
+        self.assertEqual(replayed[2], {"type": "replay.done", "since": 1, "sequence": 3})
+        self.assertEqual(live["new_message"]["sequence"], 4)
+        await sender.disconnect()
+        await resumed.disconnect()
+
+    def test_acks_for_a_channel_without_messages_are_looked_up_once(self):
+        communicator = self.communicator(self.owner, channel_id="empty")
+
+        async def ack():
+            await communicator.connect()
+            for sequence in range(5):
+                await communicator.send_json_to({"type": "read", "sequence": sequence})
+            await communicator.receive_nothing()
+            await communicator.disconnect()
+
+        with CaptureQueriesContext(connections[DEFAULT_DB_ALIAS]) as queries:
+            async_to_sync(ack)()
+
+        lookups = [query for query in queries if '"webchat_conversation"' in query["sql"]]
+        self.assertEqual(len(lookups), 1)
+
+    async def test_already_replayed_messages_are_not_delivered_twice(self):
+        sender = self.communicator(self.owner)
+        await sender.connect()
+        await sender.send_json_to({"message": "one"})
+        await sender.receive_json_from()
+
+        resumed = self.communicator(self.owner, since=0)
+        await resumed.connect()
+        await resumed.receive_json_from()
+        self.assertEqual((await resumed.receive_json_from())["type"], "replay.done")
+
+        # A broadcast of a message the replay already covered, e.g. saved while replaying
+        await get_channel_layer().group_send("1", {"type": "chat.message", "sequence": 1, "text": "{}"})
+
+        self.assertTrue(await resumed.receive_nothing())
+        await sender.disconnect()
+        await resumed.disconnect()
+
+    @override_settings(WEBCHAT_REPLAY_MAX=2)
+    async def test_too_many_missed_messages_is_reported_as_a_gap(self):
+        sender = self.communicator(self.owner)
+        await sender.connect()
+        for content in ("one", "two", "three"):
+            await sender.send_json_to({"message": content})
+            await sender.receive_json_from()
+
+        resumed = self.communicator(self.owner, since=0)
+        await resumed.connect()
+
+        self.assertEqual(await resumed.receive_json_from(), {"type": "replay.gap", "since": 0, "sequence": 3})
+        self.assertTrue(await resumed.receive_nothing())
+        await sender.disconnect()
+        await resumed.disconnect()
+
+    async def test_typing_pings_are_coalesced_into_snapshots(self):
+        sender = self.communicator(self.owner)
+        listener = self.communicator(self.outsider)
+        await sender.connect()
+        await listener.connect()
+        await listener.receive_nothing()
+
+        with mock.patch("webchat.consumer.typing_tracker", TypingTracker(ttl=3.0, interval=0.2)):
+            for _ in range(10):
+                await sender.send_json_to({"type": "typing"})
+            frames = [await listener.receive_json_from(timeout=1) for _ in range(2)]
+            self.assertTrue(await listener.receive_nothing(timeout=0.5))
+
+        # The first ping is broadcast at once, the other nine share one snapshot an interval later
+        self.assertEqual(frames, [{"type": "typing", "users": ["owner"], "ttl": 3000}] * 2)
+        await sender.disconnect()
+        await listener.disconnect()
+
+    @override_settings(WEBCHAT_SEND_QUEUE={"MAX_FRAMES": 2, "POLICY": "close"})
+    async def test_stalled_reader_is_evicted(self):
+        sender = self.communicator(self.owner)
+        stalled = self.communicator(self.outsider, stalled=True)
+        await sender.connect()
+        await stalled.connect()
+        await stalled.receive_nothing()
+        evictions_before = evictions.value
+
+        for i in range(4):
+            await sender.send_json_to({"message": f"flood {i}"})
+            await sender.receive_json_from()
+
+        self.assertEqual(await stalled.receive_output(), {"type": "websocket.close", "code": SLOW_CONSUMER_CLOSE_CODE})
+        self.assertEqual(evictions.value, evictions_before + 1)
+        await sender.disconnect()
+        await stalled.disconnect()
+
+    async def test_messages_over_the_server_rate_limit_are_rejected_before_saving(self):
+        limits = {self.server.id: {"CONNECTION": {"RATE": 0.01, "BURST": 2}}}
+        with self.settings(WEBCHAT_SERVER_RATE_LIMITS=limits):
+            communicator = self.communicator(self.owner)
+            await communicator.connect()
+            for content in ("one", "two", "three"):
+                await communicator.send_json_to({"message": content})
+            frames = [await communicator.receive_json_from() for _ in range(3)]
+
+        self.assertEqual([frame["type"] for frame in frames], ["chat.message", "chat.message", "error"])
+        self.assertEqual(frames[2]["code"], "rate_limited")
+        self.assertEqual(frames[2]["limit"], "connection")
+        self.assertGreater(frames[2]["retry_after"], 0)
+        self.assertFalse(await Message.objects.filter(content="three").aexists())
+        await communicator.disconnect()
+
+    async def test_msgpack_subprotocol_is_negotiated_alongside_json(self):
+        binary = self.communicator(self.owner, subprotocols=["chat", MSGPACK_SUBPROTOCOL])
+        text = self.communicator(self.owner)
+        self.assertEqual(await binary.connect(), (True, MSGPACK_SUBPROTOCOL))
+        self.assertEqual(await text.connect(), (True, None))
+
+        await binary.send_to(bytes_data=pack({"message": "binary meow"}))
+        frame = unpack(await binary.receive_from())
+        json_frame = await text.receive_json_from()
+
+        message = await Message.objects.aget(content="binary meow")
+        self.assertEqual(
+            frame,
+            [
+                CHAT_MESSAGE,
+                message.id,
+                message.sequence,
+                "owner",
+                "binary meow",
+                int(message.timestamp.timestamp() * 1000),
+            ],
+        )
+        self.assertEqual(json_frame["new_message"]["content"], "binary meow")
+        await binary.disconnect()
+        await text.disconnect()
+
+    async def test_malformed_frames_are_dropped_without_closing_the_socket(self):
+        binary = self.communicator(self.owner, subprotocols=[MSGPACK_SUBPROTOCOL])
+        text = self.communicator(self.owner)
+        await binary.connect()
+        await text.connect()
+
+        bomb = bytes((DEFLATE,)) + zlib.compress(msgpack.packb({"message": "m" * (1 << 20)}))
+        for frame in (b"", bytes((RAW,)) + msgpack.packb([1, 2]), bytes((RAW,)) + msgpack.packb({}), bomb):
+            await binary.send_input({"type": "websocket.receive", "bytes": frame})
+        for frame in ("[]", "42", "{}", '{"message": {"nested": 1}}', "{not json"):
+            await text.send_to(text_data=frame)
+        self.assertTrue(await binary.receive_nothing())
+        self.assertTrue(await text.receive_nothing())
+
+        await text.send_json_to({"message": "still here"})
+        self.assertEqual((await text.receive_json_from())["new_message"]["content"], "still here")
+        self.assertEqual(await Message.objects.acount(), 1)
+        await binary.disconnect()
+        await text.disconnect()
+        await text.disconnect()
+
+    async def test_non_member_messages_are_ignored(self):
+        communicator = self.communicator(self.outsider)
+        await communicator.connect()
+
+        await communicator.send_json_to({"message": "spam"})
+
+        self.assertTrue(await communicator.receive_nothing())
+        self.assertFalse(await Message.objects.filter(content="spam").aexists())
+        await communicator.disconnect()
+
+    async def test_non_member_frames_do_not_spend_the_channel_rate_limit(self):
+        limits = {self.server.id: {"CHANNEL": {"RATE": 0.01, "BURST": 1}}}
+        with self.settings(WEBCHAT_SERVER_RATE_LIMITS=limits):
+            outsider = self.communicator(self.outsider)
+            member = self.communicator(self.owner)
+            await outsider.connect()
+            await member.connect()
+            for _ in range(3):
+                await outsider.send_json_to({"message": "spam"})
+            self.assertTrue(await outsider.receive_nothing())
+
+            await member.send_json_to({"message": "still allowed"})
+            frame = await member.receive_json_from()
+
+        self.assertEqual(frame["type"], "chat.message")
+        self.assertEqual(frame["new_message"]["content"], "still allowed")
+        await outsider.disconnect()
+        await member.disconnect()
+
+    def test_connect_runs_no_queries_on_membership_cache_hit(self):
+        membership_cache.load(self.server.id)
+        communicator = self.communicator(self.owner)
+
+        async def connect_and_disconnect():
+            connected, _ = await communicator.connect()
+            await communicator.disconnect()
+            return connected
+
+        with self.assertNumQueries(0):
+            self.assertTrue(async_to_sync(connect_and_disconnect)())
+
+    async def test_revoked_member_is_ignored_without_reconnecting(self):
+        member = await database_sync_to_async(User.objects.create_user)(username="member", password="password")
+        await database_sync_to_async(self.server.member.add)(member)
+        communicator = self.communicator(member)
+        await communicator.connect()
+
+        def revoke():
+            with self.captureOnCommitCallbacks(execute=True):
+                self.server.member.remove(member)
+
+        await database_sync_to_async(revoke)()
+        await communicator.send_json_to({"message": "after removal"})
+
+        self.assertTrue(await communicator.receive_nothing())
+        self.assertFalse(await Message.objects.filter(content="after removal").aexists())
+        await communicator.disconnect()
+
+    async def test_membership_changes_reach_the_process_once_not_per_socket(self):
+        sockets = [self.communicator(self.owner, channel_id=str(channel)) for channel in range(3)]
+        for communicator in sockets:
+            await communicator.connect()
+        group = membership_group(self.server.id)
+        channel_layer = get_channel_layer()
+        self.assertEqual(len(channel_layer.groups[group]), 1)
+
+        newcomer = await database_sync_to_async(User.objects.create_user)(username="newcomer")
+        # As sent by another process after adding a member
+        await channel_layer.group_send(
+            group,
+            {
+                "type": "membership.changed",
+                "server_id": self.server.id,
+                "added": [newcomer.id],
+                "removed": [],
+                "reset": False,
+            },
+        )
+        for _ in range(10):
+            await asyncio.sleep(0)
+        self.assertTrue(membership_cache.get(self.server.id, newcomer.id))
+        for communicator in sockets:
+            self.assertTrue(await communicator.receive_nothing())
+
+        for communicator in sockets:
+            await communicator.disconnect()
+        self.assertFalse(channel_layer.groups.get(group))
+
+    async def test_unknown_server_closes_with_4004(self):
+        communicator = self.communicator(self.owner, server_id=999999)
+        await communicator.connect()
+
+        self.assertEqual(await communicator.receive_output(), {"type": "websocket.close", "code": 4004})
+
+
+class WebChatConsumerTests(ConsumerTestMixin, ConsumerTestCase):
+    consumer_class = WebChatConsumer
+
+
+class AsyncWebChatConsumerTests(ConsumerTestMixin, ConsumerTestCase):
+    consumer_class = AsyncWebChatConsumer
+
+
+class MessageViewSetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="reader", password="password")
+        conversation = Conversation.objects.create(channel_id="1")
+        cls.messages = [
+            Message.objects.create(conversation=conversation, sender=cls.user, content=f"message {i}") for i in range(7)
+        ]
+        cls.ids = [message.id for message in cls.messages]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get_page(self, **params):
+        response = self.client.get("/api/messages/", {"channel_id": "1", **params})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_newest_page_is_returned_oldest_first(self):
+        page = self.get_page(limit=3)
+
+        self.assertEqual([message["id"] for message in page["results"]], self.ids[4:])
+        self.assertEqual(page["before"], self.ids[4])
+        self.assertIsNone(page["after"])
+
+    def test_before_and_after_walk_the_history(self):
+        older = self.get_page(limit=3, before=self.ids[4])
+        self.assertEqual([message["id"] for message in older["results"]], self.ids[1:4])
+        self.assertEqual((older["before"], older["after"]), (self.ids[1], self.ids[3]))
+
+        oldest = self.get_page(limit=3, before=older["before"])
+        self.assertEqual([message["id"] for message in oldest["results"]], self.ids[:1])
+        self.assertIsNone(oldest["before"])
+
+        newer = self.get_page(limit=3, after=self.ids[0])
+        self.assertEqual([message["id"] for message in newer["results"]], self.ids[1:4])
+        self.assertEqual((newer["before"], newer["after"]), (self.ids[1], self.ids[3]))
+
+    def test_query_count_does_not_depend_on_page_size(self):
+        conversation = Conversation.objects.get(channel_id="1")
+        for i in range(20):
+            sender = User.objects.create_user(username=f"sender-{i}", password="password")
+            Message.objects.create(conversation=conversation, sender=sender, content=f"from {i}")
+
+        # channel_id -> conversation, then the page joined with its senders
+        with self.assertNumQueries(2):
+            small = self.get_page(limit=2)
+        with self.assertNumQueries(2):
+            large = self.get_page(limit=25)
+
+        self.assertEqual(len(small["results"]), 2)
+        self.assertEqual(large["results"][-1]["sender"], "sender-19")
+
+    @override_settings(WEBCHAT_MESSAGE_PAGE_SIZE_MAX=2)
+    def test_limit_is_capped_by_the_server(self):
+        self.assertEqual(len(self.get_page(limit=1000)["results"]), 2)
+
+    def test_unknown_channel_and_bad_cursor(self):
+        self.assertEqual(self.get_page(channel_id="missing")["results"], [])
+        self.assertEqual(self.client.get("/api/messages/", {"channel_id": "1", "before": "x"}).status_code, 400)
+        for limit in ("x", "0", "-3"):
+            response = self.client.get("/api/messages/", {"channel_id": "1", "limit": limit})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(str(response.data[0]), "limit must be a positive integer")
+
+
+class MessageSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(username="owner", password="password")
+        cls.outsider = User.objects.create_user(username="outsider", password="password")
+        category = Category.objects.create(name="general")
+        cls.server = Server.objects.create(name="meow", owner=cls.owner, category=category)
+        cls.server.member.add(cls.owner)
+        other_server = Server.objects.create(name="woof", owner=cls.outsider, category=category)
+        cls.lobby, cls.garden, elsewhere = (
+            Channel.objects.create(name=name, topic="", owner=cls.owner, server=server)
+            for name, server in (("lobby", cls.server), ("garden", cls.server), ("elsewhere", other_server))
+        )
+        cls.conversations = {
+            channel: Conversation.objects.create(channel_id=str(channel.id))
+            for channel in (cls.lobby, cls.garden, elsewhere)
+        }
+        cls.messages = {}
+        for channel, content in (
+            (cls.lobby, "the cat sat on the mat"),
+            (cls.lobby, "cats everywhere, cat cat cat"),
+            (cls.garden, "a cat in the garden"),
+            (cls.garden, "the dog <b>barks</b>"),
+            (elsewhere, "another cat on another server"),
+        ):
+            cls.messages[content] = Message.objects.create(
+                conversation=cls.conversations[channel], sender=cls.owner, content=content
+            )
+
+    def setUp(self):
+        membership_cache.invalidate()
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+
+    def search(self, q, **params):
+        return self.client.get("/api/messages/search/", {"q": q, "server_id": self.server.id, **params})
+
+    def contents(self, response):
+        self.assertEqual(response.status_code, 200)
+        return [result["content"] for result in response.data["results"]]
+
+    def test_results_are_ranked_and_limited_to_the_server(self):
+        contents = self.contents(self.search("cat"))
+
+        self.assertEqual(contents[0], "cats everywhere, cat cat cat")
+        self.assertCountEqual(
+            contents, ["the cat sat on the mat", "cats everywhere, cat cat cat", "a cat in the garden"]
+        )
+        self.assertEqual(self.contents(self.search("cat", channel_id=self.garden.id)), ["a cat in the garden"])
+
+    def test_snippets_are_escaped_and_mark_the_matches(self):
+        result = self.search("barks").data["results"][0]
+
+        self.assertEqual(result["snippet"], "the dog &lt;b&gt;<mark>barks</mark>&lt;/b&gt;")
+        self.assertEqual(result["channel_id"], str(self.garden.id))
+
+    def test_cursor_walks_every_result_once(self):
+        seen = []
+        response = self.search("cat", limit=1)
+        while True:
+            seen += self.contents(response)
+            if response.data["next"] is None:
+                break
+            response = self.search("cat", limit=1, cursor=response.data["next"])
+
+        self.assertEqual(seen, self.contents(self.search("cat")))
+
+    def test_index_follows_updates_and_deletes(self):
+        message = self.messages["the cat sat on the mat"]
+        message.content = "the kitten sat on the mat"
+        message.save()
+        self.messages["a cat in the garden"].delete()
+
+        self.assertEqual(self.contents(self.search("kitten")), ["the kitten sat on the mat"])
+        self.assertEqual(self.contents(self.search("cat")), ["cats everywhere, cat cat cat"])
+
+        call_command("rebuild_message_search", "--optimize", stdout=io.StringIO())
+        self.assertEqual(self.contents(self.search("kitten")), ["the kitten sat on the mat"])
+
+    def test_query_syntax_is_searched_literally(self):
+        self.assertEqual(self.contents(self.search('cat" OR "dog')), [])
+        self.assertEqual(self.search("   ").status_code, 400)
+        self.assertEqual(self.search("cat", cursor="nonsense").status_code, 400)
+
+    def test_only_members_can_search_a_server(self):
+        self.client.force_authenticate(self.outsider)
+        self.assertEqual(self.search("cat").status_code, 403)
+        self.assertEqual(self.search("cat", server_id=999999).status_code, 404)
+
+    def test_server_id_must_be_a_positive_integer(self):
+        response = self.search("cat", server_id="x")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(str(response.data[0]), "server_id must be a positive integer")
+
+    def test_triggers_dropped_by_a_table_remake_are_restored_after_migrate(self):
+        drop_triggers()
+        Message.objects.create(conversation=self.conversations[self.lobby], sender=self.owner, content="a lost kitten")
+
+        emit_post_migrate_signal(0, False, DEFAULT_DB_ALIAS)
+
+        self.assertEqual(self.contents(self.search("kitten")), ["a lost kitten"])
+        self.assertEqual(restore_triggers(), [])
+
+
+class MessageExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="auditor", password="password")
+        cls.outsider = User.objects.create_user(username="outsider", password="password")
+        cls.admin = User.objects.create_user(username="admin", password="password", is_staff=True)
+        category = Category.objects.create(name="general")
+        server = Server.objects.create(name="meow", owner=cls.user, category=category)
+        server.member.add(cls.user)
+        channel = Channel.objects.create(name="lobby", topic="", owner=cls.user, server=server)
+        cls.channel_id = str(channel.id)
+        cls.conversation = Conversation.objects.create(channel_id=cls.channel_id)
+
+    def setUp(self):
+        membership_cache.invalidate()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def seed(self, count, content="meow"):
+        Message.objects.bulk_create(
+            Message(conversation=self.conversation, sender=self.user, content=f"{content} {i}") for i in range(count)
+        )
+
+    def export(self, **params):
+        response = self.client.get("/api/messages/export/", {"channel_id": self.channel_id, **params})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return response
+
+    def test_history_is_streamed_as_ndjson_oldest_first(self):
+        self.seed(5)
+
+        response = self.export()
+        records = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        self.assertEqual([record["content"] for record in records], [f"meow {i}" for i in range(5)])
+        self.assertEqual(records[0]["sender"], "auditor")
+
+    def test_export_can_be_gzip_compressed(self):
+        self.seed(5)
+
+        response = self.export(gzip="true")
+        lines = gzip.decompress(b"".join(response.streaming_content)).splitlines()
+
+        self.assertEqual(response["Content-Type"], "application/gzip")
+        self.assertEqual(json.loads(lines[-1])["content"], "meow 4")
+
+    def test_only_members_and_admins_may_export(self):
+        self.client.force_authenticate(self.outsider)
+        self.assertEqual(self.client.get("/api/messages/export/", {"channel_id": self.channel_id}).status_code, 403)
+        self.assertEqual(self.client.get("/api/messages/export/", {"channel_id": "missing"}).status_code, 404)
+
+        self.client.force_authenticate(self.admin)
+        self.export()
+        self.assertEqual(b"".join(self.export(channel_id="missing").streaming_content), b"")
+
+    async def test_asgi_export_is_streamed_chunk_by_chunk(self):
+        await database_sync_to_async(self.seed)(2_000, content="m" * 200)
+        token, _ = await Token.objects.aget_or_create(user=self.user)
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "http",
+            "path": "/api/messages/export/",
+            "query_string": f"channel_id={self.channel_id}".encode(),
+            "headers": [(b"host", b"testserver"), (b"authorization", f"Token {token.key}".encode())],
+            "server": ("testserver", 80),
+            "client": ("127.0.0.1", 50000),
+        }
+        requests = [{"type": "http.request", "body": b"", "more_body": False}]
+        bodies = []
+
+        async def receive():
+            if requests:
+                return requests.pop()
+            await asyncio.Event().wait()
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                self.assertEqual(message["status"], 200)
+            elif message.get("body"):
+                bodies.append(len(message["body"]))
+
+        # Like the test client, keep the handler from closing the test transaction's connection
+        signals.request_started.disconnect(close_old_connections)
+        self.addCleanup(signals.request_started.connect, close_old_connections)
+        with override_settings(WEBCHAT_EXPORT_CHUNK_SIZE=200), warnings.catch_warnings():
+            # The warning ASGI gives before buffering a sync iterator whole
+            warnings.simplefilter("error")
+            await ASGIHandler()(scope, receive, send)
+
+        self.assertEqual(len(bodies), 10)
+        self.assertLess(max(bodies), sum(bodies) / 5)
+
+    def measure_export(self):
+        exported = 0
+        tracemalloc.start()
+        try:
+            for chunk in self.export().streaming_content:
+                exported += len(chunk)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return exported, peak
+
+    @override_settings(WEBCHAT_EXPORT_CHUNK_SIZE=500)
+    def test_memory_stays_flat_on_a_large_channel(self):
+        self.seed(4_000, content="m" * 200)
+        small_size, small_peak = self.measure_export()
+        self.seed(16_000, content="m" * 200)
+        large_size, large_peak = self.measure_export()
+
+        # Five times the history, about the same peak: only a few chunks are ever held at once
+        self.assertGreater(large_size, 5 * small_size - 1000)
+        self.assertLess(large_peak, small_peak * 1.5)
+        self.assertLess(large_peak, large_size / 4)
+
+
+class MessageArchiveTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="historian", password="password")
+        category = Category.objects.create(name="general")
+        cls.server = Server.objects.create(name="meow", owner=cls.user, category=category)
+        channel = Channel.objects.create(name="lobby", topic="", owner=cls.user, server=cls.server)
+        cls.channel_id = str(channel.id)
+        cls.conversation = Conversation.objects.create(channel_id=cls.channel_id)
+        now = timezone.now()
+        cls.messages = [
+            Message.objects.create(
+                conversation=cls.conversation,
+                sender=cls.user,
+                content=f"message {i}",
+                timestamp=now - timedelta(days=200 - i) if i < 7 else now,
+            )
+            for i in range(10)
+        ]
+        cls.ids = [message.id for message in cls.messages]
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        archive = {"DIR": directory.name, "AFTER_DAYS": 90, "SEGMENT_MESSAGES": 3, "BLOCK_MESSAGES": 2}
+        override = override_settings(WEBCHAT_ARCHIVE=archive)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def archive(self):
+        call_command("archive_messages", stdout=io.StringIO())
+
+    def get_page(self, **params):
+        response = self.client.get("/api/messages/", {"channel_id": self.channel_id, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_old_messages_move_to_segments(self):
+        self.archive()
+
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.archived_through, self.ids[6])
+        self.assertEqual(list(Message.objects.values_list("id", flat=True).order_by("id")), self.ids[7:])
+        self.assertEqual(
+            list(self.conversation.segments.order_by("first_id").values_list("message_count", flat=True)), [3, 3, 1]
+        )
+        messages = cold_messages(self.conversation.id, 10, after=0)
+        self.assertEqual([message.content for message in messages], [f"message {i}" for i in range(7)])
+        self.assertEqual(messages[0].timestamp, self.messages[0].timestamp)
+        self.assertEqual(messages[0].sender.username, "historian")
+
+        # Running again finds nothing new to move
+        self.archive()
+        self.assertEqual(self.conversation.segments.count(), 3)
+
+    def test_replay_continues_into_the_archive(self):
+        for sequence, message_id in enumerate(self.ids, start=1):
+            Message.objects.filter(id=message_id).update(sequence=sequence)
+        Conversation.objects.filter(id=self.conversation.id).update(last_sequence=len(self.ids))
+        self.archive()
+
+        conversation_id, sequence, events = load_replay(self.channel_id, 2, settings.WEBCHAT_REPLAY_MAX)
+
+        self.assertEqual((conversation_id, sequence), (self.conversation.id, 10))
+        self.assertEqual([event["sequence"] for event in events], list(range(3, 11)))
+        self.assertEqual(json.loads(events[0]["text"])["new_message"]["content"], "message 2")
+
+    def test_archived_messages_leave_search(self):
+        self.server.member.add(self.user)
+        self.archive()
+
+        response = self.client.get("/api/messages/search/", {"q": "message", "server_id": self.server.id})
+
+        self.assertCountEqual(
+            [result["content"] for result in response.data["results"]], ["message 7", "message 8", "message 9"]
+        )
+
+    def test_pages_continue_from_the_table_into_the_archive(self):
+        self.archive()
+
+        page = self.get_page(limit=4)
+        self.assertEqual([message["id"] for message in page["results"]], self.ids[6:])
+        older = self.get_page(limit=4, before=page["before"])
+        self.assertEqual([message["id"] for message in older["results"]], self.ids[2:6])
+        oldest = self.get_page(limit=4, before=older["before"])
+        self.assertEqual([message["id"] for message in oldest["results"]], self.ids[:2])
+        self.assertIsNone(oldest["before"])
+
+        newer = self.get_page(limit=4, after=self.ids[1])
+        self.assertEqual([message["id"] for message in newer["results"]], self.ids[2:6])
+        newest = self.get_page(limit=4, after=newer["after"])
+        self.assertEqual([message["id"] for message in newest["results"]], self.ids[6:])
+        self.assertIsNone(newest["after"])
+        self.assertEqual(newest["results"][0]["sender"], "historian")
+
+    def test_export_includes_archived_messages(self):
+        self.archive()
+        self.server.member.add(self.user)
+
+        response = self.client.get("/api/messages/export/", {"channel_id": self.channel_id})
+        records = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+
+        self.assertEqual([record["id"] for record in records], self.ids)
+        self.assertEqual(records[0]["sender"], "historian")
+
+    def test_servers_can_override_the_retention(self):
+        with override_settings(WEBCHAT_SERVER_ARCHIVE_AFTER_DAYS={self.server.id: None}):
+            self.archive()
+        self.assertEqual(Message.objects.count(), 10)
+
+        with override_settings(WEBCHAT_SERVER_ARCHIVE_AFTER_DAYS={self.server.id: 197.5}):
+            self.archive()
+        self.assertEqual(Message.objects.count(), 7)
+
+
+@override_settings(WEBCHAT_READ_MARKERS={"FLUSH_INTERVAL": None})
+class ReadMarkerTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="reader", password="password")
+        owner = User.objects.create_user(username="owner", password="password")
+        category = Category.objects.create(name="general")
+        server = Server.objects.create(name="meow", owner=owner, category=category)
+        server.member.add(cls.user)
+        other_server = Server.objects.create(name="woof", owner=owner, category=category)
+        cls.conversations = {}
+        for name, channel_server, sequence in (
+            ("lobby", server, 10),
+            ("garden", server, 4),
+            ("quiet", server, None),
+            ("elsewhere", other_server, 7),
+        ):
+            channel = Channel.objects.create(name=name, topic="", owner=owner, server=channel_server)
+            if sequence is not None:
+                cls.conversations[name] = Conversation.objects.create(
+                    channel_id=str(channel.id), last_sequence=sequence
+                )
+
+    def setUp(self):
+        membership_cache.invalidate()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def marker(self, name):
+        return ReadMarker.objects.get(user=self.user, conversation=self.conversations[name]).last_read_sequence
+
+    def test_acks_are_coalesced_into_one_write(self):
+        buffer = ReadMarkerBuffer(flush_interval=None)
+        for sequence in range(1, 101):
+            buffer.mark(self.user.id, self.conversations["lobby"].id, sequence)
+        buffer.mark(self.user.id, self.conversations["garden"].id, 3)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(buffer.flush(), 2)
+        self.assertEqual((self.marker("lobby"), self.marker("garden")), (100, 3))
+        self.assertEqual(buffer.flush(), 0)
+
+    @override_settings(WEBCHAT_READ_MARKERS={"FLUSH_INTERVAL": None})
+    def test_closing_saves_pending_markers_and_starts_over(self):
+        buffer = get_read_markers()
+        buffer.mark(self.user.id, self.conversations["lobby"].id, 9)
+
+        close_read_markers()
+
+        self.assertEqual(self.marker("lobby"), 9)
+        self.assertIsNot(get_read_markers(), buffer)
+
+    def test_markers_never_move_backwards(self):
+        buffer = ReadMarkerBuffer(flush_interval=None)
+        buffer.mark(self.user.id, self.conversations["lobby"].id, 8)
+        buffer.flush()
+        buffer.mark(self.user.id, self.conversations["lobby"].id, 5)
+        buffer.flush()
+
+        self.assertEqual(self.marker("lobby"), 8)
+
+    def test_unread_counts_take_one_query(self):
+        ReadMarker.objects.create(user=self.user, conversation=self.conversations["lobby"], last_read_sequence=6)
+
+        with self.assertNumQueries(1):
+            counts = unread_counts(self.user)
+
+        self.assertEqual(
+            {channel_id: (sequence, read) for channel_id, sequence, read in counts},
+            {self.conversations["lobby"].channel_id: (10, 6), self.conversations["garden"].channel_id: (4, 0)},
+        )
+
+    def test_acks_over_rest_show_in_the_unread_counts(self):
+        lobby = self.conversations["lobby"].channel_id
+        response = self.client.post("/api/messages/read/", {"channel_id": lobby, "sequence": 8})
+        self.assertEqual(response.status_code, 202)
+
+        response = self.client.get("/api/messages/unread/")
+        self.assertEqual(response.status_code, 200)
+        unread = {result["channel_id"]: result["unread"] for result in response.data["results"]}
+        self.assertEqual(unread, {lobby: 2, self.conversations["garden"].channel_id: 4})
+
+    def test_only_members_may_ack(self):
+        elsewhere = self.conversations["elsewhere"].channel_id
+        response = self.client.post("/api/messages/read/", {"channel_id": elsewhere, "sequence": 3})
+
+        self.assertEqual(response.status_code, 403)
+        get_read_markers().flush()
+        self.assertFalse(ReadMarker.objects.filter(user=self.user).exists())
+
+    def test_bad_acks_are_rejected(self):
+        lobby = self.conversations["lobby"].channel_id
+        self.assertEqual(
+            self.client.post("/api/messages/read/", {"channel_id": lobby, "sequence": -1}).status_code, 400
+        )
+        self.assertEqual(self.client.post("/api/messages/read/", {"channel_id": "x", "sequence": 1}).status_code, 404)
+
+
+class SendQueueTests(SimpleTestCase):
+    async def stalled_queue(self, policy):
+        self.delivered = []
+        self.release = asyncio.Event()
+
+        async def send(message):
+            if message["type"] == "websocket.send":
+                await self.release.wait()
+            self.delivered.append(message.get("text", message["type"]))
+
+        queue = SendQueue(send, max_frames=3, policy=policy)
+        await queue.send({"type": "websocket.accept"})
+        await queue.send({"type": "websocket.send", "text": "1"})
+        await asyncio.sleep(0)  # the writer picks up frame 1 and blocks on the socket
+        for text in "2345":
+            await queue.send({"type": "websocket.send", "text": text})
+        return queue
+
+    async def delivered_after_release(self, queue):
+        self.release.set()
+        for _ in range(10):
+            await asyncio.sleep(0)
+        queue.close()
+        return self.delivered
+
+    async def test_drop_oldest_keeps_the_newest_frames(self):
+        dropped_before = dropped_frames.value
+        queue = await self.stalled_queue("drop_oldest")
+
+        self.assertEqual(len(queue), 3)
+        self.assertEqual(await self.delivered_after_release(queue), ["websocket.accept", "1", "3", "4", "5"])
+        self.assertEqual(dropped_frames.value, dropped_before + 1)
+
+    async def test_resync_collapses_the_backlog_into_a_marker(self):
+        resyncs_before = resyncs.value
+        queue = await self.stalled_queue("resync")
+
+        self.assertEqual(
+            await self.delivered_after_release(queue), ["websocket.accept", "1", '{"type": "resync"}', "5"]
+        )
+        self.assertEqual(resyncs.value, resyncs_before + 1)
+
+    async def test_close_evicts_the_connection(self):
+        queue = await self.stalled_queue("close")
+
+        self.assertTrue(queue.closed)
+        self.assertEqual(self.delivered, ["websocket.accept", "websocket.close"])
+        await queue.send({"type": "websocket.send", "text": "6"})
+        self.assertEqual(await self.delivered_after_release(queue), ["websocket.accept", "websocket.close"])
+
+
+class MessageRateLimiterTests(SimpleTestCase):
+    limits = {
+        "CONNECTION": {"RATE": 1, "BURST": 3},
+        "USER": {"RATE": 1, "BURST": 4},
+        "CHANNEL": {"RATE": 1, "BURST": 5},
+    }
+
+    def setUp(self):
+        self.now = 100.0
+        self.limiter = MessageRateLimiter(sweep_interval=60, clock=lambda: self.now)
+
+    def send(self, bucket, user_id=1, channel_id="1", count=1):
+        return [self.limiter.check(bucket, 1, user_id, channel_id, self.limits) for _ in range(count)]
+
+    def test_connection_bucket_refills_at_its_rate(self):
+        bucket = self.limiter.connection_bucket(self.limits)
+
+        results = self.send(bucket, count=4)
+        self.assertEqual(results[:3], [None] * 3)
+        self.assertEqual(results[3], ("connection", 1.0))
+
+        self.now += 1
+        self.assertIsNone(self.send(bucket)[0])
+
+    def test_user_limit_spans_connections_and_channel_limit_spans_users(self):
+        first, second = self.limiter.connection_bucket(self.limits), self.limiter.connection_bucket(self.limits)
+        self.send(first, count=3)
+        self.assertEqual(self.send(second, count=2)[1][0], "user")
+
+        others = [self.limiter.connection_bucket(self.limits) for _ in range(2)]
+        self.assertIsNone(self.send(others[0], user_id=2)[0])
+        self.assertEqual(self.send(others[1], user_id=3)[0][0], "channel")
+
+    def test_idle_buckets_are_forgotten(self):
+        self.send(self.limiter.connection_bucket(self.limits), count=2)
+
+        self.now += 61
+        self.send(self.limiter.connection_bucket(self.limits), user_id=2, channel_id="2")
+
+        self.assertEqual(list(self.limiter._users), [(1, 2)])
+        self.assertEqual(list(self.limiter._channels), ["2"])
+
+    @override_settings(WEBCHAT_SERVER_RATE_LIMITS={7: {"CHANNEL": {"RATE": 20}}})
+    def test_server_overrides_are_merged_into_the_defaults(self):
+        limits = rate_limits_for("7")
+
+        self.assertEqual(limits["CHANNEL"], {"RATE": 20, "BURST": 200})
+        self.assertEqual(limits["USER"], rate_limits_for("8")["USER"])
+
+
+class TokenCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="whiskers", password="password")
+
+    def setUp(self):
+        token_cache.clear()
+
+    def make_token(self, user, lifetime=3600):
+        return jwt.encode({"user_id": user.id, "exp": int(time.time()) + lifetime}, settings.SECRET_KEY, "HS256")
+
+    def handshake(self, token):
+        scopes = []
+
+        async def app(scope, receive, send):
+            scopes.append(scope)
+
+        scope = {"type": "websocket", "headers": [(b"cookie", f"access_token={token}".encode())]}
+        with CaptureQueriesContext(connections[DEFAULT_DB_ALIAS]) as queries:
+            async_to_sync(JWTAuthMiddleWare(app))(scope, None, None)
+        return scopes[0]["user"], len(queries)
+
+    def test_repeated_handshakes_reuse_the_verified_token(self):
+        token = self.make_token(self.user)
+
+        first, first_queries = self.handshake(token)
+        second, second_queries = self.handshake(token)
+
+        self.assertEqual((first_queries, second_queries), (1, 0))
+        self.assertEqual((second.id, second.username, second.is_authenticated), (self.user.id, "whiskers", True))
+        self.assertIsNot(first, second)
+
+    def test_logout_and_deactivation_drop_cached_tokens(self):
+        token = self.make_token(self.user)
+        self.handshake(token)
+
+        self.client.force_login(self.user)
+        self.client.logout()
+        self.assertIsNone(token_cache.get(token))
+
+        self.handshake(token)
+        self.user.is_active = False
+        self.user.save()
+        user, queries = self.handshake(token)
+
+        self.assertEqual(queries, 1)
+        self.assertFalse(user.is_authenticated)
+        self.assertIsNone(token_cache.get(token))
+
+        async def connect():
+            router = URLRouter([path("ws/<str:serverId>/<str:channelId>", AsyncWebChatConsumer.as_asgi())])
+            communicator = WebsocketCommunicator(
+                JWTAuthMiddleWare(router), "ws/1/1", headers=[(b"cookie", f"access_token={token}".encode())]
+            )
+            await communicator.connect()
+            return await communicator.receive_output()
+
+        self.assertEqual(async_to_sync(connect)(), {"type": "websocket.close", "code": 4001})
+
+    def test_inactive_users_in_the_cache_are_not_trusted(self):
+        token = self.make_token(self.user)
+        # Deactivated without the signal that would drop the cached snapshot
+        User.objects.filter(id=self.user.id).update(is_active=False)
+        self.user.is_active = False
+        token_cache.put(token, {"user_id": self.user.id}, self.user)
+
+        user, queries = self.handshake(token)
+
+        self.assertEqual(queries, 1)
+        self.assertFalse(user.is_authenticated)
+
+    def test_invalid_tokens_are_not_cached(self):
+        user, _ = self.handshake("not-a-token")
+
+        self.assertFalse(user.is_authenticated)
+        self.assertEqual(len(token_cache), 0)
+
+    def test_entries_expire_with_the_token_and_are_evicted_least_recently_used_first(self):
+        now = [1000.0]
+        cache = VerifiedTokenCache(max_entries=2, ttl=300, clock=lambda: now[0])
+        other = User.objects.create_user(username="mittens")
+        cache.put("a", {"user_id": self.user.id, "exp": 1010}, self.user)
+        cache.put("b", {"user_id": other.id}, other)
+        cache.get("a")
+        cache.put("c", {"user_id": other.id}, other)
+
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("a"))
+        now[0] = 1010
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("c"))
+
+        cache.invalidate_user(other.id)
+        self.assertEqual(len(cache), 0)
+
+
+class MetricsTests(SimpleTestCase):
+    def test_metrics_are_rendered_in_the_prometheus_text_format(self):
+        counter("test_events_total", "Events").inc(3)
+        sockets = gauge("test_sockets", "Sockets", labels=("channel_id",))
+        sockets.inc('say "hi"')
+        sockets.inc("gone")
+        sockets.dec("gone")
+        latency = Histogram("test_seconds", buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 5):
+            latency.observe(value)
+
+        text = render_prometheus()
+
+        self.assertIn("# TYPE test_events_total counter\ntest_events_total 3\n", text)
+        self.assertIn('test_sockets{channel_id="say \\"hi\\""} 1\n', text)
+        self.assertNotIn('channel_id="gone"', text)
+        self.assertEqual(
+            [line for sample in latency.samples() for line in [f"{sample[0]} {sample[1]} {sample[2]}"]],
+            [
+                "test_seconds_bucket {'le': '0.1'} 1",
+                "test_seconds_bucket {'le': '1.0'} 2",
+                "test_seconds_bucket {'le': '+Inf'} 3",
+                "test_seconds_sum {} 5.55",
+                "test_seconds_count {} 3",
+            ],
+        )
+
+
+class MetricsViewTests(TestCase):
+    def test_metrics_are_only_served_to_admins(self):
+        client = APIClient()
+        self.assertEqual(client.get(reverse("metrics")).status_code, 401)
+
+        client.force_authenticate(User.objects.create_user(username="member"))
+        self.assertEqual(client.get(reverse("metrics")).status_code, 403)
+
+        client.force_authenticate(User.objects.create_user(username="operator", is_staff=True))
+        response = client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        self.assertIn(b"# TYPE webchat_message_handle_seconds histogram", response.content)
+        self.assertIn(b"webchat_channel_layer_queued_messages ", response.content)
+
+
+class ProtocolTests(SimpleTestCase):
+    @override_settings(WEBCHAT_MSGPACK_COMPRESS_MIN=100)
+    def test_large_payloads_are_compressed(self):
+        small, large = pack({"content": "meow"}), pack({"content": "meow " * 100})
+
+        self.assertEqual((small[0], large[0]), (RAW, DEFLATE))
+        self.assertLess(len(large), 100)
+        self.assertEqual(unpack(large), {"content": "meow " * 100})
+
+    def test_json_frames_convert_to_compact_binary_frames(self):
+        text = json.dumps({"type": "typing", "users": ["alice"], "ttl": 3000})
+        self.assertEqual(unpack(binary_frame(text)), [TYPING, ["alice"], 3000])
+
+        text = json.dumps({"type": "replay.done", "since": 1, "sequence": 3})
+        self.assertEqual(unpack(binary_frame(text)), {"type": "replay.done", "since": 1, "sequence": 3})
+
+    @override_settings(WEBCHAT_MSGPACK_MAX_PAYLOAD=1000)
+    def test_decompression_stops_at_the_payload_limit(self):
+        payload = msgpack.packb({"message": "m" * 980})
+        self.assertEqual(unpack(bytes((DEFLATE,)) + zlib.compress(payload)), {"message": "m" * 980})
+
+        for frame in (
+            bytes((DEFLATE,)) + zlib.compress(msgpack.packb({"message": "m" * 10_000_000})),
+            bytes((RAW,)) + payload + b"m" * 1000,
+            bytes((DEFLATE,)) + b"not zlib",
+            bytes((7,)) + payload,
+            bytes((RAW,)) + b"\xc1",
+            b"",
+        ):
+            with self.assertRaises(FrameError):
+                unpack(frame)
+
+
+class RealtimeLoggingTests(SimpleTestCase):
+    def record(self, event="ws.connected", **fields):
+        record = logging.LogRecord("webchat.realtime", logging.INFO, __file__, 1, "%s %s", (event, ""), None)
+        record.event, record.fields = event, fields
+        return record
+
+    def test_repeats_are_limited_per_window_and_counted(self):
+        now = [0.0]
+        repeats = RepeatFilter(limit=2, window=60, clock=lambda: now[0])
+
+        self.assertEqual([repeats.filter(self.record()) for _ in range(5)], [True, True, False, False, False])
+        self.assertTrue(repeats.filter(self.record("ws.rejected")))
+
+        now[0] = 61
+        record = self.record()
+        self.assertTrue(repeats.filter(record))
+        self.assertEqual(json.loads(StructuredFormatter().format(record))["suppressed_repeats"], 3)
+
+    def test_sampled_events_are_mostly_dropped(self):
+        sample = SampleFilter({"ws.connected": 0.0})
+
+        self.assertFalse(sample.filter(self.record("ws.connected")))
+        self.assertTrue(sample.filter(self.record("ws.rejected")))
+
+    def test_records_are_formatted_lazily_as_json(self):
+        class Loud:
+            formatted = 0
+
+            def __str__(self):
+                Loud.formatted += 1
+                return "loud"
+
+        with self.assertLogs("webchat.realtime", logging.WARNING) as logs:
+            log_event(logging.INFO, "ws.connected", user=Loud())
+            log_event(logging.WARNING, "ws.rejected", user=Loud())
+        # Only the record that was emitted got formatted
+        self.assertEqual(Loud.formatted, 1)
+
+        entry = json.loads(StructuredFormatter().format(logs.records[0]))
+        self.assertEqual((entry["event"], entry["user"], entry["level"]), ("ws.rejected", "loud", "WARNING"))
+
+    def test_tracing_is_switched_at_runtime(self):
+        self.addCleanup(set_tracing, tracing_enabled())
+        set_tracing(False)
+        with self.assertNoLogs("webchat.trace"):
+            trace("ws.connect", user_id=1)
+
+        set_tracing(True)
+        with self.assertLogs("webchat.trace") as logs:
+            trace("ws.connect", user_id=1)
+        self.assertEqual(logs.records[0].fields, {"user_id": 1})
+
+    def test_queueing_handler_drops_records_instead_of_blocking(self):
+        stream = io.StringIO()
+        handler = QueueingHandler(stream, maxsize=1)
+        handler.setFormatter(StructuredFormatter())
+        handler.listener.stop()  # a stalled writer
+        dropped_before = dropped_records.value
+
+        for _ in range(3):
+            handler.handle(self.record())
+
+        self.assertEqual(dropped_records.value, dropped_before + 2)
+        handler.listener.start()
+        handler.stop()
+        self.assertEqual(json.loads(stream.getvalue())["event"], "ws.connected")
+
+
+class TypingTrackerTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 100.0
+        self.tracker = TypingTracker(ttl=3.0, interval=0.5, clock=lambda: self.now)
+
+    def test_snapshots_are_due_at_most_once_per_interval(self):
+        self.assertEqual(self.tracker.ping("1", "alice"), 0)
+        self.assertEqual(self.tracker.snapshot("1"), ["alice"])
+
+        self.now += 0.1
+        self.assertAlmostEqual(self.tracker.ping("1", "bob"), 0.4)
+        self.assertIsNone(self.tracker.ping("1", "alice"))
+        self.assertIsNone(self.tracker.ping("1", "carol"))
+
+        self.now += 0.4
+        self.assertEqual(self.tracker.snapshot("1"), ["alice", "bob", "carol"])
+
+    def test_typists_expire_or_stop(self):
+        self.tracker.ping("1", "alice")
+        self.tracker.ping("1", "bob")
+        self.tracker.stop("1", "bob")
+
+        self.now += 3.5
+        self.tracker.ping("1", "carol")
+
+        self.assertEqual(self.tracker.snapshot("1"), ["carol"])
+
+    def test_idle_channels_are_forgotten(self):
+        for channel in ("1", "2", "3"):
+            self.tracker.ping(channel, "alice")
+            self.tracker.snapshot(channel)
+
+        self.now += 10
+        self.tracker.ping("4", "alice")
+        self.tracker.snapshot("4")
+
+        self.assertEqual(set(self.tracker._typists), {"4"})
+        self.assertEqual(set(self.tracker._next_snapshot_at), {"4"})
+
+
+class SeedDatasetTests(TestCase):
+    def test_seeded_conversations_have_gapless_sequences(self):
+        counts = seed_dataset(50, 6, categories=2, channels_per_server=2, members_per_server=5, messages=300)
+
+        self.assertEqual(
+            counts,
+            {
+                "accounts": 50,
+                "categories": 2,
+                "servers": 6,
+                "memberships": counts["memberships"],
+                "channels": 12,
+                "messages": 300,
+            },
+        )
+        self.assertGreaterEqual(counts["memberships"], 30)
+        self.assertEqual(Message.objects.count(), 300)
+        for conversation in Conversation.objects.all():
+            sequences = list(conversation.message.order_by("id").values_list("sequence", flat=True))
+            self.assertEqual(sequences, list(range(1, conversation.last_sequence + 1)))
+
+
+class HotQueryIndexTests(TestCase):
+    def test_hot_queries_use_indexes(self):
+        call_command("explain_hot_queries", "--check", stdout=io.StringIO())
+
+
+class MessageWriteBehindTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="writer", password="password")
+        cls.conversation = Conversation.objects.create(channel_id="1")
+
+    def make_writer(self, **kwargs):
+        return MessageWriteBehind(flush_interval=None, id_generator=MessageIdGenerator(worker_id=3), **kwargs)
+
+    def test_ids_are_increasing_and_browser_safe(self):
+        generator = MessageIdGenerator(worker_id=15)
+        ids = [generator.next_id() for _ in range(2000)]
+
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertLess(ids[-1], 2**53)
+
+    def test_messages_are_saved_on_flush_with_their_assigned_id_and_timestamp(self):
+        writer = self.make_writer(batch_size=2)
+        queued = [
+            writer.write(Message(conversation=self.conversation, sender=self.user, content=f"message {i}"))
+            for i in range(5)
+        ]
+        self.assertFalse(Message.objects.exists())
+
+        with CaptureQueriesContext(connections[DEFAULT_DB_ALIAS]) as queries:
+            writer.flush()
+        self.assertEqual(sum(query["sql"].startswith("INSERT") for query in queries.captured_queries), 3)
+
+        saved = list(Message.objects.order_by("id").values_list("id", "timestamp"))
+        self.assertEqual(saved, [(message.id, message.timestamp) for message in queued])
+        self.assertEqual(writer.pending_messages(), [])
+
+    def test_flush_advances_last_sequence_with_the_batch(self):
+        writer = self.make_writer(batch_size=2)
+        for sequence in (1, 2, 3):
+            writer.write(Message(conversation=self.conversation, sender=self.user, content="hi", sequence=sequence))
+
+        writer.flush()
+
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.last_sequence, 3)
+
+    def test_allocator_shares_gapless_counters_and_starts_after_saved_messages(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "sequences")
+        Conversation.objects.filter(id=self.conversation.id).update(last_sequence=41)
+        other = Conversation.objects.create(channel_id="2")
+        first, second = SequenceAllocator(path), SequenceAllocator(path)
+        self.addCleanup(first.close)
+        self.addCleanup(second.close)
+
+        with self.assertNumQueries(2):
+            sequences = [first.next_sequence(self.conversation.id), second.next_sequence(self.conversation.id)]
+        with self.assertNumQueries(0):
+            sequences += [first.next_sequence(self.conversation.id) for _ in range(3)]
+
+        self.assertEqual(sequences, [42, 43, 44, 45, 46])
+        self.assertEqual(second.next_sequence(other.id), 1)
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.last_sequence, 41)
+
+    def test_allocator_forgets_counters_of_a_recreated_database(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "sequences")
+        allocator = SequenceAllocator(path)
+        self.assertEqual([allocator.next_sequence(self.conversation.id) for _ in range(3)], [1, 2, 3])
+        allocator.close()
+
+        # As if the database had been deleted and migrated again
+        first = MigrationRecorder.Migration.objects.order_by("id").first()
+        first.applied -= timedelta(days=1)
+        first.save()
+        allocator = SequenceAllocator(path)
+        self.addCleanup(allocator.close)
+
+        self.assertEqual(allocator.next_sequence(self.conversation.id), 1)
+
+    def test_operational_errors_leave_the_batch_queued_for_the_next_flush(self):
+        writer = self.make_writer()
+        writer.write(Message(conversation=self.conversation, sender=self.user, content="one", sequence=1))
+        writer.write(Message(conversation=self.conversation, sender=self.user, content="two", sequence=2))
+
+        locked = OperationalError("database is locked")
+        with mock.patch.object(Message.objects, "bulk_create", side_effect=locked), self.assertRaises(OperationalError):
+            writer.flush()
+        self.assertEqual(len(writer.pending_messages()), 2)
+
+        writer.flush()
+        self.assertEqual(Message.objects.count(), 2)
+        self.assertEqual(writer.pending_messages(), [])
+
+    def test_only_conflicting_messages_are_dropped_and_counted(self):
+        Message.objects.create(conversation=self.conversation, sender=self.user, content="saved", sequence=2)
+        writer = self.make_writer()
+        for sequence in (1, 2, 3):
+            writer.write(Message(conversation=self.conversation, sender=self.user, content="new", sequence=sequence))
+        before = dropped_messages.value
+
+        with self.assertLogs("webchat.persistence", "WARNING"):
+            writer.flush()
+
+        self.assertEqual(dropped_messages.value - before, 1)
+        self.assertEqual(
+            sorted(Message.objects.values_list("sequence", "content")), [(1, "new"), (2, "saved"), (3, "new")]
+        )
+        self.assertEqual(writer.pending_messages(), [])
+
+    def test_is_full_once_max_pending_messages_are_queued(self):
+        writer = self.make_writer(max_pending=2)
+        writer.write(Message(conversation=self.conversation, sender=self.user, content="one"))
+        self.assertFalse(writer.is_full)
+
+        writer.write(Message(conversation=self.conversation, sender=self.user, content="two"))
+        self.assertTrue(writer.is_full)
+
+        writer.close()
+        self.assertFalse(writer.is_full)
+        self.assertEqual(Message.objects.count(), 2)
+
+
+@override_settings(WEBCHAT_WRITE_BEHIND={"ENABLED": True, "FLUSH_INTERVAL": None})
+class AsyncWebChatConsumerWriteBehindTests(ConsumerTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        write_behind = {**settings.WEBCHAT_WRITE_BEHIND, "SEQUENCE_FILE": os.path.join(directory.name, "sequences")}
+        self.enterContext(override_settings(WEBCHAT_WRITE_BEHIND=write_behind))
+
+    async def test_message_is_broadcast_before_it_is_saved(self):
+        sender = self.communicator(self.owner)
+        await sender.connect()
+
+        await sender.send_json_to({"message": "first"})
+        await sender.receive_json_from()
+        await sender.send_json_to({"message": "second"})
+        event = await sender.receive_json_from()
+
+        self.assertFalse(await Message.objects.filter(content="second").aexists())
+        await sender.disconnect()
+
+        await database_sync_to_async(get_message_writer().flush)()
+        saved = await Message.objects.aget(content="second")
+        self.assertEqual(saved.id, event["new_message"]["id"])
+        self.assertEqual(saved.timestamp.isoformat(), event["new_message"]["timestamp"])
+        self.assertEqual(saved.sequence, event["new_message"]["sequence"])
+
+    def test_sequences_are_allocated_without_a_write_per_message(self):
+        async def chat(queries):
+            sender = self.communicator(self.owner)
+            await sender.connect()
+            await sender.send_json_to({"message": "first"})
+            await sender.receive_json_from()
+            before = len(queries)
+            for i in range(5):
+                await sender.send_json_to({"message": f"line {i}"})
+                await sender.receive_json_from()
+            await sender.disconnect()
+            return queries.captured_queries[before:]
+
+        # The coroutine runs on another thread, so hand it this thread's connection explicitly
+        with CaptureQueriesContext(connections[DEFAULT_DB_ALIAS]) as queries:
+            self.assertEqual(async_to_sync(chat)(queries), [])
+
+        conversation = Conversation.objects.get(channel_id="1")
+        self.assertEqual(conversation.last_sequence, 0)
+        get_message_writer().flush()
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.last_sequence, 6)
+
+
+class UnixSocketChannelLayerTests(SimpleTestCase):
+    def setUp(self):
+        socket_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(socket_dir.cleanup)
+        self.socket_dir = socket_dir.name
+
+    def make_layer(self):
+        return UnixSocketChannelLayer(socket_dir=self.socket_dir)
+
+    def test_default_socket_dir_is_private_to_the_deployment(self):
+        here = UnixSocketChannelLayer().socket_dir
+        with override_settings(BASE_DIR="/srv/other-meowchat"):
+            elsewhere = UnixSocketChannelLayer().socket_dir
+
+        self.assertNotEqual(here, elsewhere)
+        self.assertNotEqual(os.path.basename(here), "meowchat-channels")
+
+    async def test_group_send_reaches_members_in_other_processes(self):
+        first, second = self.make_layer(), self.make_layer()
+        first_channel = await first.new_channel()
+        second_channel = await second.new_channel()
+        await first.group_add("chat", first_channel)
+        await second.group_add("chat", second_channel)
+
+        await first.group_send("chat", {"type": "chat.message", "text": "hi"})
+
+        self.assertEqual(await first.receive(first_channel), {"type": "chat.message", "text": "hi"})
+        received = await asyncio.wait_for(second.receive(second_channel), 1)
+        self.assertEqual(received, {"type": "chat.message", "text": "hi"})
+        await first.close()
+        await second.close()
+
+    async def test_send_is_routed_to_the_process_owning_the_channel(self):
+        first, second = self.make_layer(), self.make_layer()
+        channel = await second.new_channel()
+
+        await first.send(channel, {"type": "hello"})
+
+        self.assertEqual(await asyncio.wait_for(second.receive(channel), 1), {"type": "hello"})
+        await first.close()
+        await second.close()
+
+    async def test_discarded_channels_stop_receiving(self):
+        first, second = self.make_layer(), self.make_layer()
+        channel = await second.new_channel()
+        await second.group_add("chat", channel)
+        await second.group_discard("chat", channel)
+
+        await first.group_send("chat", {"type": "chat.message"})
+
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(second.receive(channel), 0.2)
+        await first.close()
+        await second.close()
+
+    async def test_messages_for_full_inboxes_are_counted_and_logged(self):
+        layer = UnixSocketChannelLayer(socket_dir=self.socket_dir, capacity=2)
+        channel = await layer.new_channel()
+        await layer.group_add("chat", channel)
+        before = layer_dropped_messages.value
+
+        with self.assertLogs("webchat.realtime", "WARNING") as logs:
+            for _ in range(3):
+                await layer.group_send("chat", {"type": "chat.message"})
+            layer._deliver({"op": "group_send", "group": "chat", "message": {"type": "chat.message"}})
+
+        self.assertEqual(layer_dropped_messages.value - before, 2)
+        self.assertEqual([record.event for record in logs.records], ["layer.message.dropped"] * 2)
+        await layer.close()
+
+    async def test_peers_that_stop_reading_are_dropped(self):
+        peer = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        peer.bind(os.path.join(self.socket_dir, "12345-stalled.sock"))
+        peer.listen()
+        self.addCleanup(peer.close)
+        layer = UnixSocketChannelLayer(socket_dir=self.socket_dir, send_timeout=0.1)
+
+        with self.assertLogs("webchat.layers", "WARNING"):
+            await asyncio.wait_for(layer.group_send("chat", {"type": "chat.message", "text": "m" * (8 << 20)}), 5)
+
+        self.assertEqual(layer._writers, {})
+        await layer.close()
+
+    def test_connections_of_finished_event_loops_are_closed(self):
+        peer = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        peer.bind(os.path.join(self.socket_dir, "12345-peer.sock"))
+        peer.listen()
+        self.addCleanup(peer.close)
+        layer = self.make_layer()
+
+        # Every call from plain sync code runs on an event loop of its own
+        async_to_sync(layer.group_send)("chat", {"type": "chat.message"})
+        first, _ = peer.accept()
+        self.addCleanup(first.close)
+        async_to_sync(layer.group_send)("chat", {"type": "chat.message"})
+        second, _ = peer.accept()
+        self.addCleanup(second.close)
+
+        first.settimeout(1)
+        self.assertTrue(first.recv(1 << 16))
+        self.assertEqual(first.recv(1 << 16), b"")
+        async_to_sync(layer.close)()
+
+    async def test_sockets_left_by_dead_processes_are_removed(self):
+        stale_path = os.path.join(self.socket_dir, "12345-stale.sock")
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(stale_path)
+        stale.close()
+        layer = self.make_layer()
+
+        await layer.group_send("chat", {"type": "chat.message"})
+
+        self.assertFalse(os.path.exists(stale_path))
+        await layer.close()
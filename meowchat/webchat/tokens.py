@@ -0,0 +1,126 @@
+"""Process-local cache of verified WebSocket access tokens.
+
+Decoding the `access_token` cookie and loading its user costs a signature check and a
+query on every handshake, although clients reconnect with the same token many times
+before it expires. Each verified token is kept, keyed by its SHA-256 digest so raw
+tokens never sit in memory, together with its claims and a snapshot of the fields of
+the user the consumers read. An entry lives until the token's `exp` or for
+`WEBCHAT_TOKEN_CACHE["TTL"]` seconds, whichever comes first, and the least recently
+used entries are evicted past `WEBCHAT_TOKEN_CACHE["MAX_ENTRIES"]`.
+
+Logging out, and saving or deleting a user, drops the user's tokens from the cache of
+the process that did it; the TTL bounds staleness everywhere else.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.signals import user_logged_out
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from meowchat.metrics import counter
+
+# The user fields consumers read, everything else is deferred
+SNAPSHOT_FIELDS = ("id", "username", "is_active")
+
+token_cache_hits = counter("webchat_token_cache_hits_total", "WebSocket handshakes authenticated from the token cache")
+token_cache_misses = counter("webchat_token_cache_misses_total", "WebSocket handshakes that had to verify their token")
+
+
+def token_digest(token):
+    return hashlib.sha256(token.encode()).digest()
+
+
+def user_snapshot(user):
+    return tuple(getattr(user, field) for field in SNAPSHOT_FIELDS)
+
+
+class VerifiedTokenCache:
+    def __init__(self, max_entries=10000, ttl=300, clock=time.time):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._by_user = {}
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        """Returns `(claims, user)` for a cached token, or None.
+
+        The user is a fresh model instance built from the snapshot, with every field
+        outside `SNAPSHOT_FIELDS` deferred.
+        """
+        if not self.max_entries:
+            return None
+        digest = token_digest(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None and entry[0] <= self.clock():
+                self._discard(digest)
+                entry = None
+            if entry is None:
+                token_cache_misses.inc()
+                return None
+            self._entries.move_to_end(digest)
+        token_cache_hits.inc()
+        _, claims, snapshot = entry
+        return claims, get_user_model().from_db(DEFAULT_DB_ALIAS, SNAPSHOT_FIELDS, snapshot)
+
+    def put(self, token, claims, user):
+        if not self.max_entries:
+            return
+        expires_at = self.clock() + self.ttl
+        if "exp" in claims:
+            expires_at = min(expires_at, claims["exp"])
+        digest = token_digest(token)
+        with self._lock:
+            self._discard(digest)
+            self._entries[digest] = (expires_at, claims, user_snapshot(user))
+            self._by_user.setdefault(user.id, set()).add(digest)
+            while len(self._entries) > self.max_entries:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for digest in list(self._by_user.get(user_id, ())):
+                self._discard(digest)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _discard(self, digest):
+        entry = self._entries.pop(digest, None)
+        if entry is None:
+            return
+        user_id = entry[2][0]
+        digests = self._by_user.get(user_id)
+        if digests is not None:
+            digests.discard(digest)
+            if not digests:
+                del self._by_user[user_id]
+
+
+token_cache = VerifiedTokenCache(**{key.lower(): value for key, value in settings.WEBCHAT_TOKEN_CACHE.items()})
+
+
+@receiver(user_logged_out)
+def user_logged_out_handler(sender, user, **kwargs):
+    if user is not None:
+        token_cache.invalidate_user(user.id)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def user_saved_or_deleted(sender, instance, **kwargs):
+    # Covers deactivation and renames, which would otherwise leave a stale snapshot
+    token_cache.invalidate_user(instance.id)
@@ -0,0 +1,102 @@
+"""Process-local, coalesced typing indicators.
+
+Typing pings from clients never reach the channel layer one by one. Each worker keeps
+the users typing in every channel in memory, each entry expiring `WEBCHAT_TYPING_TTL`
+seconds after that user's last ping, and broadcasts one snapshot of them per channel
+at most every `WEBCHAT_TYPING_INTERVAL` seconds, and only while someone is pinging.
+
+A snapshot only lists the typists connected to the worker that sent it, so clients
+show the union of the users named in the snapshots of the last `ttl` milliseconds.
+Nothing here touches the database.
+"""
+
+import asyncio
+import json
+import threading
+import time
+
+from django.conf import settings
+
+
+class TypingTracker:
+    def __init__(self, ttl=3.0, interval=0.5, clock=time.monotonic):
+        self.ttl = ttl
+        self.interval = interval
+        self.clock = clock
+        self._typists = {}
+        self._next_snapshot_at = {}
+        self._scheduled = set()
+        self._next_sweep = 0
+        self._lock = threading.Lock()
+
+    def ping(self, channel, username):
+        """Records that `username` is typing in `channel`.
+
+        Returns the seconds until the channel's next snapshot is due, 0 meaning now,
+        or None when a snapshot is already scheduled. The caller is expected to call
+        `snapshot` after that delay and broadcast the result.
+        """
+        now = self.clock()
+        with self._lock:
+            self._typists.setdefault(channel, {})[username] = now + self.ttl
+            if channel in self._scheduled:
+                return None
+            self._scheduled.add(channel)
+            return max(0.0, self._next_snapshot_at.get(channel, 0) - now)
+
+    def stop(self, channel, username):
+        """Forgets that `username` was typing in `channel`, e.g. because they sent the message."""
+        with self._lock:
+            typists = self._typists.get(channel)
+            if typists is not None:
+                typists.pop(username, None)
+
+    def snapshot(self, channel):
+        """Returns the users still typing in `channel` and starts its next interval."""
+        now = self.clock()
+        with self._lock:
+            self._scheduled.discard(channel)
+            self._next_snapshot_at[channel] = now + self.interval
+            typists = self._typists.get(channel, {})
+            for username in [username for username, expires_at in typists.items() if expires_at <= now]:
+                del typists[username]
+            if not typists:
+                self._typists.pop(channel, None)
+            if now >= self._next_sweep:
+                self._sweep(now)
+            return sorted(typists)
+
+    def _sweep(self, now):
+        # Channels nobody typed in for a while would otherwise be remembered forever
+        self._next_sweep = now + self.ttl
+        for channel in [channel for channel, at in self._next_snapshot_at.items() if at <= now]:
+            if channel not in self._scheduled:
+                del self._next_snapshot_at[channel]
+        for channel, typists in list(self._typists.items()):
+            if channel not in self._scheduled and all(expires_at <= now for expires_at in typists.values()):
+                del self._typists[channel]
+
+
+def typing_snapshot_event(users, ttl):
+    """Builds the group event for a typing snapshot, with the client frame already encoded."""
+    frame = {"type": "typing", "users": users, "ttl": int(ttl * 1000)}
+    return {"type": "typing.snapshot", "text": json.dumps(frame)}
+
+
+typing_tracker = TypingTracker(
+    ttl=getattr(settings, "WEBCHAT_TYPING_TTL", 3.0), interval=getattr(settings, "WEBCHAT_TYPING_INTERVAL", 0.5)
+)
+
+
+async def broadcast_snapshot(channel_layer, channel, tracker):
+    await channel_layer.group_send(channel, typing_snapshot_event(tracker.snapshot(channel), tracker.ttl))
+
+
+async def schedule_snapshot(channel_layer, channel, tracker, delay):
+    """Schedules the broadcast of the channel's snapshot in `delay` seconds and returns at once.
+
+    The timer lives on the event loop, so sync consumers call this through
+    `async_to_sync`, which runs it on the server's loop.
+    """
+    loop = asyncio.get_running_loop()
+    loop.call_later(delay, lambda: loop.create_task(broadcast_snapshot(channel_layer, channel, tracker)))
@@ -1,20 +1,352 @@
-from rest_framework import viewsets
+import json
+import zlib
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import CharField
+from django.db.models.functions import Cast
+from django.http import HttpResponse, StreamingHttpResponse
+from meowchat.metrics import render_prometheus
+from rest_framework import status, viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, PermissionDenied, ValidationError
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from server.membership import membership_cache
+from server.models import Channel
+
+from .archive import cold_messages, iter_cold_messages
+from .models import Conversation, Message
+from .persistence import get_message_writer
+from .read_markers import get_read_markers, unread_counts
+from .schemas import (
+    export_message_docs,
+    list_message_docs,
+    metrics_docs,
+    read_message_docs,
+    search_message_docs,
+    unread_message_docs,
+)
+from .search import decode_cursor, encode_cursor, highlight, match_expression, search_messages
+from .serializers import MessageSearchResultSerializer, MessageSerializer, ReadAckSerializer
+
+
+def parse_cursor(request, name):
+    value = request.query_params.get(name)
+    if value is None or value == "":
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValidationError(detail=f"{name} must be a message id")
+
+
+def parse_positive_int(request, name, default=None, maximum=None):
+    """Returns a positive integer query parameter, or `default` when it is absent, capped at `maximum`."""
+    value = request.query_params.get(name)
+    if value is None or value == "":
+        number = default
+    else:
+        try:
+            number = int(value)
+        except ValueError:
+            number = 0
+        if number < 1:
+            raise ValidationError(detail=f"{name} must be a positive integer")
+    if number is None or maximum is None:
+        return number
+    return min(number, maximum)
+
+
+def require_channel_access(request, channel_id):
+    """Raises unless the user is an admin or a member of the channel's server."""
+    if request.user.is_staff:
+        return
+    server_id = None
+    if channel_id and channel_id.isdigit():
+        server_id = Channel.objects.filter(id=channel_id).values_list("server_id", flat=True).first()
+    if server_id is None:
+        raise NotFound(detail="Channel not found")
+    if not membership_cache.is_member(server_id, request.user.id):
+        raise PermissionDenied(detail="Not a member of this server")
+
+
+def export_record(message_id, sender, content, timestamp):
+    return json.dumps({"id": message_id, "sender": sender, "content": content, "timestamp": timestamp.isoformat()})
+
 
-from .models import Conversation
-from .schemas import list_message_docs
-from .serializers import MessageSerializer
+def export_lines(conversation_id, chunk_size):
+    """Yields a conversation's messages as NDJSON, one chunk of rows at a time.
+
+    Archived messages come first, they are older than everything in the message table.
+    """
+    for messages in iter_cold_messages(conversation_id, chunk_size):
+        yield "".join(
+            export_record(message.id, message.sender and message.sender.username, message.content, message.timestamp)
+            + "\n"
+            for message in messages
+        ).encode()
+
+    rows = (
+        Message.objects.filter(conversation_id=conversation_id)
+        .order_by("id")
+        .values_list("id", "sender__username", "content", "timestamp")
+        .iterator(chunk_size=chunk_size)
+    )
+    lines = []
+    for row in rows:
+        lines.append(export_record(*row) + "\n")
+        if len(lines) >= chunk_size:
+            yield "".join(lines).encode()
+            lines = []
+    if lines:
+        yield "".join(lines).encode()
+
+
+def async_stream(chunks):
+    """Wraps a sync iterator for ASGI servers, pulling one chunk at a time in the request's thread.
+
+    Given a sync iterator, an ASGI `StreamingHttpResponse` consumes it whole into a list
+    before sending anything, so a streamed export would be held in memory after all.
+    """
+
+    async def iterate():
+        iterator = iter(chunks)
+        while True:
+            chunk = await sync_to_async(next, thread_sensitive=True)(iterator, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    return iterate()
+
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
 
 
 class MessageViewSet(viewsets.ViewSet):
     @list_message_docs
     def list(self, request):
+        """Returns one page of a channel's messages, oldest first.
+
+        Pages are keyed on message id: without a cursor the newest `limit` messages are
+        returned, `before` pages back through older messages and `after` forward through
+        newer ones. `limit` is capped at `WEBCHAT_MESSAGE_PAGE_SIZE_MAX`. The `before` and
+        `after` fields of the response are the cursors for the neighbouring pages, or null
+        when there is nothing more in that direction.
+        """
+        channel_id = request.query_params.get("channel_id")
+        before = parse_cursor(request, "before")
+        after = parse_cursor(request, "after")
+        limit = parse_positive_int(
+            request, "limit", settings.WEBCHAT_MESSAGE_PAGE_SIZE, settings.WEBCHAT_MESSAGE_PAGE_SIZE_MAX
+        )
+
+        # Resolved up front so the page query is a range scan on (conversation_id, id)
+        conversation = Conversation.objects.filter(channel_id=channel_id).values_list("id", "archived_through").first()
+        if conversation is None:
+            return Response({"results": [], "before": None, "after": None})
+        conversation_id, archived_through = conversation
+
+        messages = (
+            Message.objects.filter(conversation_id=conversation_id)
+            .select_related("sender")
+            .only("id", "sequence", "content", "timestamp", "sender__username")
+        )
+        if before is not None:
+            messages = messages.filter(id__lt=before)
+        if after is not None:
+            messages = messages.filter(id__gt=after)
+
+        # Fetch one extra row to know whether there is another page in the paging direction.
+        # Archived messages are all older than the table's, so pages that reach past the
+        # oldest row in the table continue in the archive segments
+        backwards = after is None
+        if backwards:
+            page = list(messages.order_by("-id")[: limit + 1])
+            if len(page) <= limit and archived_through:
+                older_than = page[-1].id if page else before
+                page += cold_messages(conversation_id, limit + 1 - len(page), before=older_than)
+        else:
+            page = cold_messages(conversation_id, limit + 1, after=after) if after < archived_through else []
+            if len(page) <= limit:
+                page += list(messages.order_by("id")[: limit + 1 - len(page)])
+        has_more = len(page) > limit
+        page = page[:limit]
+        if backwards:
+            page.reverse()
+
+        has_older = has_more if backwards else after is not None
+        has_newer = before is not None if backwards else has_more
+
+        serializer = MessageSerializer(page, many=True)
+        return Response(
+            {
+                "results": serializer.data,
+                "before": page[0].id if page and has_older else None,
+                "after": page[-1].id if page and has_newer else None,
+            }
+        )
+
+    @export_message_docs
+    @action(detail=False, methods=["get"])
+    def export(self, request):
+        """Streams a channel's whole history as NDJSON, oldest first.
+
+        Rows are read in chunks of `WEBCHAT_EXPORT_CHUNK_SIZE` and written out as they
+        arrive, so memory stays flat however long the channel is. Pass `gzip=true` to
+        get the stream gzip compressed. Only members of the channel's server and admins
+        may export it.
+        """
         channel_id = request.query_params.get("channel_id")
+        compress = request.query_params.get("gzip", "").lower() in ("true", "1", "yes")
+
+        require_channel_access(request, channel_id)
 
+        conversation_id = Conversation.objects.filter(channel_id=channel_id).values_list("id", flat=True).first()
+        chunks = () if conversation_id is None else export_lines(conversation_id, settings.WEBCHAT_EXPORT_CHUNK_SIZE)
+        filename = "messages.ndjson"
+        if compress:
+            chunks = gzip_stream(chunks)
+            filename += ".gz"
+
+        if isinstance(request._request, ASGIRequest):
+            chunks = async_stream(chunks)
+
+        response = StreamingHttpResponse(
+            chunks, content_type="application/gzip" if compress else "application/x-ndjson"
+        )
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
+        return response
+
+    @search_message_docs
+    @action(detail=False, methods=["get"])
+    def search(self, request):
+        """Full-text search over the messages of a server the user is a member of.
+
+        Every word of `q` must appear in a message, the last one may be the start of a
+        word. Results come best match first with an HTML-escaped `snippet` marking the
+        matches; pass `next` back as `cursor` for the following page. `channel_id`
+        narrows the search to one channel of the server. Only messages still in the
+        message table are searched, archived ones are listed and exported but not found.
+        """
+        server_id = parse_positive_int(request, "server_id")
+        if server_id is None:
+            raise ValidationError(detail="server_id is required")
+        expression = match_expression(request.query_params.get("q", ""))
+        if expression is None:
+            raise ValidationError(detail="q must contain a word")
+        cursor = request.query_params.get("cursor")
         try:
-            conversation = Conversation.objects.get(channel_id=channel_id)
-            message = conversation.message.all()
-            serializer = MessageSerializer(message, many=True)
-            return Response(serializer.data)
-        except Conversation.DoesNotExist:
-            return Response([])
+            after = decode_cursor(cursor) if cursor else None
+        except ValueError:
+            raise ValidationError(detail="cursor is invalid")
+        limit = parse_positive_int(
+            request, "limit", settings.WEBCHAT_MESSAGE_PAGE_SIZE, settings.WEBCHAT_MESSAGE_PAGE_SIZE_MAX
+        )
+
+        is_member = membership_cache.is_member(server_id, request.user.id)
+        if is_member is None:
+            raise NotFound(detail="Server not found")
+        if not is_member:
+            raise PermissionDenied(detail="Not a member of this server")
+
+        # Conversations are keyed by the channel id as text
+        channel_keys = Channel.objects.filter(server_id=server_id).annotate(key=Cast("id", CharField())).values("key")
+        conversations = Conversation.objects.filter(channel_id__in=channel_keys)
+        channel_id = request.query_params.get("channel_id")
+        if channel_id:
+            conversations = conversations.filter(channel_id=channel_id)
+        conversation_ids = list(conversations.values_list("id", flat=True))
+
+        rows = search_messages(expression, conversation_ids, limit + 1, after)
+        next_cursor = encode_cursor(rows[limit - 1][1], rows[limit - 1][0]) if len(rows) > limit else None
+        rows = rows[:limit]
+        messages = (
+            Message.objects.select_related("sender", "conversation")
+            .only("id", "sequence", "content", "timestamp", "sender__username", "conversation__channel_id")
+            .in_bulk([message_id for message_id, _, _ in rows])
+        )
+        page = []
+        for message_id, _, snippet in rows:
+            message = messages[message_id]
+            message.snippet = highlight(snippet)
+            page.append(message)
+
+        serializer = MessageSearchResultSerializer(page, many=True)
+        return Response(
+            {
+                "results": serializer.data,
+                "next": next_cursor,
+            }
+        )
+
+    @read_message_docs
+    @action(detail=False, methods=["post"])
+    def read(self, request):
+        """Marks a channel as read up to a message sequence number.
+
+        Acknowledgements are coalesced and saved within `WEBCHAT_READ_MARKERS["FLUSH_INTERVAL"]`
+        seconds, so clients can send one for every message that scrolls into view. A
+        marker never moves backwards. Only members of the channel's server and admins may
+        mark it.
+        """
+        serializer = ReadAckSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        channel_id = serializer.validated_data["channel_id"]
+        require_channel_access(request, channel_id)
+
+        conversation_id = Conversation.objects.filter(channel_id=channel_id).values_list("id", flat=True).first()
+        if conversation_id is None:
+            raise NotFound(detail="Channel has no messages")
+        get_read_markers().mark(request.user.id, conversation_id, serializer.validated_data["sequence"])
+        return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+
+    @unread_message_docs
+    @action(detail=False, methods=["get"])
+    def unread(self, request):
+        """Returns the unread message count of every channel in the user's servers.
+
+        Channels without any message are left out.
+        """
+        # Acks still buffered in this process would otherwise show as unread, and
+        # queued messages would be missing from the counts
+        get_read_markers().flush()
+        writer = get_message_writer()
+        if writer is not None:
+            writer.flush()
+        return Response(
+            {
+                "results": [
+                    {
+                        "channel_id": channel_id,
+                        "sequence": sequence,
+                        "read_sequence": read_sequence,
+                        "unread": max(0, sequence - read_sequence),
+                    }
+                    for channel_id, sequence, read_sequence in unread_counts(request.user)
+                ]
+            }
+        )
+
+
+class MetricsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    @metrics_docs
+    def get(self, request):
+        """Returns this worker's realtime metrics in the Prometheus text format.
+
+        Counters and histograms are kept per process, so a scrape sees the worker that
+        served it.
+        """
+        return HttpResponse(render_prometheus(), content_type="text/plain; version=0.0.4; charset=utf-8")